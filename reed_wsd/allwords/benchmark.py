@@ -0,0 +1,91 @@
+"""
+Micro-benchmarks for the allwords pipeline.
+
+Example usage:
+
+python benchmark.py
+
+"""
+
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+import time
+import random
+import torch
+from reed_wsd.util import apply_zone_mask
+
+BATCH_SIZES = [16, 64, 256, 1024, 4096]
+
+
+def zero_out_probs_by_row(input_vec, zones):
+    """
+    The row-by-row zone masking that apply_zone_mask replaces; kept here as
+    the baseline for benchmark_zone_masks.
+    
+    """
+    new_vec = torch.full(input_vec.shape, float('-inf'), device=input_vec.device)
+    for row in range(len(zones)):
+        start, stop = zones[row]
+        new_vec[row, start: stop] = input_vec[row, start: stop]
+    return new_vec
+
+
+def random_zones(batch_size, num_senses, max_zone_size=30):
+    zones = []
+    for _ in range(batch_size):
+        size = random.randint(1, max_zone_size)
+        start = random.randint(0, num_senses - size)
+        zones.append((start, start + size))
+    return zones
+
+
+def time_per_call(fn, n_trials):
+    fn() # warm-up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_trials):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_trials
+
+
+def benchmark_zone_masks(batch_sizes=BATCH_SIZES, num_senses=2000, n_trials=20,
+                         device='cpu'):
+    """
+    Times row-by-row zone masking against apply_zone_mask (with zones given
+    either as a list of pairs or as a precomputed tensor). Returns one
+    dictionary of per-batch times (in milliseconds) for each batch size.
+    
+    """
+    results = []
+    for batch_size in batch_sizes:
+        input_vec = torch.randn(batch_size, num_senses, device=device)
+        zones = random_zones(batch_size, num_senses)
+        zone_tensor = torch.tensor(zones, dtype=torch.long, device=device)
+        assert(torch.equal(zero_out_probs_by_row(input_vec, zones),
+                           apply_zone_mask(input_vec, zone_tensor)))
+        by_row = time_per_call(lambda: zero_out_probs_by_row(input_vec, zones), n_trials)
+        from_list = time_per_call(lambda: apply_zone_mask(input_vec, zones), n_trials)
+        from_tensor = time_per_call(lambda: apply_zone_mask(input_vec, zone_tensor), n_trials)
+        results.append({'batch_size': batch_size,
+                        'by_row_ms': 1000 * by_row,
+                        'list_ms': 1000 * from_list,
+                        'tensor_ms': 1000 * from_tensor})
+    return results
+
+
+def print_zone_mask_benchmark(results):
+    print('{:>10} {:>12} {:>12} {:>12} {:>9}'.format('batch', 'by row (ms)', 
+                                                   'list (ms)', 'tensor (ms)',
+                                                   'speedup'))
+    for result in results:
+        print('{:>10} {:>12.3f} {:>12.3f} {:>12.3f} {:>8.1f}x'.format(
+              result['batch_size'], result['by_row_ms'], result['list_ms'],
+              result['tensor_ms'], result['by_row_ms'] / result['tensor_ms']))
+
+
+if __name__ == '__main__':
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print_zone_mask_benchmark(benchmark_zone_masks(device=device))
@@ -1,5 +1,5 @@
 import torch
-from transformers import BertModel, BertTokenizer
+from transformers import BertModel, BertTokenizer, BertTokenizerFast
 from reed_wsd.util import cudaify
 
 
@@ -8,19 +8,52 @@ def tokenize_with_target(tokenizer, sent, target_i):
     sent: a list of words to be tokenized
     target: the target word
     """
-    sent = ['[CLS]'] + sent + ['[SEP]']
-    tks = []
-    start = 0
-    tracker = 0
-    for i, word in enumerate(sent):
-        if i == target_i + 1:
-            start = tracker
-        curr_tks = tokenizer.tokenize(word)
-        tracker += len(curr_tks)
-        if i == target_i + 1:
-            end = tracker
-        tks += curr_tks
-    return torch.tensor(tokenizer.convert_tokens_to_ids(tks)), [start, end]
+    return with_target(tokenizer, tokenize_words(tokenizer, sent), target_i)
+
+
+def tokenize_words(tokenizer, sent):
+    """
+    Returns the token ids of each word of sent (a list of words).
+    
+    """
+    return [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(word)) 
+            for word in sent]
+
+
+def with_target(tokenizer, word_ids, target_i):
+    """
+    Joins the token ids of each word (as returned by tokenize_words) into
+    the ids of the sentence, between [CLS] and [SEP]. Returns them along 
+    with the [start, end) token span of word target_i.
+    
+    """
+    ids = [tokenizer.cls_token_id]
+    for i, curr_ids in enumerate(word_ids):
+        if i == target_i:
+            start = len(ids)
+        ids += curr_ids
+        if i == target_i:
+            end = len(ids)
+    ids.append(tokenizer.sep_token_id)
+    return torch.tensor(ids), [start, end]
+
+
+def word_spans(word_ids, n_words):
+    """
+    Converts the word index of each token (as returned by a fast 
+    tokenizer's word_ids, with None for special tokens) into the 
+    [start, stop) token span of each of the n_words words. Words that 
+    produce no tokens get a span of None.
+    
+    """
+    spans = [None] * n_words
+    for token_index, word_index in enumerate(word_ids):
+        if word_index is not None:
+            if spans[word_index] is None:
+                spans[word_index] = [token_index, token_index + 1]
+            else:
+                spans[word_index][1] = token_index + 1
+    return spans
     
 
 class BertSentenceVectorizer:
@@ -31,19 +64,50 @@ class BertSentenceVectorizer:
     
     """
     def __init__(self):
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
         self.model = cudaify(BertModel.from_pretrained('bert-base-uncased'))
 
     def __call__(self, sent):
-        # Add special tokens takes care of adding [CLS], [SEP], <s>... tokens 
-        # in the right way for each model.
-        input_ids = self.tokenizer.encode(sent, add_special_tokens=True) 
-        bert_toks = self.tokenizer.convert_ids_to_tokens(input_ids)
-        input_ids = torch.tensor([input_ids])
+        return self.encode_batch([self.tokenize(sent)])[0]
+
+    def tokenize(self, sent):
+        return self.tokenizer.encode(sent, add_special_tokens=True)
+
+    def tokenize_words(self, words):
+        """
+        Tokenizes a sentence given as a list of words. Returns the token ids
+        and the token span of each word (see word_spans).
+        
+        """
+        encoding = self.tokenizer(words, is_split_into_words=True, 
+                                  add_special_tokens=True)
+        return encoding['input_ids'], word_spans(encoding.word_ids(), len(words))
+
+    def encode_batch(self, input_ids_list):
+        """
+        Runs a list of token id sequences (as returned by .tokenize) through 
+        BERT in a single padded forward pass. Returns a list of 
+        (bert_toks, last_hidden_states) pairs, with the padding stripped.
+        
+        """
+        lengths = torch.tensor([len(ids) for ids in input_ids_list])
+        input_ids = torch.full((len(input_ids_list), lengths.max().item()), 
+                               self.tokenizer.pad_token_id, dtype=torch.long)
+        for i, ids in enumerate(input_ids_list):
+            input_ids[i, :len(ids)] = torch.tensor(ids)
+        attention_mask = (torch.arange(input_ids.shape[1]).unsqueeze(0) 
+                          < lengths.unsqueeze(1)).long()
         with torch.no_grad():
-            last_hidden_states = self.model(cudaify(input_ids))[0]
-            last_hidden_states = last_hidden_states.squeeze(0)
-            return bert_toks, last_hidden_states
+            last_hidden_states = self.model(cudaify(input_ids), 
+                                            attention_mask=cudaify(attention_mask))[0]
+        result = []
+        for i, ids in enumerate(input_ids_list):
+            bert_toks = self.tokenizer.convert_ids_to_tokens(ids)
+            result.append((bert_toks, last_hidden_states[i, :len(ids)]))
+        return result
+
+    def batch(self, sents):
+        return self.encode_batch([self.tokenize(sent) for sent in sents])
         
     def dim(self):
         return 768
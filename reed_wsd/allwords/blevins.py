@@ -2,54 +2,138 @@ import os, sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import math
 import random
+import torch
+from os.path import join
 from torch.utils.data import Dataset
-from reed_wsd.allwords.bert import tokenize_with_target
+from reed_wsd.allwords.bert import tokenize_words, with_target
+from torch.nn.utils.rnn import pad_sequence
 from reed_wsd.allwords.wordnet import wn_example, wn_definition_with_target
 from nltk.corpus import wordnet as wn
 from transformers import BertTokenizer
 import nltk
-from reed_wsd.allwords.wordsense import SenseInventory
+from reed_wsd.allwords.wordsense import SenseInventory, sample_inventory, sentence_order
+from reed_wsd.allwords.wordsense import sentence_groups, sentence_sampler
+from reed_wsd.loader import Loader
+
+
+class GlossCache:
+    """
+    The tokenized, padded glosses of the senses of a lemma, together with
+    their representation spans. Entries are keyed by (lemma, gloss mode),
+    plus the target's wordform in 'wneg' mode, since the chosen example
+    sentence depends on it. They are computed on first use and can be
+    persisted with save. 'wneg' examples are found with example_index
+    (by default, the ExampleIndex shared by users of the same tokenizer).
+    
+    """
+    def __init__(self, tknz, entries=None, filename=None, example_index=None):
+        self.tknz = tknz
+        self.entries = entries if entries is not None else dict()
+        self.filename = filename
+        self.example_index = example_index
+        self.n_added = 0
+
+    @staticmethod
+    def key(lemma, gloss, wordform=None):
+        if gloss == 'wneg':
+            return (lemma, gloss, wordform)
+        return (lemma, gloss)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def glosses(self, lemma, senses, gloss, wordform=None):
+        key = GlossCache.key(lemma, gloss, wordform)
+        entry = self.entries.get(key)
+        if entry is None or entry['senses'] != senses:
+            entry = self.tokenize(senses, gloss, wordform)
+            self.entries[key] = entry
+            self.n_added += 1
+        result = dict(entry['encoding'])
+        result['span'] = list(entry['span'])
+        return result
+
+    def tokenize(self, senses, gloss, wordform=None, rand=False):
+        if gloss == 'defn_cls':
+            glosses = [wn.lemma_from_key(sense).synset().definition() for sense in senses]
+            rep_spans = [[0, 1]] * len(glosses)
+        else:
+            glosses = []
+            rep_spans = []
+            for sense in senses:
+                wn_lemma = wn.lemma_from_key(sense)
+                if gloss == 'defn_tgt':
+                    gloss_str, rep_span = wn_definition_with_target(self.tknz, wn_lemma)
+                else:
+                    gloss_str, rep_span = wn_example(wn_lemma, wordform, self.tknz, rand=rand,
+                                                      index=self.example_index)
+                glosses.append(gloss_str)
+                rep_spans.append(rep_span)
+        encoding = self.tknz(glosses, padding=True, return_tensors='pt')
+        return {'senses': list(senses), 
+                'encoding': dict(encoding), 
+                'span': rep_spans}
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = self.filename
+        partial_file = filename + '.partial'
+        torch.save(self.entries, partial_file)
+        os.replace(partial_file, filename)
+        self.n_added = 0
+
+    @staticmethod
+    def from_file(filename, tknz, example_index=None):
+        """
+        Loads the cache from filename if it exists; otherwise returns an
+        empty cache that save() will write to filename.
+        
+        """
+        entries = None
+        if os.path.exists(filename):
+            entries = torch.load(filename)
+        return GlossCache(tknz, entries, filename, example_index)
+
 
 class BEMDataset(Dataset):
+    """
+    A map-style dataset of bi-encoder instances. On construction, it builds
+    an index with one (sentence index, word position) entry per annotated 
+    word whose lemma is in the inventory, so that __getitem__ is O(1).
 
+    The tokenized glosses are looked up in a GlossCache (an in-memory one
+    if gloss_cache is None), except for random 'wneg' examples, which
+    are drawn anew each time. The word-level token ids of each sentence
+    are memoized, so a sentence is tokenized once however many targets
+    it has.
+    
+    """
     def __init__(self, st_sents, randomize_sents = True, sense_sz=-1, 
-                 gloss='defn_cls', random_wneg=False):
+                 gloss='defn_cls', random_wneg=False, gloss_cache=None):
         assert sense_sz == -1 or sense_sz > 0, "sense_sz must be either positive integer or -1"
         assert(gloss in ['defn_cls', 'defn_tgt', 'wneg'])
         if random_wneg:
             assert gloss == 'wneg', 'need wneg gloss to turn on random examples'
         self.st_sents = st_sents
-        self.instance_index = 0
         self.gloss = gloss
         self.random_wneg = random_wneg
         self.randomize_sents = randomize_sents
         self.tknz = BertTokenizer.from_pretrained('bert-base-uncased')
-        self.num_insts = self.st_sents.get_n_insts()
+        if gloss_cache is None:
+            gloss_cache = GlossCache(self.tknz)
+        self.gloss_cache = gloss_cache
+        self.sent_tokens = dict()
         self.inv = self.st_sents.get_inventory()
-        self.instance_iter = self.item_iter()
         self.lemmatizer = nltk.stem.WordNetLemmatizer()
-        self.current_instance = next(self.instance_iter)
         if sense_sz > 0:
-            all_senses_by_lemma = self.inv.get_senses_by_lemma()
-            key_samples = random.sample(all_senses_by_lemma.keys(), sense_sz)
-            new_senses_by_lemma = {}
-            for k in key_samples:
-                new_senses_by_lemma[k] = all_senses_by_lemma[k]
-            self.inv = SenseInventory(new_senses_by_lemma)
-            # recount n_insts
-            self.count_insts()
+            self.inv = sample_inventory(self.inv, sense_sz)
+        self.count_insts()
 
     def count_insts(self):
-        n_insts = 0
-        sent_ids = list(range(len(self.st_sents)))
-        for i, index in enumerate(sent_ids):            
-            st_sent = self.st_sents[index] 
-            for i, word in enumerate(st_sent['words']):
-                if 'sense' in word:
-                    lemma = self.inv.sense_lemma(word['sense'])
-                    if lemma in self.inv.get_senses_by_lemma():
-                        n_insts += 1
-        self.num_insts = n_insts
+        sent_indices, positions = self.st_sents.instance_positions(self.inv)
+        self.index = list(zip(sent_indices.tolist(), positions.tolist()))
+        self.sent_bounds = sentence_groups(sent_indices)
+        self.num_insts = len(self.index)
         
     def onehot(self, sense):
         return self.st_sents.onehot(sense)
@@ -65,74 +149,85 @@ class BEMDataset(Dataset):
         self.randomize_sents = value
 
     def item_iter(self):
-        sent_ids = list(range(len(self.st_sents)))
-        if self.randomize_sents:
-            random.shuffle(sent_ids)
-        for i, index in enumerate(sent_ids):            
-            st_sent = self.st_sents[index] 
-            old_toks = [wd['word'] for wd in st_sent['words']]    
-            for i, word in enumerate(st_sent['words']):
-                if 'sense' in word:
-                    s = word['sense']
-                    lemma = self.inv.sense_lemma(s)
-                    if lemma in self.inv.get_senses_by_lemma():
-                        input_ids, target_range = tokenize_with_target(self.tknz, old_toks, i)
-                        senses = self.inv.get_senses(lemma)
-                        correct_sense_i = senses.index(s) 
-                        if self.gloss == 'defn_cls':
-                            glosses = [wn.lemma_from_key(sense).synset().definition() for sense in senses]
-                            glosses_ids = self.tknz(glosses, padding=True, return_tensors='pt')
-                            gloss_span = [[0, 1]] * len(glosses)
-                            glosses_ids['span'] = gloss_span
-                        if self.gloss == 'defn_tgt':
-                            glosses = []
-                            rep_spans = []
-                            for sense in senses:
-                                wn_lemma = wn.lemma_from_key(sense)
-                                gloss, rep_span = wn_definition_with_target(self.tknz, wn_lemma)
-                                glosses.append(gloss)
-                                rep_spans.append(rep_span)
-                            glosses_ids = self.tknz(glosses, padding=True, return_tensors='pt')
-                            glosses_ids['span'] = rep_spans
-                        if self.gloss == 'wneg':
-                            glosses = []
-                            rep_spans = []
-                            for sense in senses:
-                                wn_lemma = wn.lemma_from_key(sense)
-                                gloss, rep_span = wn_example(wn_lemma, word['word'], self.tknz, rand=self.random_wneg)
-                                glosses.append(gloss)
-                                rep_spans.append(rep_span)
-                            glosses_ids = self.tknz(glosses, padding=True, return_tensors='pt')
-                            glosses_ids['span'] = rep_spans
-                        yield {'input_ids': input_ids, 'pos': target_range,
-                               'glosses_ids': glosses_ids, 'sense_id': correct_sense_i}
+        for i in sentence_order(self.sent_bounds, self.randomize_sents):
+            yield self[i]
+
+    def sent_token_ids(self, sent_index):
+        word_ids = self.sent_tokens.get(sent_index)
+        if word_ids is None:
+            word_ids = tokenize_words(self.tknz, self.st_sents.sent_words(sent_index))
+            self.sent_tokens[sent_index] = word_ids
+        return word_ids
 
     def __getitem__(self, index):
-        if index < self.instance_index:
-            self.instance_index = 0
-            self.instance_iter = self.item_iter()
-            self.current_instance = next(self.instance_iter)
-        while self.instance_index < index:
-            self.instance_index += 1
-            self.current_instance = next(self.instance_iter)            
-        return self.current_instance
+        (sent_index, i) = self.index[index]
+        word = self.st_sents.token(sent_index, i)
+        s = word['sense']
+        lemma = self.inv.sense_lemma(s)
+        input_ids, target_range = with_target(self.tknz, self.sent_token_ids(sent_index), i)
+        senses = self.inv.get_senses(lemma)
+        correct_sense_i = self.inv.sense_id(s) - self.inv.sense_range(lemma)[0]
+        if self.random_wneg:
+            entry = self.gloss_cache.tokenize(senses, self.gloss, word['word'], rand=True)
+            glosses_ids = dict(entry['encoding'])
+            glosses_ids['span'] = entry['span']
+        else:
+            glosses_ids = self.gloss_cache.glosses(lemma, senses, self.gloss, word['word'])
+        return {'input_ids': input_ids, 'pos': target_range,
+                'glosses_ids': glosses_ids, 'sense_id': correct_sense_i,
+                'zone': list(self.inv.sense_range(lemma))}
 
     def __len__(self):
         return self.num_insts
-                    
 
-class BEMLoader:
+    def sent_index(self, index):
+        return self.index[index][0]
+
+    def instance_lemmas(self):
+        lemmas = set()
+        for (sent_index, i) in self.index:
+            lemmas.add(self.inv.sense_lemma(self.st_sents.token(sent_index, i)['sense']))
+        return sorted(lemmas)
 
-    def __init__(self, bem_ds, batch_size, desired_ids = None):
+    def build_gloss_cache(self):
+        """
+        Fills the gloss cache with the glosses of every instance, so that
+        it can be persisted before training. Returns the number of entries
+        added.
+        
+        """
+        n_added = self.gloss_cache.n_added
+        if not self.random_wneg:
+            for (sent_index, i) in self.index:
+                word = self.st_sents.token(sent_index, i)
+                lemma = self.inv.sense_lemma(word['sense'])
+                self.gloss_cache.glosses(lemma, self.inv.get_senses(lemma), 
+                                         self.gloss, word['word'])
+        return self.gloss_cache.n_added - n_added
+                    
+
+class BEMLoader(Loader):
+    """
+    If group_sents is True, the instances of each sentence are batched
+    together and each batch holds one context per distinct sentence;
+    batch['context_rows'] gives the context row of each instance, so that
+    the context encoder runs once per sentence rather than once per target.
+    
+    """
+    def __init__(self, bem_ds, batch_size, desired_ids = None, shuffle = None,
+                 num_workers = 0, prefetch = 0, seed = None, group_sents = False):
+        if shuffle is None:
+            shuffle = bem_ds.randomize_sents
+        sampler = sentence_sampler(bem_ds) if group_sents else None
+        super().__init__(batch_size, shuffle, num_workers, prefetch, seed, sampler)
         self.ds = bem_ds
-        self.n_insts = len(self.ds)
-        self.batch_size = batch_size
+        self.group_sents = group_sents
         if desired_ids is None:
             self.desired_ids = list(range(len(self.ds)))
         else:
             self.desired_ids = desired_ids            
+        self.n_insts = len(self.desired_ids)
         self.inventory = self.ds.get_inventory()
-        self.tknz = BertTokenizer.from_pretrained('bert-base-uncased')
 
     def get_dataset(self):
         return self.ds
@@ -152,35 +247,109 @@ class BEMLoader:
     def sense(self, sense_id):
         return self.inventory.sense(sense_id)
 
-    def __len__(self):
-        return math.ceil(self.n_insts / self.batch_size)
-
-    def __iter__(self):
-        input_sents_batch = []
+    def collate(self, indices):
+        input_ids_batch = []
         glosses_ids_batch = []
         pos_batch = []
         gold_batch = []
-        for i in self.desired_ids:
-            input_ids = self.ds[i]['input_ids']
-            string_sent = self.tknz.decode(input_ids, skip_special_tokens=True)
-            input_sents_batch.append(string_sent)
-            glosses_ids_batch.append(self.ds[i]['glosses_ids'])
-            pos_batch.append(self.ds[i]['pos'])
-            gold_batch.append(self.ds[i]['sense_id'])
-            if len(input_sents_batch) == self.batch_size:
-                contexts = self.tknz(input_sents_batch, padding=True, return_tensors='pt')
-                yield {'contexts': contexts,
-                       'glosses': glosses_ids_batch,
-                       'span': pos_batch,
-                       'gold': gold_batch}
-                input_sents_batch = []
-                glosses_ids_batch = []
-                pos_batch = []
-                gold_batch = []
-        if len(input_sents_batch) > 0:
-            contexts = self.tknz(input_sents_batch, padding=True, return_tensors='pt')
-            yield {'contexts': contexts,
-                   'glosses': glosses_ids_batch,
-                   'span': pos_batch,
-                   'gold': gold_batch}
+        zone_batch = []
+        context_rows = []
+        sent_rows = dict()
+        for i in indices:
+            inst = self.ds[i]
+            sent_key = self.ds.sent_index(i) if self.group_sents else len(context_rows)
+            if sent_key not in sent_rows:
+                sent_rows[sent_key] = len(input_ids_batch)
+                input_ids_batch.append(inst['input_ids'])
+            context_rows.append(sent_rows[sent_key])
+            glosses_ids_batch.append(inst['glosses_ids'])
+            pos_batch.append(inst['pos'])
+            gold_batch.append(inst['sense_id'])
+            zone_batch.append(inst['zone'])
+        contexts = pad_contexts(input_ids_batch, self.ds.tknz.pad_token_id)
+        return {'contexts': contexts,
+                'context_rows': context_rows,
+                'glosses': glosses_ids_batch,
+                'span': pos_batch,
+                'gold': gold_batch,
+                'zones': zone_batch}
+
+
+def pad_contexts(input_ids_batch, pad_token_id):
+    """
+    Pads the token ids of a batch of contexts into the inputs of a BERT 
+    encoder, with attention masks built from the context lengths.
+    
+    """
+    lengths = torch.tensor([len(input_ids) for input_ids in input_ids_batch])
+    input_ids = pad_sequence(input_ids_batch, batch_first=True, 
+                             padding_value=pad_token_id)
+    attention_mask = (torch.arange(input_ids.shape[1]).unsqueeze(0) 
+                      < lengths.unsqueeze(1)).long()
+    return {'input_ids': input_ids,
+            'token_type_ids': torch.zeros_like(input_ids),
+            'attention_mask': attention_mask}
+
+
+class GlossBank:
+    """
+    The gloss representations of a trained BEMforWSD for the senses of a
+    set of lemmas, kept in memory. The matrix holds one row per distinct
+    gloss, and rows maps each sense id of the inventory to its row (or to
+    -1, for the senses of other lemmas). Since gloss representations do 
+    not depend on the context, they can be computed once and shared by 
+    every instance of a lemma.
+    
+    """
+    GLOSS_MODES = ['defn_cls', 'defn_tgt']
+
+    def __init__(self, matrix, rows):
+        self.matrix = matrix
+        self.rows = rows
+
+    @staticmethod
+    def supports(bem_ds):
+        return bem_ds.gloss in GlossBank.GLOSS_MODES
+
+    @staticmethod
+    def build(net, bem_ds):
+        """
+        Encodes the glosses of the lemmas of bem_ds's instances, each 
+        distinct gloss once (see BEMforWSD.encode_batch_glosses). Only 
+        context-independent gloss modes ('defn_cls', 'defn_tgt') are 
+        supported.
+        
+        """
+        assert(GlossBank.supports(bem_ds))
+        inv = bem_ds.get_inventory()
+        lemmas = bem_ds.instance_lemmas()
+        assert(len(lemmas) > 0)
+        glosses = [bem_ds.gloss_cache.glosses(lemma, inv.get_senses(lemma), bem_ds.gloss)
+                   for lemma in lemmas]
+        with torch.no_grad():
+            (matrix, lemma_rows) = net.encode_batch_glosses(glosses)
+        rows = torch.full((inv.num_senses(),), -1, dtype=torch.long)
+        for (lemma, lemma_row) in zip(lemmas, lemma_rows):
+            (start, stop) = inv.sense_range(lemma)
+            rows[start:stop] = lemma_row
+        return GlossBank(matrix.float(), rows)
+
+    def score(self, target_reps, zones):
+        """
+        Scores each target representation against the bank rows of its
+        zone (a [start, stop) range of sense ids). Returns a matrix with 
+        one row per target, padded with -inf beyond each zone's width.
+        
+        """
+        zones = torch.tensor(zones, dtype=torch.long)
+        starts = zones[:, 0].unsqueeze(1)
+        stops = zones[:, 1].unsqueeze(1)
+        width = (stops - starts).max().item()
+        sense_ids = starts + torch.arange(width).unsqueeze(0)
+        in_zone = sense_ids < stops
+        rows = self.rows[torch.min(sense_ids, stops - 1)]
+        assert((rows >= 0).all()), "zone outside of the gloss bank's lemmas"
+        glosses = self.matrix[rows.to(self.matrix.device)].to(target_reps.device)
+        scores = (glosses * target_reps.unsqueeze(1)).sum(dim=-1)
+        return scores.masked_fill(~in_zone.to(target_reps.device), float('-inf'))
 
@@ -1,33 +1,48 @@
 import torch
 import os
 import torch.nn.functional as F
-from reed_wsd.util import cudaify, predict_abs, predict_simple, ABS
+from reed_wsd.util import cudaify, predict_abs, predict_simple, ABS, apply_zone_mask
 import numpy as np
 from tqdm import tqdm
+from reed_wsd.allwords.blevins import GlossBank
 
 LARGE_NEGATIVE = 0
 file_dir = os.path.dirname(os.path.realpath(__file__))
 
 def apply_zone_masks(outputs, zones):
-    revised = torch.empty(outputs.shape, device=outputs.device)
-    revised = revised.fill_(LARGE_NEGATIVE)
-    for row in range(len(zones)):
-        (start, stop) = zones[row]
-        revised[row][start:stop] = outputs[row][start:stop]
+    revised = apply_zone_mask(outputs, zones, LARGE_NEGATIVE)
     revised = F.normalize(revised, dim=-1, p=1)
     return revised
 
 class AllwordsBEMDecoder:
-    def __call__(self, net, data):
+    """
+    If use_bank is True, the glosses of the data's lemmas are encoded 
+    once per call into an in-memory GlossBank, and each instance is scored
+    against the bank rows of its lemma, rather than running the gloss 
+    encoder over every instance's candidate glosses. Gloss modes that
+    depend on the context (e.g. 'wneg') are still scored per instance.
+    
+    """
+    def __init__(self, use_bank=False):
+        self.use_bank = use_bank
+
+    def __call__(self, net, data, trust_model=None):
         net.eval()
-        val_loader = data.batch_iter()
         with torch.no_grad():
-            for batch in val_loader:
+            bank = None
+            if self.use_bank and GlossBank.supports(data.get_dataset()):
+                bank = GlossBank.build(net, data.get_dataset())
+            for batch in data:
                 contexts = batch['contexts']
                 glosses = batch['glosses']
                 span = batch['span']
                 gold = batch['gold']
-                scores = net(contexts, glosses, span)
+                context_rows = batch.get('context_rows')
+                if bank is None:
+                    scores = net(contexts, glosses, span, context_rows)
+                else:
+                    scores = bank.score(net.encode_contexts(contexts, span, context_rows), 
+                                        batch['zones'])
                 max_scores, preds = scores.max(dim=-1)
                 for element in zip(max_scores,
                                    zip(preds,
@@ -52,7 +67,9 @@ class AllwordsAbstainingEmbeddingDecoder:
                 output, conf = net(cudaify(evidence), zones)
                 ps = F.softmax(output.clamp(min=-25, max=25), dim=-1)
                 abs_i = output.shape[1] - 1 # last class is abstention class
-                preds = ps[:, :-1].argmax(dim=-1)
+                # argmax over the unclamped output, so that padding columns
+                # (-inf) never tie with real candidates clamped to -25
+                preds = net.output_senses(output[:, :-1].argmax(dim=-1), zones)
                 max_weight_class = ps.argmax(dim=-1)
                 is_abs = (max_weight_class == abs_i)
                 for element in zip(preds, response, conf, is_abs):
@@ -75,8 +92,9 @@ class AllwordsSimpleEmbeddingDecoder:
         with torch.no_grad():
             for inst_ids, targets, evidence, response, zones in tqdm(data, total=len(data)):
                 output, conf = net(cudaify(evidence), zones)
-                ps = F.softmax(output.clamp(min=-25, max=25), dim=-1)
-                preds = ps.argmax(dim=-1)
+                # argmax over the unclamped output, so that padding columns
+                # (-inf) never tie with real candidates clamped to -25
+                preds = net.output_senses(output.argmax(dim=-1), zones)
                 if trust_model is not None:
                     trust_score = trust_model.get_score(evidence.cpu().numpy(),
                                                         preds.cpu().numpy())
@@ -98,3 +116,31 @@ class AllwordsSimpleEmbeddingDecoder:
                                'abstained': False}
                     yield pkg
 
+
+def quantization_report(net, decoder, ref_loader, quant_loader, trust_model=None):
+    """
+    Decodes the same instances twice: once from a reference vector store
+    (ref_loader) and once from its quantized copy (quant_loader). Both 
+    loaders must iterate over the instances in the same order.
+    
+    Reports the accuracy under each store, the change in accuracy and the
+    fraction of predictions that agree.
+    
+    """
+    ref_preds = list(decoder(net, ref_loader, trust_model))
+    quant_preds = list(decoder(net, quant_loader, trust_model))
+    assert(len(ref_preds) == len(quant_preds))
+    n_insts = max(len(ref_preds), 1)
+    ref_correct = 0
+    quant_correct = 0
+    agreed = 0
+    for ref, quant in zip(ref_preds, quant_preds):
+        ref_pred = int(ref['pred'])
+        quant_pred = int(quant['pred'])
+        ref_correct += int(ref_pred == ref['gold'])
+        quant_correct += int(quant_pred == quant['gold'])
+        agreed += int(ref_pred == quant_pred)
+    return {'ref_acc': ref_correct / n_insts,
+            'quant_acc': quant_correct / n_insts,
+            'acc_delta': (quant_correct - ref_correct) / n_insts,
+            'agreement': agreed / n_insts}
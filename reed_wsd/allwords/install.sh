@@ -7,8 +7,10 @@ unzip raganato.zip
 rm raganato.zip
 cd ..
 echo 'Compiling XML files into JSON.'
-python3 raganato.py data/WSD_Evaluation_Framework/ data/raganato.json
+python3 raganato.py data/WSD_Evaluation_Framework/ data/raganato.json data/raganato_split
 echo 'Compiling contextualized word vectors.'
 [ ! -d "data/vecs" ] &&  mkdir -p "data/vecs"
-python3 vectorize.py data/raganato.json data/vecs/
+# each worker loads its own copy of BERT, so use a few threaded workers rather than one per core
+num_workers=$(( $(nproc) < 4 ? $(nproc) : 4 ))
+python3 vectorize.py data/raganato.json data/vecs/ --batch_size 32 --num_workers $num_workers
 echo 'Done!'
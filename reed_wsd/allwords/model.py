@@ -1,16 +1,14 @@
+import math
 import torch
 from torch import nn
 import torch.nn.functional as F
-from reed_wsd.util import cudaify, entropy
+from reed_wsd.util import cudaify, entropy, apply_zone_mask, zone_bounds, local_zones
+from reed_wsd.util import length_buckets
 from transformers import BertModel
 from torch.nn.utils.rnn import pad_sequence
 
 def zero_out_probs(input_vec, zones):
-    new_vec = torch.full(input_vec.shape, torch.tensor(float('-inf')), device=input_vec.device)
-    for row in range(len(zones)):
-        start, stop = zones[row]
-        new_vec[row, start: stop] = input_vec[row, start: stop]
-    return new_vec
+    return apply_zone_mask(input_vec, zones, float('-inf'))
 
 def max_prob(input_vec, zones):
     zoned_output = zero_out_probs(input_vec, zones)
@@ -61,29 +59,120 @@ apply_zones_lookup = {'max_prob': max_prob,
                       'entropy': entropy_confidence,
                       'norm': norm_confidence}
 
+class SparseZoneLinear(nn.Module):
+    """
+    An affine layer that only computes the outputs inside each row's zone
+    (plus, if abstain is True, an extra abstention output). The outputs 
+    are compact: column j of row i scores the j-th sense id of its zone, 
+    columns past the end of a (shorter) zone are -inf and the abstention 
+    output is the last column. See candidates for the sense id scored by 
+    each column.
+    
+    The candidate weight rows are gathered with a sparse embedding lookup,
+    so the cost scales with the zone sizes rather than with output_size,
+    and the gradients are sparse (use optim.SparseAdam).
+    
+    """
+    def __init__(self, input_size, output_size, abstain=False):
+        super().__init__()
+        self.input_size = input_size
+        self.output_size = output_size
+        self.abstain = abstain
+        n_rows = output_size + 1 if abstain else output_size
+        bound = 1 / math.sqrt(input_size) # same as nn.Linear
+        self.weight = nn.Parameter(torch.empty(n_rows, input_size).uniform_(-bound, bound))
+        self.bias = nn.Parameter(torch.empty(n_rows, 1).uniform_(-bound, bound))
+
+    def candidates(self, zones, device=None):
+        """
+        Returns the sense id scored by each column of the compact outputs
+        for the given zones (the abstention output is scored as sense id
+        output_size), with -1 past the end of each zone.
+        
+        """
+        starts, stops = zone_bounds(zones, device)
+        width = int((stops - starts).max()) if len(starts) > 0 else 0
+        candidates = starts.unsqueeze(1) + torch.arange(width, device=device).unsqueeze(0)
+        candidates = candidates.masked_fill(candidates >= stops.unsqueeze(1), -1)
+        if self.abstain:
+            abs_ids = torch.full((len(starts), 1), self.output_size, 
+                                 dtype=torch.long, device=device)
+            candidates = torch.cat([candidates, abs_ids], dim=1)
+        return candidates
+
+    def forward(self, input_vec, zones):
+        """
+        Returns the compact logits, of shape [batch, max zone width] (plus
+        one column if abstain is True), and the candidate sense ids of 
+        their columns.
+        
+        """
+        device = input_vec.device
+        candidates = self.candidates(zones, device)
+        valid = candidates >= 0
+        # padding positions re-read the zone start, so no other row is touched
+        rows = torch.where(valid, candidates, candidates[:, :1])
+        weights = F.embedding(rows, self.weight, sparse=True)
+        biases = F.embedding(rows, self.bias, sparse=True).squeeze(2)
+        logits = torch.bmm(weights, input_vec.unsqueeze(2)).squeeze(2) + biases
+        return logits.masked_fill(~valid, float('-inf')), candidates
+
+
 class SingleLayerFFNWithZones(nn.Module):
+    """
+    If sparse is True, the outputs only cover each row's zone (see 
+    SparseZoneLinear), so the gold sense ids must be mapped to output
+    columns with output_columns before computing a loss, and the 
+    predicted columns back to sense ids with output_senses.
+    
+    """
     def __init__(self,
                  input_size,
                  output_size,
-                 zone_applicant='max_prob'):
+                 zone_applicant='max_prob',
+                 sparse=False):
         super().__init__()
         self.input_size = input_size
         self.output_size = output_size
-        self.linear = cudaify(nn.Linear(input_size, output_size))
+        self.sparse = sparse
+        if sparse:
+            self.linear = cudaify(SparseZoneLinear(input_size, output_size))
+        else:
+            self.linear = cudaify(nn.Linear(input_size, output_size))
         self.zone_applicant = apply_zones_lookup[zone_applicant]
         torch.nn.init.xavier_uniform_(self.linear.weight)
         print('confidence:', self.zone_applicant.__name__)
 
     def forward(self, input_vec, zones):
-        nextout = self.linear(input_vec)
+        if self.sparse:
+            nextout, _ = self.linear(input_vec, zones)
+            zones = local_zones(zones, input_vec.device)
+        else:
+            nextout = self.linear(input_vec)
         return self.zone_applicant(nextout, zones)
 
+    def output_columns(self, sense_ids, zones):
+        if not self.sparse:
+            return sense_ids
+        starts, _ = zone_bounds(zones, sense_ids.device)
+        return sense_ids - starts
+
+    def output_senses(self, columns, zones):
+        if not self.sparse:
+            return columns
+        candidates = self.linear.candidates(zones, columns.device)
+        return candidates.gather(1, columns.unsqueeze(1)).squeeze(1)
+
 class AbstainingSingleLayerFFNWithZones(SingleLayerFFNWithZones):
     def __init__(self, input_size,
                  output_size,
-                 zone_applicant='max_non_abs'):
-        super().__init__(input_size, output_size, zone_applicant)
-        self.linear = cudaify(nn.Linear(input_size, output_size + 1))
+                 zone_applicant='max_non_abs',
+                 sparse=False):
+        super().__init__(input_size, output_size, zone_applicant, sparse)
+        if sparse:
+            self.linear = cudaify(SparseZoneLinear(input_size, output_size, abstain=True))
+        else:
+            self.linear = cudaify(nn.Linear(input_size, output_size + 1))
 
 class DropoutClassifier(nn.Module):
 
@@ -105,20 +194,91 @@ class DropoutClassifier(nn.Module):
         nextout = self.linear3(nextout)
         return F.log_softmax(nextout, dim=1)
 
+def dedupe_glosses(glosses):
+    """
+    Collects the distinct glosses of a batch, where glosses holds the 
+    tokenized (padded) glosses of each instance. Returns a list of 
+    (unpadded input ids, representation span) pairs and, for each instance,
+    a long tensor with the index of each of its glosses in that list.
+    
+    Glosses without a 'span' are represented by their [CLS] token, i.e. 
+    the span [0, 1].
+    
+    """
+    index = dict()
+    unique = []
+    rows = []
+    for g in glosses:
+        input_ids = g['input_ids']
+        spans = g.get('span', [[0, 1]] * len(input_ids))
+        inst_rows = []
+        for ids, mask, span in zip(input_ids, g['attention_mask'], spans):
+            ids = ids[torch.as_tensor(mask).bool()]
+            key = (tuple(ids.tolist()), tuple(span))
+            if key not in index:
+                index[key] = len(unique)
+                unique.append((ids, list(span)))
+            inst_rows.append(index[key])
+        rows.append(torch.tensor(inst_rows, dtype=torch.long))
+    return unique, rows
+
+
 class BEMforWSD(nn.Module):
     """
     This is the Bi-encoder Model proposed by Blevins et al.
     in this paper: https://github.com/facebookresearch/wsd-biencoders
     """
-    def __init__(self, gpu=False):
+    def __init__(self, gpu=False, gloss_chunk_size=256):
         super(BEMforWSD, self).__init__()
         self.gpu = gpu
+        self.gloss_chunk_size = gloss_chunk_size
         self.context_encoder = BertModel.from_pretrained('bert-base-uncased')
         self.gloss_encoder = BertModel.from_pretrained('bert-base-uncased')
         self.output_size = None
 
-    def forward(self, contexts, glosses, pos):
+    def forward(self, contexts, glosses, pos, context_rows=None):
         scores = []
+        target_rep = self.encode_contexts(contexts, pos, context_rows)
+        gloss_reps, rows = self.encode_batch_glosses(glosses)
+        for i, inst_rows in enumerate(rows):
+            score = target_rep[i] * gloss_reps[inst_rows.to(gloss_reps.device)]
+            score = score.sum(dim=1)
+            scores.append(score)
+        result = pad_sequence(scores, batch_first=True)
+        return result
+
+    def encode_batch_glosses(self, glosses):
+        """
+        Encodes each distinct gloss of a batch once, in length-bucketed
+        chunks of at most self.gloss_chunk_size glosses. Returns the gloss
+        representations and, for each instance, the rows of its glosses.
+        
+        """
+        (unique, rows) = dedupe_glosses(glosses)
+        lengths = [len(input_ids) for (input_ids, _) in unique]
+        order = []
+        chunk_reps = []
+        for chunk in length_buckets(lengths, self.gloss_chunk_size):
+            input_ids = pad_sequence([unique[j][0] for j in chunk], batch_first=True)
+            attention_mask = pad_sequence([torch.ones(lengths[j], dtype=torch.long) 
+                                           for j in chunk], batch_first=True)
+            chunk_reps.append(self.encode_glosses({'input_ids': input_ids,
+                                                   'attention_mask': attention_mask,
+                                                   'span': [unique[j][1] for j in chunk]}))
+            order += chunk
+        gloss_reps = torch.cat(chunk_reps)
+        inverse = torch.empty(len(order), dtype=torch.long)
+        inverse[torch.tensor(order)] = torch.arange(len(order))
+        return gloss_reps[inverse.to(gloss_reps.device)], rows
+
+    def encode_contexts(self, contexts, pos, context_rows=None):
+        """
+        Returns the representations of the targets (whose token spans are
+        given by pos) in the tokenized contexts. If context_rows is given,
+        target i is found in context context_rows[i], so that several targets
+        can share one encoded sentence; otherwise target i is in context i.
+        
+        """
         context_inputs = contexts['input_ids']
         if self.gpu:
             context_inputs = cudaify(context_inputs)
@@ -127,35 +287,51 @@ class BEMforWSD(nn.Module):
             context_masks = cudaify(context_masks)
         context_rep = self.context_encoder(input_ids=context_inputs,
                                            attention_mask=context_masks)[0] # last hidden state
-        target_rep = self.target_representation(context_rep, pos)
-        for i, g in enumerate(glosses):
-            input_ids = g['input_ids']
-            if self.gpu:
-                input_ids = cudaify(input_ids)
-            attention_mask = g['attention_mask']
-            if self.gpu:
-                attention_mask = cudaify(attention_mask)
-            last_layer = self.gloss_encoder(input_ids=input_ids,
-                                            attention_mask=attention_mask)[0]
-            if 'span' not in g:
-                gloss_reps = last_layer[:, 0, :] # the vector that corresponds to CLS
-            else:
-                span = g['span']
-                gloss_reps = self.target_representation(last_layer, span)
-            score = target_rep[i] * gloss_reps
-            score = score.sum(dim=1)
-            scores.append(score)
-        result = pad_sequence(scores, batch_first=True)
-        return result
+        return self.target_representation(context_rep, pos, context_rows)
+
+    def encode_glosses(self, g):
+        """
+        Returns the representations of the tokenized glosses of one target's
+        candidate senses.
+        
+        """
+        input_ids = g['input_ids']
+        if self.gpu:
+            input_ids = cudaify(input_ids)
+        attention_mask = g['attention_mask']
+        if self.gpu:
+            attention_mask = cudaify(attention_mask)
+        last_layer = self.gloss_encoder(input_ids=input_ids,
+                                        attention_mask=attention_mask)[0]
+        if 'span' not in g:
+            return last_layer[:, 0, :] # the vector that corresponds to CLS
+        return self.target_representation(last_layer, g['span'])
 
     @staticmethod
-    def target_representation(context_rep, pos):
-        result = context_rep.clone()
-        idx = torch.ones(context_rep.shape).bool()
-        for i, p in enumerate(pos):
-            idx[i, p[0]:p[1], :] = 0
-        result[idx] = 0
-        result = result.sum(dim=1)
-        for i, p in enumerate(pos):
-            result[i] /= (p[1] - p[0])
-        return result
+    def target_representation(context_rep, pos, rows=None):
+        """
+        Averages the vectors of each [start, stop) token span of pos. If
+        rows is given, span i is pooled from sequence rows[i] of context_rep
+        (so a sequence can hold many spans); otherwise from sequence i.
+
+        With rows, the spans are pooled with one [sequences, spans, tokens]
+        mask (zero outside each span's own sequence), so the hidden states
+        are never copied per span.
+        
+        """
+        device = context_rep.device
+        pos = torch.as_tensor(pos, dtype=torch.long, device=device)
+        starts = pos[:, 0].unsqueeze(1)
+        stops = pos[:, 1].unsqueeze(1)
+        positions = torch.arange(context_rep.shape[1], device=device).unsqueeze(0)
+        span_mask = ((positions >= starts) & (positions < stops)).to(context_rep.dtype)
+        if rows is None:
+            result = torch.bmm(span_mask.unsqueeze(1), context_rep).squeeze(1)
+        else:
+            rows = torch.as_tensor(rows, dtype=torch.long, device=device)
+            seqs = torch.arange(context_rep.shape[0], device=device).unsqueeze(1)
+            in_seq = (seqs == rows.unsqueeze(0)).to(context_rep.dtype)
+            seq_mask = in_seq.unsqueeze(2) * span_mask.unsqueeze(0)
+            pooled = torch.bmm(seq_mask, context_rep)
+            result = pooled[rows, torch.arange(len(rows), device=device)]
+        return result / (stops - starts).to(context_rep.dtype)
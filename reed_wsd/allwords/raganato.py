@@ -3,15 +3,30 @@ Conversion tools from Raganato XML to a simpler JSON format.
 
 Example usage:
 
-python raganato.py datadir raganato.json
+python raganato.py datadir raganato.json [splitdir]
+
+The XML files are parsed incrementally (one <sentence> at a time), so memory
+use does not grow with the size of the corpus. Each corpus is converted in
+its own process and written to a JSON-lines fragment; the fragments are then
+streamed into the final JSON file.
+
+If splitdir is given, the converter also writes a split format that can be
+read one corpus at a time (see SenseTaggedSentences.from_split):
+    - inventory.json: the sense inventory
+    - corpora.json: maps each corpus id to its files and counts
+    - corpusK.jsonl: the sentences of corpus K, one JSON object per line
 
 """
 
-from xml.dom import minidom
+import xml.etree.ElementTree as ET
 import json
+import os
+import shutil
+import tempfile
 from os.path import join
 import sys
 from collections import defaultdict
+from multiprocessing import Pool
 
 def create_sense_inventory(goldfiles):
     inventory = defaultdict(dict)
@@ -49,51 +64,53 @@ def parse_raganato_gold(goldfile, inventory):
 
 def parse_raganato_xml_sent(sent_node, sense_map):
     tokens = []
-    for node in sent_node.childNodes:
-        if node.nodeName == "wf":
-            word = node.childNodes[0].nodeValue
-            lemma = node.getAttribute('lemma')
-            tag = node.getAttribute('pos')
+    for node in sent_node:
+        if node.tag == "wf":
+            word = node.text
+            lemma = node.get('lemma')
+            tag = node.get('pos')
             sense = None
             tokens.append(Token(word,tag,None,lemma,sense).to_dict())
-        elif node.nodeName == "instance":
-            word = node.childNodes[0].nodeValue
-            lemma = node.getAttribute('lemma')
-            tag = node.getAttribute('pos')
-            sent_id = node.getAttribute('id')
+        elif node.tag == "instance":
+            word = node.text
+            lemma = node.get('lemma')
+            tag = node.get('pos')
+            sent_id = node.get('id')
             sense = sense_map[sent_id]
             tokens.append(Token(word,tag,sent_id,lemma,sense).to_dict())
-        elif node.nodeName == "#text" and node.nodeValue == '\n':
-            pass
         else:
-            print('Warning: element {} not recognized!'.format(node.nodeName))
-    result = {'sentid': sent_node.getAttribute('id'), 'words': tokens}
+            print('Warning: element {} not recognized!'.format(node.tag))
+    result = {'sentid': sent_node.get('id'), 'words': tokens}
     return result           
 
 
-def parse_raganato_xml(xmldoc, sense_map):
-    corpora = xmldoc.getElementsByTagName('corpus')
-    output_sents = []
-    n_insts = 0
-    for corpus in corpora:
-        for node in corpus.childNodes:
-            if node.nodeName == "text":
-                for sent_node in node.childNodes:
-                    if sent_node.nodeName == "sentence":
-                        sent = parse_raganato_xml_sent(sent_node, sense_map) 
-                        for w in sent['words']:
-                            if 'sense' in w.keys(): n_insts += 1
-                        sent['sentid'] = len(output_sents)
-                        output_sents.append(sent)
-                    elif sent_node.nodeName == "#text" and sent_node.nodeValue == '\n':
-                        pass
-                    else:
-                        print('Warning: element {} not recognized!'.format(sent_node.nodeName))
-            elif node.nodeName == "#text" and node.nodeValue == '\n':
-                pass
-            else:
-                print('Warning: element {} not recognized!'.format(node.nodeName))
-    return output_sents, n_insts
+def iter_raganato_xml(xml_file, sense_map):
+    """
+    Iterates through the sentences of a Raganato XML file, without building
+    the whole document tree. Each <sentence> element is discarded once it
+    has been converted.
+    
+    """
+    ancestors = []
+    sent_index = 0
+    for event, node in ET.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            ancestors.append(node)
+            continue
+        ancestors.pop()
+        if node.tag == "sentence":
+            sent = parse_raganato_xml_sent(node, sense_map)
+            sent['sentid'] = sent_index
+            sent_index += 1
+            if len(ancestors) > 0:
+                ancestors[-1].remove(node)
+            yield sent
+        elif node.tag not in ["wf", "instance", "text", "corpus"]:
+            print('Warning: element {} not recognized!'.format(node.tag))
+
+
+def count_instances(sent):
+    return len([w for w in sent['words'] if 'sense' in w])
 
 
 class Token:
@@ -116,12 +133,36 @@ class Token:
 
 
 def harvest_data(xml_file, gold_file, inventory):
-    xmldoc = minidom.parse(xml_file)    
     sense_map = parse_raganato_gold(gold_file, inventory)
-    output_sents, n_insts = parse_raganato_xml(xmldoc, sense_map)
+    output_sents = []
+    n_insts = 0
+    for sent in iter_raganato_xml(xml_file, sense_map):
+        n_insts += count_instances(sent)
+        output_sents.append(sent)
     return output_sents, n_insts
 
 
+def write_corpus_fragment(xml_file, gold_file, fragment_file):
+    """
+    Converts a single corpus into a JSON-lines file (one sentence per line).
+    Returns the number of sentences and of sense-annotated instances.
+    
+    """
+    sense_map = parse_raganato_gold(gold_file, None)
+    n_sents = 0
+    n_insts = 0
+    with open(fragment_file, 'wb') as writer:
+        for sent in iter_raganato_xml(xml_file, sense_map):
+            n_sents += 1
+            n_insts += count_instances(sent)
+            writer.write((json.dumps(sent) + '\n').encode('utf-8'))
+    return n_sents, n_insts
+
+
+def _write_corpus_fragment(args):
+    return write_corpus_fragment(*args)
+
+
 def harvest_multi(xml_files, gold_files):
     inventory = create_sense_inventory(gold_files)
     corpora = dict()
@@ -132,17 +173,83 @@ def harvest_multi(xml_files, gold_files):
     return result
 
  
-def run(xml_files, gold_files, json_output):
+def write_streamed_json(inventory, xml_files, fragment_files, n_insts, json_output):
+    """
+    Writes the same JSON structure as harvest_multi, copying each sentence
+    line by line from the corpus fragments.
+    
+    """
+    with open(json_output, 'w') as writer:
+        writer.write('{"inventory": ')
+        writer.write(json.dumps(inventory))
+        writer.write(', "corpora": {')
+        for i, (xml_file, fragment_file) in enumerate(zip(xml_files, fragment_files)):
+            if i > 0:
+                writer.write(', ')
+            writer.write(json.dumps(xml_file))
+            writer.write(': {"sents": [')
+            with open(fragment_file) as reader:
+                for j, line in enumerate(reader):
+                    if j > 0:
+                        writer.write(',\n')
+                    writer.write(line.rstrip('\n'))
+            writer.write('], "n_insts": {}}}'.format(n_insts[i]))
+        writer.write('}}\n')
+
+
+def write_split(inventory, xml_files, fragment_files, n_sents, n_insts, split_dir):
+    """
+    Moves the corpus fragments into split_dir, and writes the inventory
+    and the corpus index next to them.
+    
+    """
+    if not os.path.exists(split_dir):
+        os.makedirs(split_dir)
+    corpora = dict()
+    for xml_file, fragment_file, corpus_sents, corpus_insts in zip(xml_files, fragment_files,
+                                                                   n_sents, n_insts):
+        sents_file = os.path.basename(fragment_file)
+        shutil.move(fragment_file, join(split_dir, sents_file))
+        corpora[xml_file] = {'sents': sents_file, 
+                             'n_sents': corpus_sents, 'n_insts': corpus_insts}
+    if os.path.exists(join(split_dir, 'inventory.pt')):
+        # compiled from the previous inventory.json
+        os.remove(join(split_dir, 'inventory.pt'))
+    with open(join(split_dir, 'inventory.json'), 'w') as writer:
+        json.dump(inventory, writer)
+    with open(join(split_dir, 'corpora.json'), 'w') as writer:
+        json.dump(corpora, writer, indent=4)
+
+
+def run(xml_files, gold_files, json_output, num_workers=None, split_dir=None):
     """
     e.g. run(['Training_Corpora/SemCor/semcor.data.xml'],
              ['Training_Corpora/SemCor/semcor.gold.key.txt'],
              'semcor.json')
 
     """
-    result = harvest_multi(xml_files, gold_files)
-    with open(json_output, 'w') as writer:
-        writer.write(json.dumps(result, indent=4))
-    
+    inventory = create_sense_inventory(gold_files)
+    if num_workers is None:
+        num_workers = len(xml_files)
+    fragment_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(json_output)))
+    try:
+        fragment_files = [join(fragment_dir, 'corpus{}.jsonl'.format(i)) 
+                          for i in range(len(xml_files))]
+        jobs = list(zip(xml_files, gold_files, fragment_files))
+        if num_workers > 1:
+            with Pool(min(num_workers, len(jobs))) as pool:
+                counts = pool.map(_write_corpus_fragment, jobs)
+        else:
+            counts = [_write_corpus_fragment(job) for job in jobs]
+        n_sents = [corpus_sents for (corpus_sents, _) in counts]
+        n_insts = [corpus_insts for (_, corpus_insts) in counts]
+        write_streamed_json(inventory, xml_files, fragment_files, n_insts, json_output)
+        if split_dir is not None:
+            write_split(inventory, xml_files, fragment_files, n_sents, n_insts, split_dir)
+    finally:
+        shutil.rmtree(fragment_dir)
+
+
     
 if __name__ == '__main__':    
     root_data_dir = sys.argv[1]
@@ -152,5 +259,6 @@ if __name__ == '__main__':
                  join(eval_dir, 'semeval2007/semeval2007.data.xml')]
     gold_files = [join(train_dir, 'SemCor/semcor.gold.key.txt'),
                   join(eval_dir, 'semeval2007/semeval2007.gold.key.txt')]
-    run(xml_files, gold_files, sys.argv[2])
+    split_dir = sys.argv[3] if len(sys.argv) > 3 else None
+    run(xml_files, gold_files, sys.argv[2], split_dir=split_dir)
     
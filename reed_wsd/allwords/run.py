@@ -7,7 +7,7 @@ from reed_wsd.allwords.model import SimpleFFN, SimpleAbstainingFFN
 from reed_wsd.util import cudaify, Logger
 from reed_wsd.allwords.evaluate import AllwordsEmbeddingDecoder
 from reed_wsd.allwords.wordsense import SenseTaggedSentences, SenseInstanceDataset, SenseInstanceLoader, TwinSenseInstanceLoader
-from reed_wsd.allwords.vectorize import DiskBasedVectorManager
+from reed_wsd.allwords.vectorize import open_vector_manager
 from reed_wsd.loss import NLLLoss, ConfidenceLoss1, ConfidenceLoss4, PairwiseConfidenceLoss
 from reed_wsd.allwords.train import SingleEmbeddingTrainer, PairwiseEmbeddingTrainer
 from reed_wsd.plot import PYCurve, plot_curves
@@ -27,12 +27,11 @@ def init_dataset(data_dir, stage, style, sense_sz=-1, gloss=None):
     elif stage == "train":
         corpus_id = 'data/WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.data.xml'
 
-    filename = join(data_dir, 'raganato.json')
-    sents = SenseTaggedSentences.from_json(filename, corpus_id) 
+    sents = SenseTaggedSentences.from_data_dir(data_dir, corpus_id) 
     if style == "bem":
         ds = BEMDataset(sents, sense_sz=sense_sz, gloss=gloss)
     if style == 'fnn':
-        vecmgr = DiskBasedVectorManager(join(join(data_dir, 'vecs'), corpus_id))
+        vecmgr = open_vector_manager(join(join(data_dir, 'vecs'), corpus_id))
         ds = SenseInstanceDataset(sents, vecmgr)
     return ds
 
@@ -1,7 +1,19 @@
 import torch
 from reed_wsd.train import Trainer
 from tqdm import tqdm
-from reed_wsd.util import cudaify
+from reed_wsd.util import cudaify, log
+from reed_wsd.allwords.vectorize import CachedVectorManager
+
+def log_vector_cache(loader):
+    vec_manager = getattr(loader.get_instance_dataset(), 'vec_manager', None)
+    if isinstance(vec_manager, CachedVectorManager):
+        log(str(vec_manager))
+        vec_manager.reset_stats()
+
+def log_data_wait(loader):
+    wait_time = getattr(loader, 'wait_time', None)
+    if wait_time is not None:
+        log('time spent waiting for data: {:.2f}s'.format(wait_time))
 
 class SingleEmbeddingTrainer(Trainer):
     def _epoch_step(self, model):
@@ -11,11 +23,14 @@ class SingleEmbeddingTrainer(Trainer):
         for (_, _, evidence, response, zones) in tqdm(self.train_loader, total=len(self.train_loader)):
             self.optimizer.zero_grad()
             outputs, conf = model(cudaify(evidence), zones)
-            loss_size = self.criterion(outputs, conf, cudaify(response))
+            gold = model.output_columns(cudaify(response), zones)
+            loss_size = self.criterion(outputs, conf, gold)
             loss_size.backward()
             self.optimizer.step()
             running_loss += loss_size.data.item()
             denom += 1
+        log_vector_cache(self.train_loader)
+        log_data_wait(self.train_loader)
         return running_loss / denom
 
 class PairwiseEmbeddingTrainer(Trainer):
@@ -31,11 +46,15 @@ class PairwiseEmbeddingTrainer(Trainer):
             self.optimizer.zero_grad()
             outputs1, conf1 = model(cudaify(evidence1), zones1)
             outputs2, conf2 = model(cudaify(evidence2), zones2)
-            loss_size = self.criterion(outputs1, outputs2, cudaify(response1), cudaify(response2), conf1, conf2)
+            gold1 = model.output_columns(cudaify(response1), zones1)
+            gold2 = model.output_columns(cudaify(response2), zones2)
+            loss_size = self.criterion(outputs1, outputs2, gold1, gold2, conf1, conf2)
             loss_size.backward()
             self.optimizer.step()
             running_loss += loss_size.data.item()
             denom += 1
+        log_vector_cache(self.train_loader)
+        log_data_wait(self.train_loader)
         return running_loss / denom
 
 class BEMTrainer(Trainer):
@@ -48,7 +67,7 @@ class BEMTrainer(Trainer):
             glosses = batch['glosses']
             span = batch['span']
             gold = batch['gold']
-            scores = model(contexts, glosses, span)
+            scores = model(contexts, glosses, span, batch.get('context_rows'))
             loss_size = self.criterion(scores, cudaify(torch.tensor(gold)))
             loss_size.backward()
             self.optimizer.step()
@@ -2,12 +2,67 @@ import os, sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from os.path import join
 import json
+import argparse
+import time
+import shutil
+import multiprocessing
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
 import reed_wsd.allwords.bert as bert
+import reed_wsd.allwords.align as align
+from reed_wsd.util import length_buckets
 
 class VectorManager:
     def get_vector(self, sent_id):
         raise NotImplementedError('Cannot call .get_vector on abstract class.')
 
+    def get_record(self, sent_id):
+        """
+        Returns the stored record of a sentence (with at least its 'tokens'
+        and, if stored, its 'positions' and 'spans'), or None, so that a
+        caller needing several of these fields reads the record only once.
+        The record may or may not include the 'vecs'.
+        
+        """
+        return self.get_vector(sent_id)
+
+    def get_tokens(self, sent_id):
+        vecs = self.get_vector(sent_id)
+        return None if vecs is None else vecs['tokens']
+
+    def get_positions(self, sent_id):
+        """
+        For a target-only store, returns the sentence word positions that 
+        have a (pooled) vector; returns None for a store of token vectors.
+        
+        """
+        vecs = self.get_vector(sent_id)
+        return None if vecs is None else vecs.get('positions')
+
+    def get_spans(self, sent_id):
+        """
+        Returns the [start, stop) token span of each word of the sentence,
+        as computed by the tokenizer during vectorization (None for a word
+        without tokens), or None if no spans were stored.
+        
+        """
+        vecs = self.get_vector(sent_id)
+        return None if vecs is None else vecs.get('spans')
+
+    def fingerprint(self):
+        """
+        Returns a JSON-serializable summary of the stored vectors that
+        changes whenever they are rewritten (None if unknown), so that
+        data derived from them can be checked for staleness.
+        
+        """
+        return None
+
+    def close(self):
+        pass
+
 class RamBasedVectorManager(VectorManager):
     def __init__(self, vec_map):
         super().__init__()
@@ -15,6 +70,15 @@ class RamBasedVectorManager(VectorManager):
         
     def get_vector(self, sent_id):
         return self.vec_map[sent_id]
+
+    def write(self, sent_id, toks, vectors, positions=None, spans=None):
+        self.vec_map[sent_id] = {'sentid': sent_id,
+                                 'tokens': toks,
+                                 'vecs': vectors}
+        if positions is not None:
+            self.vec_map[sent_id]['positions'] = positions
+        if spans is not None:
+            self.vec_map[sent_id]['spans'] = spans
          
 
 class DiskBasedVectorManager(VectorManager):
@@ -40,38 +104,796 @@ class DiskBasedVectorManager(VectorManager):
                 data = json.load(reader)
             return data
     
-    def write(self, sent_id, toks, vectors):
+    def write(self, sent_id, toks, vectors, positions=None, spans=None):
+        if hasattr(vectors, 'tolist'):
+            vectors = vectors.tolist()
         with open(self.get_filename(sent_id), 'w') as writer:
             output = {'sentid': sent_id,
                       'tokens': toks,
                       'vecs': vectors}
+            if positions is not None:
+                output['positions'] = positions
+            if spans is not None:
+                output['spans'] = spans
             json.dump(output, writer)
 
+    def fingerprint(self):
+        n_files = 0
+        last_mtime = 0
+        for subdir in os.listdir(self.root_dir):
+            if subdir.startswith('batch'):
+                for entry in os.scandir(join(self.root_dir, subdir)):
+                    n_files += 1
+                    last_mtime = max(last_mtime, entry.stat().st_mtime_ns)
+        return {'root_dir': os.path.abspath(self.root_dir),
+                'store': 'json',
+                'n_files': n_files,
+                'last_mtime': last_mtime}
+
+    def sent_ids(self):
+        result = []
+        for subdir in os.listdir(self.root_dir):
+            if subdir.startswith('batch'):
+                for filename in os.listdir(join(self.root_dir, subdir)):
+                    if filename.startswith('sent') and filename.endswith('.json'):
+                        result.append(int(filename[4:-5]))
+        return sorted(result)
+
+
+class MemmapVectorManager(VectorManager):
+    """
+    A MemmapVectorManager stores the token vectors of every sentence of a
+    corpus in a single contiguous matrix file (vectors.bin), plus a small
+    index (index.json) recording, for each sentence id, the row offset,
+    the number of rows and the BERT tokens (and, if available, the token
+    span of each word, or for a target-only store, the word positions of 
+    the rows).
+
+    Vectors are read through numpy.memmap, so the 'vecs' field returned by
+    get_vector is a view onto the file rather than a parsed copy.
+
+    The matrix is stored with one of the following encodings (dtype):
+        - 'float32'
+        - 'float16'
+        - 'int8': each vector is divided by a per-vector scale (its largest
+          absolute value / 127) and rounded; the scales are stored in 
+          scales.bin, and get_vector returns dequantized float32 copies
+    
+    """
+    VECTOR_FILE = 'vectors.bin'
+    INDEX_FILE = 'index.json'
+    SCALE_FILE = 'scales.bin'
+    
+    def __init__(self, root_dir, dtype='float32'):
+        super().__init__()
+        self.root_dir = root_dir
+        self.dtype = dtype
+        self.dim = None
+        self.n_rows = 0
+        self.index = dict()
+        self.matrix = None
+        self.scales = None
+        self.writer = None
+        self.scale_writer = None
+        if os.path.exists(join(root_dir, MemmapVectorManager.INDEX_FILE)):
+            self._load_index()
+
+    @staticmethod
+    def exists(root_dir):
+        return os.path.exists(join(root_dir, MemmapVectorManager.INDEX_FILE))
+
+    def _load_index(self):
+        with open(join(self.root_dir, MemmapVectorManager.INDEX_FILE)) as reader:
+            data = json.load(reader)
+        self.dtype = data['dtype']
+        self.dim = data['dim']
+        self.n_rows = data['n_rows']
+        self.index = {int(sent_id): data['sents'][sent_id] 
+                      for sent_id in data['sents']}
+
+    def _get_matrix(self):
+        if self.matrix is None:
+            if self.n_rows == 0:
+                # numpy cannot map an empty file
+                self.matrix = np.zeros((0, self.dim or 0), dtype=self.dtype)
+            else:
+                # copy-on-write mode, so that torch can wrap slices without copying
+                self.matrix = np.memmap(join(self.root_dir, MemmapVectorManager.VECTOR_FILE),
+                                        dtype=self.dtype, mode='c',
+                                        shape=(self.n_rows, self.dim))
+        return self.matrix
+
+    def _get_scales(self):
+        if self.scales is None:
+            if self.n_rows == 0:
+                self.scales = np.zeros((0,), dtype='float32')
+            else:
+                self.scales = np.memmap(join(self.root_dir, MemmapVectorManager.SCALE_FILE),
+                                        dtype='float32', mode='r', shape=(self.n_rows,))
+        return self.scales
+
+    def sent_ids(self):
+        return sorted(self.index)
+
+    def fingerprint(self):
+        stat = os.stat(join(self.root_dir, MemmapVectorManager.INDEX_FILE))
+        return {'root_dir': os.path.abspath(self.root_dir),
+                'store': 'memmap',
+                'dtype': self.dtype,
+                'index_size': stat.st_size,
+                'index_mtime': stat.st_mtime_ns}
+
+    def get_record(self, sent_id):
+        return self.index.get(sent_id)
+
+    def get_tokens(self, sent_id):
+        if sent_id not in self.index:
+            return None
+        return self.index[sent_id]['tokens']
+
+    def get_positions(self, sent_id):
+        if sent_id not in self.index:
+            return None
+        return self.index[sent_id].get('positions')
+
+    def get_spans(self, sent_id):
+        if sent_id not in self.index:
+            return None
+        return self.index[sent_id].get('spans')
+
+    def get_vector(self, sent_id):
+        if sent_id not in self.index:
+            return None
+        entry = self.index[sent_id]
+        offset = entry['offset']
+        vecs = self._get_matrix()[offset:offset + entry['length']]
+        if self.dtype == 'int8':
+            scales = self._get_scales()[offset:offset + entry['length']]
+            vecs = vecs.astype('float32') * scales[:, np.newaxis]
+        result = {'sentid': sent_id,
+                  'tokens': entry['tokens'],
+                  'vecs': vecs}
+        for key in ['positions', 'spans']:
+            if key in entry:
+                result[key] = entry[key]
+        return result
+
+    def write(self, sent_id, toks, vectors, positions=None, spans=None):
+        if hasattr(vectors, 'cpu'):
+            vectors = vectors.detach().cpu().numpy()
+        if self.dtype == 'int8':
+            vectors, scales = quantize_int8(vectors)
+        else:
+            vectors = np.asarray(vectors, dtype=self.dtype)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        assert vectors.shape[1] == self.dim, "vector dimension mismatch"
+        if self.writer is None:
+            if not os.path.exists(self.root_dir):
+                os.makedirs(self.root_dir)
+            self.writer = self._open_for_append(MemmapVectorManager.VECTOR_FILE,
+                                                self.dim * np.dtype(self.dtype).itemsize)
+            if self.dtype == 'int8':
+                self.scale_writer = self._open_for_append(MemmapVectorManager.SCALE_FILE, 4)
+        self.writer.write(vectors.tobytes())
+        if self.dtype == 'int8':
+            self.scale_writer.write(scales.tobytes())
+        self.index[sent_id] = {'offset': self.n_rows, 
+                               'length': vectors.shape[0],
+                               'tokens': toks}
+        if positions is not None:
+            self.index[sent_id]['positions'] = positions
+        if spans is not None:
+            self.index[sent_id]['spans'] = spans
+        self.n_rows += vectors.shape[0]
+        self.matrix = None
+        self.scales = None
+
+    def _open_for_append(self, filename, row_bytes):
+        """
+        Opens one of the store's binary files for writing after the rows 
+        already in the index. A fresh index truncates the file, discarding
+        leftovers that no index refers to.
+        
+        """
+        filename = join(self.root_dir, filename)
+        if self.n_rows == 0:
+            return open(filename, 'wb')
+        assert os.path.getsize(filename) == self.n_rows * row_bytes, \
+            "{} does not match the {} rows of the index".format(filename, self.n_rows)
+        return open(filename, 'ab')
+
+    @staticmethod
+    def remove(root_dir):
+        """
+        Deletes the store in root_dir (if any), so that it can be rewritten.
+        
+        """
+        for filename in [MemmapVectorManager.VECTOR_FILE, MemmapVectorManager.INDEX_FILE,
+                         MemmapVectorManager.SCALE_FILE]:
+            if os.path.exists(join(root_dir, filename)):
+                os.remove(join(root_dir, filename))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.scale_writer is not None:
+                self.scale_writer.close()
+                self.scale_writer = None
+            output = {'dtype': self.dtype,
+                      'dim': self.dim,
+                      'n_rows': self.n_rows,
+                      'sents': self.index}
+            with open(join(self.root_dir, MemmapVectorManager.INDEX_FILE), 'w') as writer:
+                json.dump(output, writer)
+
+    def __getstate__(self):
+        # worker processes reopen the memmap rather than pickling its contents
+        assert self.writer is None, "cannot pickle a MemmapVectorManager during writing"
+        state = self.__dict__.copy()
+        state['matrix'] = None
+        state['scales'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def quantize_int8(vectors):
+    """
+    Quantizes each row of vectors to int8, using a per-row scale of
+    (largest absolute value / 127). Returns the int8 matrix and the 
+    float32 scales.
+    
+    """
+    vectors = np.asarray(vectors, dtype='float32')
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.rint(vectors / scales[:, np.newaxis]).astype('int8')
+    return quantized, scales.astype('float32')
+
+def reconstruction_error(ref_manager, other_manager, sent_ids):
+    """
+    Compares the vectors of two stores (e.g. a float32 store and its 
+    quantized copy) over the given sentences. Reports the mean and max 
+    absolute elementwise error, the mean relative L2 error of a vector
+    and the mean cosine similarity of corresponding vectors.
+    
+    """
+    abs_error = 0.0
+    max_error = 0.0
+    rel_error = 0.0
+    cosine = 0.0
+    n_elements = 0
+    n_vectors = 0
+    for sent_id in sent_ids:
+        ref = np.asarray(ref_manager.get_vector(sent_id)['vecs'], dtype='float64')
+        other = np.asarray(other_manager.get_vector(sent_id)['vecs'], dtype='float64')
+        diff = np.abs(ref - other)
+        abs_error += diff.sum()
+        max_error = max(max_error, diff.max())
+        ref_norms = np.maximum(np.linalg.norm(ref, axis=1), 1e-12)
+        other_norms = np.maximum(np.linalg.norm(other, axis=1), 1e-12)
+        rel_error += (np.linalg.norm(ref - other, axis=1) / ref_norms).sum()
+        cosine += ((ref * other).sum(axis=1) / (ref_norms * other_norms)).sum()
+        n_elements += diff.size
+        n_vectors += ref.shape[0]
+    return {'mean_abs_error': abs_error / max(n_elements, 1),
+            'max_abs_error': max_error,
+            'mean_rel_error': rel_error / max(n_vectors, 1),
+            'mean_cosine': cosine / max(n_vectors, 1)}
+
+
+class CachedVectorManager(VectorManager):
+    """
+    Wraps another VectorManager with a least-recently-used cache of 
+    sentence vectors, holding at most max_bytes bytes of vectors in RAM.
+    Cache hits, misses and evictions are counted for logging.
+
+    The cache is guarded by a lock, so it can be shared with the loader's
+    prefetch thread. Worker processes each get their own copy; their
+    counts are sent back with take_stats and merge_stats (n_sents and 
+    n_bytes only describe the cache of the current process).
+    
+    """
+    def __init__(self, vec_manager, max_bytes):
+        super().__init__()
+        self.vec_manager = vec_manager
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_vector(self, sent_id):
+        with self.lock:
+            if sent_id in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(sent_id)
+                return self.cache[sent_id]
+            self.misses += 1
+        data = self.vec_manager.get_vector(sent_id)
+        if data is None:
+            return None
+        data = dict(data)
+        vecs = data['vecs']
+        data['vecs'] = np.array(vecs, dtype=getattr(vecs, 'dtype', 'float32'))
+        size = data['vecs'].nbytes
+        with self.lock:
+            if size <= self.max_bytes and sent_id not in self.cache:
+                while self.n_bytes + size > self.max_bytes:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.n_bytes -= evicted['vecs'].nbytes
+                    self.evictions += 1
+                self.cache[sent_id] = data
+                self.n_bytes += size
+        return data
+
+    def get_record(self, sent_id):
+        return self.vec_manager.get_record(sent_id)
+
+    def get_tokens(self, sent_id):
+        return self.vec_manager.get_tokens(sent_id)
+
+    def get_positions(self, sent_id):
+        return self.vec_manager.get_positions(sent_id)
+
+    def get_spans(self, sent_id):
+        return self.vec_manager.get_spans(sent_id)
+
+    def fingerprint(self):
+        return self.vec_manager.fingerprint()
+
+    def stats(self):
+        n_requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / n_requests if n_requests > 0 else 0.0,
+                'n_sents': len(self.cache),
+                'n_bytes': self.n_bytes}
+
+    def take_stats(self):
+        """
+        Returns the hit, miss and eviction counts, and resets them.
+        
+        """
+        with self.lock:
+            result = {'hits': self.hits, 'misses': self.misses,
+                      'evictions': self.evictions}
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        return result
+
+    def merge_stats(self, stats):
+        with self.lock:
+            self.hits += stats['hits']
+            self.misses += stats['misses']
+            self.evictions += stats['evictions']
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __str__(self):
+        return 'vector cache: {}'.format(self.stats())
+
+
+def open_vector_manager(root_dir, cache_bytes=None):
+    """
+    Returns a MemmapVectorManager if root_dir holds a converted vector store,
+    and a DiskBasedVectorManager otherwise. If cache_bytes is given, the
+    result is wrapped in a CachedVectorManager of that size.
+    
+    """
+    if MemmapVectorManager.exists(root_dir):
+        result = MemmapVectorManager(root_dir)
+    else:
+        result = DiskBasedVectorManager(root_dir)
+    if cache_bytes is not None:
+        result = CachedVectorManager(result, cache_bytes)
+    return result
+
+
+def convert_vector_dir(json_dir, out_dir, dtype='float32', report=False):
+    """
+    Converts a directory of batchN/sentN.json files (as written by a
+    DiskBasedVectorManager) into a MemmapVectorManager store. If report
+    is True, also returns the reconstruction_error of the new store with 
+    respect to the JSON vectors (e.g. to evaluate an int8 encoding).
+    
+    """
+    reader = DiskBasedVectorManager(json_dir)
+    sent_ids = reader.sent_ids()
+    MemmapVectorManager.remove(out_dir)
+    with MemmapVectorManager(out_dir, dtype) as writer:
+        for sent_id in sent_ids:
+            data = reader.get_vector(sent_id)
+            writer.write(sent_id, data['tokens'], data['vecs'], data.get('positions'),
+                         data.get('spans'))
+    if report:
+        return reconstruction_error(reader, MemmapVectorManager(out_dir), sent_ids)
+
+
+def convert_vector_tree(vec_root, out_root=None, dtype='float32', report=False):
+    """
+    Converts every corpus directory under vec_root (i.e. every directory 
+    holding batchN subdirectories) into a MemmapVectorManager store at the
+    same relative path under out_root. By default, the stores are written
+    alongside the existing JSON files. If report is True, the 
+    reconstruction error of each store is printed and returned (as a dict
+    keyed by corpus directory).
+    
+    """
+    if out_root is None:
+        out_root = vec_root
+    errors = dict()
+    for dirpath, dirnames, _ in os.walk(vec_root):
+        if any(d.startswith('batch') for d in dirnames):
+            out_dir = join(out_root, os.path.relpath(dirpath, vec_root))
+            print('Converting: {}'.format(dirpath))
+            error = convert_vector_dir(dirpath, out_dir, dtype, report)
+            if report:
+                print('Reconstruction error ({}): {}'.format(dtype, error))
+                errors[out_dir] = error
+            dirnames[:] = [d for d in dirnames if not d.startswith('batch')]
+    return errors
+
 def normalize(word):
     words = word.split("_")
     return ' '.join(words)
 
-def vectorize_sent(sent, vectorizer):
-    sent_id = sent['sentid']
-    words = [normalize(wd['word']) for wd in sent['words']]
-    sent_str = ' '.join(words)
-    toks, vectors = vectorizer(sent_str)
-    return sent_id, toks, vectors
-        
-def vectorize_sents(sents, vectorizer, writer):
-    for sent in sents:
-        sent_id, toks, vectors = vectorize_sent(sent, vectorizer)
-        writer.write(sent_id, toks, vectors.tolist())
+def sent_words(sent):
+    return [normalize(wd['word']) for wd in sent['words']]
+
+def sent_string(sent):
+    return ' '.join(sent_words(sent))
+
+def tokenize_sent(sent, vectorizer):
+    """
+    Returns the token ids of sent, plus the token span of each word if the
+    vectorizer can provide them (see BertSentenceVectorizer.tokenize_words).
+    
+    """
+    if hasattr(vectorizer, 'tokenize_words'):
+        return vectorizer.tokenize_words(sent_words(sent))
+    return vectorizer.tokenize(sent_string(sent)), None
+
+
+class ThroughputMeter:
+    """
+    Keeps track of how many sentences and (non-padding) tokens have been 
+    vectorized, and reports sentences/sec and tokens/sec.
+    
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.n_sents = 0
+        self.n_toks = 0
+
+    def update(self, n_sents, n_toks):
+        self.n_sents += n_sents
+        self.n_toks += n_toks
+
+    def sents_per_sec(self):
+        return self.n_sents / max(time.time() - self.start_time, 1e-9)
+
+    def toks_per_sec(self):
+        return self.n_toks / max(time.time() - self.start_time, 1e-9)
+
+    def __str__(self):
+        return '{} sentences, {:.1f} sents/sec, {:.1f} tokens/sec'.format(self.n_sents,
+                                                                         self.sents_per_sec(),
+                                                                         self.toks_per_sec())
+
+
+def target_positions(sent, window=0):
+    """
+    Returns the positions of the sense-annotated words of sent, together
+    with the positions of the words within window words of them.
+    
+    """
+    n_words = len(sent['words'])
+    positions = set()
+    for i, word in enumerate(sent['words']):
+        if 'sense' in word:
+            positions.update(range(max(i - window, 0), min(i + window + 1, n_words)))
+    return sorted(positions)
+
+def sparsify(sent, toks, vectors, window=0, spans=None):
+    """
+    Converts the token vectors of a sentence into target-only form: one
+    vector per kept word (see target_positions), obtained by summing the
+    vectors of its subword tokens. Returns a (words, vectors, positions) 
+    triple, or None if the words cannot be aligned with the tokens.
+
+    The words are aligned with the tokens using spans if given, and 
+    align.align otherwise.
+    
+    """
+    words = [wd['word'] for wd in sent['words']]
+    alignment = spans if spans is not None else align.align(words, toks)
+    if alignment is None:
+        return None
+    positions = target_positions(sent, window)
+    if any(alignment[i] is None for i in positions):
+        return None
+    vectors = torch.as_tensor(vectors)
+    pooled = [vectors[alignment[i][0]:alignment[i][1]].sum(dim=0) for i in positions]
+    pooled = torch.stack(pooled) if len(pooled) > 0 else vectors[:0]
+    return [words[i] for i in positions], pooled, positions
+
+def write_sent(writer, sent, toks, vectors, targets_only=False, window=0, spans=None):
+    if not targets_only:
+        writer.write(sent['sentid'], toks, vectors, spans=spans)
+    else:
+        sparse = sparsify(sent, toks, vectors, window, spans)
+        if sparse is not None:
+            writer.write(sent['sentid'], *sparse)
+
+def vectorize_sents(sents, vectorizer, writer, batch_size=1, report_every=100,
+                    targets_only=False, window=0):
+    """
+    Vectorizes sents and writes them with writer. If targets_only is True,
+    only the pooled vectors of the annotated words (plus a window of 
+    surrounding words) are written.
+    
+    """
+    meter = ThroughputMeter()
+    if batch_size <= 1:
+        for sent in sents:
+            input_ids, spans = tokenize_sent(sent, vectorizer)
+            toks, vectors = vectorizer.encode_batch([input_ids])[0]
+            write_sent(writer, sent, toks, vectors, targets_only, window, spans)
+            meter.update(1, len(toks))
+            if meter.n_sents % report_every == 0:
+                print(meter)
+    else:
+        tokenized = [tokenize_sent(sent, vectorizer) for sent in sents]
+        input_ids = [ids for (ids, _) in tokenized]
+        buckets = length_buckets([len(ids) for ids in input_ids], batch_size)
+        for i, bucket in enumerate(buckets):
+            results = vectorizer.encode_batch([input_ids[j] for j in bucket])
+            for j, (toks, vectors) in zip(bucket, results):
+                write_sent(writer, sents[j], toks, vectors, targets_only, window,
+                           tokenized[j][1])
+            meter.update(len(bucket), sum(len(input_ids[j]) for j in bucket))
+            if (i + 1) % max(report_every // batch_size, 1) == 0:
+                print(meter)
+    print(meter)
+    return meter
+
+def init_writer(corpus_dir, store, dtype='float32'):
+    assert(store in ['json', 'memmap'])
+    if store == 'memmap':
+        return MemmapVectorManager(corpus_dir, dtype)
+    else:
+        return DiskBasedVectorManager(corpus_dir)
+
+
+def merge_vector_stores(in_dirs, out_dir, dtype='float32'):
+    """
+    Concatenates several MemmapVectorManager stores into a single (new) 
+    store.
+    
+    """
+    MemmapVectorManager.remove(out_dir)
+    with MemmapVectorManager(out_dir, dtype) as writer:
+        for in_dir in in_dirs:
+            reader = MemmapVectorManager(in_dir)
+            for sent_id in reader.sent_ids():
+                data = reader.get_vector(sent_id)
+                writer.write(sent_id, data['tokens'], data['vecs'], data.get('positions'),
+                         data.get('spans'))
+
+
+class ShardManifest:
+    """
+    Records which shards of a corpus have been completely vectorized, so
+    that an interrupted run can resume where it stopped. The manifest is 
+    rewritten atomically after every completed shard.
+
+    The manifest also records the settings of the run (shard size, store,
+    dtype, targets_only, window); resuming with different settings raises
+    a ValueError rather than mixing shards of both runs.
+    
+    """
+    def __init__(self, filename, settings=None):
+        self.filename = filename
+        self.settings = settings
+        self.completed = dict()
+        self.merged = False
+        if os.path.exists(filename):
+            with open(filename) as reader:
+                data = json.load(reader)
+            if settings is not None and data.get('settings') != settings:
+                raise ValueError('{} was written with settings {}, not {}; remove it to start over.'.format(
+                                 filename, data.get('settings'), settings))
+            self.settings = data.get('settings')
+            self.completed = data['completed']
+            self.merged = data['merged']
+
+    def is_complete(self, shard_id, shard=None):
+        """
+        Returns whether the shard is recorded as complete. If the shard's
+        sentences are given, the recorded sentid range and sentence count
+        must also match them.
         
-def vectorize_json(json_file, vectorizer, vector_dir):
-    if not os.path.exists(vector_dir):
-        os.makedirs(vector_dir)
+        """
+        info = self.completed.get(str(shard_id))
+        if info is None:
+            return False
+        if shard is not None:
+            return (info['first'] == shard[0]['sentid'] and
+                    info['last'] == shard[-1]['sentid'] and
+                    info['n_sents'] == len(shard))
+        return True
+
+    def mark_complete(self, shard_id, info):
+        self.completed[str(shard_id)] = info
+        self.save()
+
+    def mark_merged(self):
+        self.merged = True
+        self.save()
+
+    def save(self):
+        tmp_file = self.filename + '.tmp'
+        with open(tmp_file, 'w') as writer:
+            json.dump({'settings': self.settings,
+                       'completed': self.completed, 
+                       'merged': self.merged}, writer)
+            writer.flush()
+            os.fsync(writer.fileno())
+        os.replace(tmp_file, self.filename)
+
+
+def shard_sents(sents, shard_size):
+    """
+    Splits sents into shards of (at most) shard_size sentences, each 
+    covering a contiguous range of sentids.
+    
+    """
+    sents = sorted(sents, key=lambda sent: sent['sentid'])
+    return [sents[i:i + shard_size] for i in range(0, len(sents), shard_size)]
+
+def shard_dir(corpus_dir, shard_id):
+    return join(corpus_dir, 'shards', 'shard{}'.format(shard_id))
+
+_worker_vectorizer = None
+
+def _init_worker(vectorizer_factory, num_threads):
+    global _worker_vectorizer
+    torch.set_num_threads(num_threads)
+    _worker_vectorizer = vectorizer_factory()
+
+def vectorize_shard(vectorizer, shard_id, sents, out_dir, store, dtype, batch_size,
+                    targets_only=False, window=0):
+    if store == 'memmap' and os.path.exists(out_dir):
+        shutil.rmtree(out_dir) # leftovers of an interrupted run
+    writer = init_writer(out_dir, store, dtype)
+    meter = vectorize_sents(sents, vectorizer, writer, batch_size, 
+                            targets_only=targets_only, window=window)
+    writer.close()
+    return shard_id, {'first': sents[0]['sentid'],
+                      'last': sents[-1]['sentid'],
+                      'n_sents': meter.n_sents,
+                      'n_toks': meter.n_toks}
+
+def _vectorize_shard_in_worker(args):
+    return vectorize_shard(_worker_vectorizer, *args)
+
+def vectorize_corpus_sharded(sents, vectorizer_factory, corpus_dir, num_workers=1,
+                             shard_size=1000, store='memmap', dtype='float32', 
+                             batch_size=1, threads_per_worker=None, 
+                             targets_only=False, window=0):
+    """
+    Vectorizes a corpus in shards of shard_size sentences, spread over 
+    num_workers processes (each with its own copy of the model, created by 
+    calling vectorizer_factory, and threads_per_worker torch threads).
+    
+    Shards that are already recorded as complete in the corpus manifest are
+    skipped. With the memmap store, each shard is written to its own store
+    and the shards are merged once they are all complete.
+    
+    """
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+    settings = {'shard_size': shard_size, 'store': store, 'dtype': dtype,
+                'targets_only': targets_only, 'window': window}
+    manifest = ShardManifest(join(corpus_dir, 'manifest.json'), settings)
+    shards = shard_sents(sents, shard_size)
+    if manifest.merged:
+        if not all(manifest.is_complete(shard_id, shard) 
+                   for shard_id, shard in enumerate(shards)):
+            raise ValueError('{} holds vectors of different sentences; remove it to start over.'.format(
+                             corpus_dir))
+        if os.path.exists(join(corpus_dir, 'shards')):
+            # left over by a run interrupted right after its merge
+            shutil.rmtree(join(corpus_dir, 'shards'))
+        print('Already vectorized: {}'.format(corpus_dir))
+        return
+    tasks = []
+    for shard_id, shard in enumerate(shards):
+        out_dir = shard_dir(corpus_dir, shard_id) if store == 'memmap' else corpus_dir
+        if not (manifest.is_complete(shard_id, shard) and
+                (store != 'memmap' or MemmapVectorManager.exists(out_dir))):
+            tasks.append((shard_id, shard, out_dir, store, dtype, batch_size,
+                          targets_only, window))
+    print('Vectorizing {} of {} shards: {}'.format(len(tasks), len(shards), corpus_dir))
+    # each worker loads its own model, so never start more than there are shards
+    num_workers = min(num_workers, len(tasks))
+    if num_workers <= 1:
+        vectorizer = vectorizer_factory() if len(tasks) > 0 else None
+        for task in tasks:
+            shard_id, info = vectorize_shard(vectorizer, *task)
+            manifest.mark_complete(shard_id, info)
+    else:
+        if threads_per_worker is None:
+            threads_per_worker = max(1, multiprocessing.cpu_count() // num_workers)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(num_workers, initializer=_init_worker,
+                          initargs=(vectorizer_factory, threads_per_worker)) as pool:
+            for shard_id, info in pool.imap_unordered(_vectorize_shard_in_worker, tasks):
+                manifest.mark_complete(shard_id, info)
+    if store == 'memmap':
+        shard_dirs = [shard_dir(corpus_dir, shard_id) for shard_id in range(len(shards))]
+        merge_vector_stores(shard_dirs, corpus_dir, dtype)
+    # record the merge before removing the shards, so that an interruption
+    # in between cannot leave a manifest with nothing to merge
+    manifest.mark_merged()
+    if store == 'memmap':
+        shutil.rmtree(join(corpus_dir, 'shards'))
+
+def vectorize_json_sharded(json_file, vectorizer_factory, vector_dir, num_workers=1,
+                           shard_size=1000, store='memmap', dtype='float32', 
+                           batch_size=1, threads_per_worker=None, 
+                           targets_only=False, window=0):
     with open(json_file) as f:
         sents = json.load(f)
-        for corpus in sents['corpora']:
-            writer = DiskBasedVectorManager(join(vector_dir, corpus))
-            vectorize_sents(sents['corpora'][corpus]['sents'], vectorizer, writer)
+    for corpus in sents['corpora']:
+        vectorize_corpus_sharded(sents['corpora'][corpus]['sents'], vectorizer_factory,
+                                 join(vector_dir, corpus), num_workers, shard_size,
+                                 store, dtype, batch_size, threads_per_worker,
+                                 targets_only, window)
         
 if __name__ == '__main__':
-    vectorize_json(sys.argv[1], bert.BertSentenceVectorizer(), sys.argv[2])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", help="raganato json file (or, with --convert, an existing vecs directory)", type=str)
+    parser.add_argument("output_path", help="directory where the vectors are stored", type=str)
+    parser.add_argument("--store", help="vector store format", choices=['json', 'memmap'], default='memmap')
+    parser.add_argument("--dtype", help="element type of a memmap store", choices=['float32', 'float16', 'int8'], default='float32')
+    parser.add_argument("--batch_size", help="number of sentences per BERT forward pass", default=32, type=int)
+    parser.add_argument("--num_workers", help="number of vectorization processes (each loads its own model)", default=1, type=int)
+    parser.add_argument("--shard_size", help="number of sentences per resumable shard", default=1000, type=int)
+    parser.add_argument("--targets_only", help="only store pooled vectors of sense-annotated words", action='store_true')
+    parser.add_argument("--window", help="with --targets_only, also store words within this distance of a target", default=0, type=int)
+    parser.add_argument("--convert", help="convert a tree of json vector files into memmap stores", action='store_true')
+    parser.add_argument("--report", help="with --convert, report the error of the converted vectors with respect to the json vectors", action='store_true')
+    args = parser.parse_args()
+    if args.convert:
+        convert_vector_tree(args.input_path, args.output_path, args.dtype, args.report)
+    else:
+        vectorize_json_sharded(args.input_path, bert.BertSentenceVectorizer, 
+                               args.output_path, args.num_workers, args.shard_size,
+                               args.store, args.dtype, args.batch_size,
+                               targets_only=args.targets_only, window=args.window)
     
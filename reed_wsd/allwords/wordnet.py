@@ -1,9 +1,11 @@
+import os, sys
+import json
 from nltk.corpus import wordnet as wn
 from nltk.tokenize import word_tokenize
 import nltk
 from nltk.stem import WordNetLemmatizer
 import random
-from reed_wsd.allwords.bert import tokenize_with_target
+from reed_wsd.allwords.bert import tokenize_words
 
 
 def wn_definition_with_target(tokenizer, wn_lemma):
@@ -22,62 +24,166 @@ def wn_definition_with_target(tokenizer, wn_lemma):
 
 
 
-def wn_example(lemma, wordform, tokenizer, rand=False):
-    """
-    Takes the given nltk.wordnet lemma (e.g. 'be%2:42:03::') and a string
-    form of that lemma (e.g. "is") and finds an example sentence from
-    wordnet.
+def nltk_tag_to_wordnet_tag(nltk_tag):
+    if nltk_tag.startswith('J'):
+        return wn.ADJ
+    elif nltk_tag.startswith('V'):
+        return wn.VERB
+    elif nltk_tag.startswith('N'):
+        return wn.NOUN
+    elif nltk_tag.startswith('R'):
+        return wn.ADV
+    else:
+        return None
+
+_lemmatizer = WordNetLemmatizer()
 
+def lemmatize_tokens(tokens):
     """
-    lemmatizer = WordNetLemmatizer()
-
-    def nltk_tag_to_wordnet_tag(nltk_tag):
-        if nltk_tag.startswith('J'):
-            return wn.ADJ
-        elif nltk_tag.startswith('V'):
-            return wn.VERB
-        elif nltk_tag.startswith('N'):
-            return wn.NOUN
-        elif nltk_tag.startswith('R'):
-            return wn.ADV
+    takes a list of word tokens and returns a list of lemmatized tokens
+    """
+    lemmatized_sentence = []
+    for word, nltk_tag in nltk.pos_tag(tokens):
+        tag = nltk_tag_to_wordnet_tag(nltk_tag)
+        if tag is None:
+            #if there is no available tag, append the token as is
+            lemmatized_sentence.append(word)
         else:
-            return None
+            #else use the tag to lemmatize the token
+            lemmatized_sentence.append(_lemmatizer.lemmatize(word, tag))
+    return lemmatized_sentence
+
+
+class ExampleIndex:
+    """
+    Maps the name of each synset to its example sentences, each stored
+    with the [start, stop) token span (as tokenized by tknz, with [CLS] 
+    at token 0) of the first occurrence of every lemma in the example.
+    The lemmas of target wordforms are memoized as well, so that finding
+    an example for a (synset, wordform) pair is a dictionary lookup.
+
+    Synsets are indexed on first use (or all at once, with build), and
+    the index can be persisted with save.
+    
+    """
+    def __init__(self, tknz, entries=None, wordform_lemmas=None, filename=None):
+        self.tknz = tknz
+        self.entries = entries if entries is not None else dict()
+        self.wordform_lemmas = wordform_lemmas if wordform_lemmas is not None else dict()
+        self.filename = filename
+        self.n_added = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def examples(self, synset):
+        entry = self.entries.get(synset.name())
+        if entry is None:
+            entry = [self.index_example(eg) for eg in synset.examples()]
+            self.entries[synset.name()] = entry
+            self.n_added += 1
+        return entry
+
+    def index_example(self, example):
+        tokens = word_tokenize(example)
+        spans = dict()
+        start = 1
+        for word_ids, lemma in zip(tokenize_words(self.tknz, tokens), 
+                                   lemmatize_tokens(tokens)):
+            if lemma not in spans:
+                spans[lemma] = [start, start + len(word_ids)]
+            start += len(word_ids)
+        return {'text': example, 'spans': spans}
+
+    def wordform_lemma(self, wordform):
+        lemma = self.wordform_lemmas.get(wordform)
+        if lemma is None:
+            lemma = lemmatize_tokens(word_tokenize(wordform))[0]
+            self.wordform_lemmas[wordform] = lemma
+            self.n_added += 1
+        return lemma
+
+    def matches(self, synset, wordform):
+        """
+        Returns the (example, span) pairs of the synset's examples that
+        contain the lemma of wordform.
+        
+        """
+        tgt_lemma = self.wordform_lemma(wordform)
+        return [(eg['text'], eg['spans'][tgt_lemma]) 
+                for eg in self.examples(synset) if tgt_lemma in eg['spans']]
+
+    def build(self):
+        for synset in wn.all_synsets():
+            self.examples(synset)
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = self.filename
+        partial_file = filename + '.partial'
+        with open(partial_file, 'w') as writer:
+            json.dump({'entries': self.entries, 
+                       'wordform_lemmas': self.wordform_lemmas}, writer)
+        os.replace(partial_file, filename)
+        self.n_added = 0
 
-    def lemmatize_sentence(sentence):
+    @staticmethod
+    def from_file(filename, tknz):
         """
-        takes a str sentence and return a list of lemmatized tokens
+        Loads the index from filename if it exists; otherwise returns an
+        empty index that save() will write to filename.
+        
         """
-        #tokenize the sentence and find the POS tag for each token
-        nltk_tagged = nltk.pos_tag(nltk.word_tokenize(sentence))  
-        #tuple of (token, wordnet_tag)
-        wordnet_tagged = map(lambda x: (x[0], nltk_tag_to_wordnet_tag(x[1])), nltk_tagged)
-        lemmatized_sentence = []
-        for word, tag in wordnet_tagged:
-            if tag is None:
-                #if there is no available tag, append the token as is
-                lemmatized_sentence.append(word)
-            else:
-                #else use the tag to lemmatize the token
-                lemmatized_sentence.append(lemmatizer.lemmatize(word, tag))
-        return lemmatized_sentence
-    syns_egs = lemma.synset().examples()
-    syns_egs_tks = [word_tokenize(eg) for eg in syns_egs]
-    lemmatized_syns_egs = [lemmatize_sentence(sent) for sent in syns_egs]
-    tgt_lemma = lemmatize_sentence(wordform)[0]
-    example_pairs = []
-    for i, eg in enumerate(lemmatized_syns_egs):
-        if tgt_lemma in eg:
-            index = eg.index(tgt_lemma)
-            example_pairs.append([i, index])
+        entries = None
+        wordform_lemmas = None
+        if os.path.exists(filename):
+            with open(filename) as reader:
+                data = json.load(reader)
+            entries = data['entries']
+            wordform_lemmas = data['wordform_lemmas']
+        return ExampleIndex(tknz, entries, wordform_lemmas, filename)
+
+
+_default_indices = dict()
+
+def default_example_index(tokenizer):
+    """
+    Returns an in-memory ExampleIndex shared by the callers that use 
+    the same tokenizer.
+    
+    """
+    key = tokenizer.name_or_path
+    if key not in _default_indices:
+        _default_indices[key] = ExampleIndex(tokenizer)
+    return _default_indices[key]
+
+
+def wn_example(lemma, wordform, tokenizer, rand=False, index=None):
+    """
+    Takes the given nltk.wordnet lemma (e.g. 'be%2:42:03::') and a string
+    form of that lemma (e.g. "is") and finds an example sentence from
+    wordnet, looked up in index (by default, an in-memory ExampleIndex
+    shared by the callers with the same tokenizer).
+
+    """
+    if index is None:
+        index = default_example_index(tokenizer)
+    example_pairs = index.matches(lemma.synset(), wordform)
     if len(example_pairs) == 0:
         gloss, span = wn_definition_with_target(tokenizer, lemma)
         return gloss, span
     if rand:
-        random_pair = random.sample(example_pairs, 1)[0]
+        example, span = random.sample(example_pairs, 1)[0]
     else:
-        random_pair = example_pairs[0]
-    _, span = tokenize_with_target(tokenizer, syns_egs_tks[random_pair[0]], random_pair[1])
-    return syns_egs[random_pair[0]], span
+        example, span = example_pairs[0]
+    return example, list(span)
+
+def random_wn_example(lemma, word, tokenizer, index=None):
+    return wn_example(lemma, word, tokenizer, rand=True, index=index)
+
 
-def random_wn_example(lemma, word, tokenizer):
-    return wn_example(lemma, word, tokenizer, rand=True)
+if __name__ == '__main__':
+    from transformers import BertTokenizer
+    index = ExampleIndex(BertTokenizer.from_pretrained('bert-base-uncased'))
+    index.build()
+    index.save(sys.argv[1])
@@ -1,9 +1,13 @@
 import os, sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import math
+import copy
 import json
+import hashlib
 import torch
 import random
+import numpy as np
+from os.path import join
 from torch import tensor
 from torch.utils.data import Dataset
 import reed_wsd.util as util
@@ -17,18 +21,40 @@ import nltk
 from reed_wsd.loader import Loader
 
 class SenseInventory:
+    """
+    Assigns an id to every sense, so that the senses of each lemma occupy
+    a contiguous range (the lemma's "zone"). Lookups are precompiled:
+        - sense_ids maps each sense key to its id
+        - lemma_ids maps each lemma to its id (lemmas are in sorted order)
+        - zone_starts, zone_stops (long tensors indexed by lemma id) give 
+          the [start, stop) sense range of each lemma
+        - sense_lemma_ids (a long tensor indexed by sense id) gives the
+          lemma id of each sense
+    
+    """
     def __init__(self, senses_by_lemma):
         self.senses_by_lemma = {x: tuple(sorted(senses_by_lemma[x])) 
                                 for x in senses_by_lemma}
         self.all_senses = []
         self.lemma_ranges = dict()
+        self.lemmas = sorted(self.senses_by_lemma)
+        self.lemma_ids = {lemma: i for (i, lemma) in enumerate(self.lemmas)}
+        self.sense_ids = dict()
+        sense_lemma_ids = []
         current_id = 0
-        for lemma in sorted(self.senses_by_lemma):
+        for lemma in self.lemmas:
             for sense in self.senses_by_lemma[lemma]:
+                self.sense_ids[sense] = len(self.all_senses)
                 self.all_senses.append(sense)
+                sense_lemma_ids.append(self.lemma_ids[lemma])
             prev_id = current_id
             current_id += len(self.senses_by_lemma[lemma])
             self.lemma_ranges[lemma] = (prev_id, current_id)
+        zones = torch.tensor([self.lemma_ranges[lemma] for lemma in self.lemmas],
+                             dtype=torch.long).view(-1, 2)
+        self.zone_starts = zones[:, 0].contiguous()
+        self.zone_stops = zones[:, 1].contiguous()
+        self.sense_lemma_ids = torch.tensor(sense_lemma_ids, dtype=torch.long)
              
     def contains_lemma(self, lemma):
         return lemma in self.senses_by_lemma
@@ -37,10 +63,7 @@ class SenseInventory:
         return SenseInventory.deconstruct_sense(sense)[0]
     
     def sense_id(self, sense):
-        lemma = self.sense_lemma(sense)
-        lemma_range = self.lemma_ranges[lemma]
-        lemma_subindex = self.senses_by_lemma[lemma].index(sense)
-        return lemma_range[0] + lemma_subindex
+        return self.sense_ids[sense]
         
     def sense(self, sense_id):
         return self.all_senses[sense_id]
@@ -48,6 +71,83 @@ class SenseInventory:
     def sense_range(self, lemma):
         return self.lemma_ranges[lemma]
 
+    def sense_id_tensor(self, senses):
+        """
+        Maps a list of sense keys to a long tensor of their ids.
+        
+        """
+        sense_ids = self.sense_ids
+        return torch.tensor([sense_ids[sense] for sense in senses], dtype=torch.long)
+
+    def lemma_id_tensor(self, lemmas):
+        lemma_ids = self.lemma_ids
+        return torch.tensor([lemma_ids[lemma] for lemma in lemmas], dtype=torch.long)
+
+    def zone_tensors(self, sense_ids):
+        """
+        Given a long tensor of sense ids, returns the zone starts and zone
+        stops (long tensors of the same shape) of their lemmas.
+        
+        """
+        lemma_ids = self.sense_lemma_ids[sense_ids]
+        return self.zone_starts[lemma_ids], self.zone_stops[lemma_ids]
+
+    def sense_lemmas(self, sense_ids):
+        """
+        Given a long tensor of sense ids, returns the list of their lemmas.
+        
+        """
+        return [self.lemmas[i] for i in self.sense_lemma_ids[sense_ids].tolist()]
+
+    def save(self, filename, source_stamp=None):
+        torch.save({'inventory': self.__dict__, 
+                    'source_stamp': source_stamp}, filename)
+
+    @staticmethod
+    def load(filename):
+        """
+        Restores a saved inventory without recompiling it.
+        
+        """
+        result = SenseInventory.__new__(SenseInventory)
+        result.__dict__.update(torch.load(filename)['inventory'])
+        return result
+
+    @staticmethod
+    def from_json_cached(inventory, filename):
+        """
+        Loads the compiled inventory from filename if it is up to date;
+        otherwise compiles the JSON inventory and saves the result to 
+        filename.
+
+        The inventory is either a dict from lemmas to senses, or the name
+        of a JSON file holding one. In the latter case, the file is only
+        parsed when compiling, and the compiled inventory is only reused 
+        while the file keeps the size and modification time it had then.
+        A dict is stamped with a hash of its contents.
+        
+        """
+        if isinstance(inventory, str):
+            stat = os.stat(inventory)
+            source_stamp = [stat.st_size, stat.st_mtime_ns]
+        else:
+            contents = json.dumps(inventory, sort_keys=True, default=sorted)
+            source_stamp = hashlib.sha1(contents.encode('utf-8')).hexdigest()
+        if os.path.exists(filename):
+            data = torch.load(filename)
+            if 'inventory' in data and data['source_stamp'] == source_stamp:
+                result = SenseInventory.__new__(SenseInventory)
+                result.__dict__.update(data['inventory'])
+                return result
+        if isinstance(inventory, str):
+            with open(inventory) as reader:
+                inventory = json.load(reader)
+        result = SenseInventory(inventory)
+        partial_file = filename + '.partial'
+        result.save(partial_file, source_stamp)
+        os.replace(partial_file, filename)
+        return result
+
     def get_senses(self, lemma):
         return self.senses_by_lemma[lemma]
 
@@ -81,12 +181,71 @@ class SenseInventory:
         return SenseInventory(senses_by_lemma)
         
         
-class SenseTaggedSentences(Dataset):
+class Interner:
+    """
+    Assigns consecutive integer ids to strings, in order of first
+    appearance.
+    
+    """
+    def __init__(self):
+        self.ids = dict()
+        self.values = []
+
+    def __call__(self, value):
+        if value is None:
+            return -1
+        if value not in self.ids:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+        return self.ids[value]
 
+
+class SenseTaggedSentences(Dataset):
+    """
+    The sense-tagged sentences of a corpus, stored column by column rather
+    than as per-word dictionaries. Every token has an entry in the following
+    int32 arrays (a value of -1 means the field is absent):
+        - word_ids: indexes into self.words
+        - tag_ids: indexes into self.tags
+        - sense_ids: indexes into self.senses (-1 for untagged words)
+        - lemma_ids: indexes into self.lemmas (the lemma of the sense)
+        - inst_ids: indexes into self.inst_id_strs
+    
+    The tokens of sentence k are those in [sent_offsets[k], sent_offsets[k+1]).
+    Indexing (e.g. sents[k]) still returns the sentence as a dictionary with
+    the 'sentid' and 'words' fields of the JSON format.
+    
+    """
     def __init__(self, st_sents, inventory, n_insts):
-        self.st_sents = st_sents
-        self.inventory = SenseInventory(inventory)
+        if not isinstance(inventory, SenseInventory):
+            inventory = SenseInventory(inventory)
+        self.inventory = inventory
         self.n_insts = n_insts
+        words, tags, senses, lemmas, inst_ids = (Interner(), Interner(), Interner(), 
+                                                 Interner(), Interner())
+        columns = [[], [], [], [], []]
+        offsets = [0]
+        self.sentids = []
+        for st_sent in st_sents:
+            self.sentids.append(st_sent['sentid'])
+            for word in st_sent['words']:
+                sense = word.get('sense')
+                lemma = None if sense is None else SenseInventory.deconstruct_sense(sense)[0]
+                columns[0].append(words(word['word']))
+                columns[1].append(tags(word.get('tag')))
+                columns[2].append(senses(sense))
+                columns[3].append(lemmas(lemma))
+                columns[4].append(inst_ids(word.get('id')))
+            offsets.append(len(columns[0]))
+        (self.word_ids, self.tag_ids, self.sense_ids, 
+         self.lemma_ids, self.inst_ids) = [np.array(column, dtype=np.int32) 
+                                           for column in columns]
+        self.sent_offsets = np.array(offsets, dtype=np.int64)
+        self.words = words.values
+        self.tags = tags.values
+        self.senses = senses.values
+        self.lemmas = lemmas.values
+        self.inst_id_strs = inst_ids.values
 
     def onehot(self, sense):
         result = torch.zeros(self.num_senses())
@@ -102,11 +261,58 @@ class SenseTaggedSentences(Dataset):
     def get_n_insts(self):
         return self.n_insts
 
+    def sent_id(self, index):
+        return self.sentids[index]
+
+    def sent_words(self, index):
+        start, stop = self.sent_offsets[index], self.sent_offsets[index + 1]
+        return [self.words[i] for i in self.word_ids[start:stop]]
+
+    def token(self, index, pos):
+        """
+        Returns the word at position pos of sentence index, as a dictionary
+        with (some of) the fields 'word', 'tag', 'sense' and 'id'.
+        
+        """
+        i = self.sent_offsets[index] + pos
+        result = {'word': self.words[self.word_ids[i]]}
+        for key, ids, values in [('tag', self.tag_ids, self.tags),
+                                 ('sense', self.sense_ids, self.senses),
+                                 ('id', self.inst_ids, self.inst_id_strs)]:
+            if ids[i] >= 0:
+                result[key] = values[ids[i]]
+        return result
+
+    def instance_positions(self, inv=None):
+        """
+        Finds the sense-tagged words whose lemma belongs to inv (by default,
+        every sense-tagged word). Returns two arrays: the sentence index and
+        the word position of each such word, in corpus order.
+        
+        """
+        if inv is None:
+            selected = (self.sense_ids >= 0)
+        else:
+            known = np.array([inv.contains_lemma(lemma) for lemma in self.lemmas] + [False])
+            selected = known[self.lemma_ids]  # lemma id -1 selects the final False
+        tokens = np.nonzero(selected)[0]
+        sent_indices = np.searchsorted(self.sent_offsets, tokens, side='right') - 1
+        return sent_indices, tokens - self.sent_offsets[sent_indices]
+
+    def count_instances(self, inv=None):
+        return len(self.instance_positions(inv)[0])
+
     def __getitem__(self, index):
-        return self.st_sents[index]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('sentence index out of range: {}'.format(index))
+        n_words = self.sent_offsets[index + 1] - self.sent_offsets[index]
+        return {'sentid': self.sentids[index],
+                'words': [self.token(index, pos) for pos in range(n_words)]}
 
     def __len__(self):
-        return len(self.st_sents)
+        return len(self.sentids)
 
     @staticmethod
     def from_json_dict(st_sents, corpus_id):
@@ -127,6 +333,44 @@ class SenseTaggedSentences(Dataset):
             st_sents = json.load(reader)        
         return SenseTaggedSentences.from_json_dict(st_sents, corpus_id)
 
+    @staticmethod
+    def from_split(split_dir, corpus_id):
+        """
+        Loads a single corpus from the split format written by raganato.py
+        (inventory.json, corpora.json and one JSON-lines file per corpus).
+        The compiled inventory is cached as inventory.pt.
+        Sentences are streamed from disk into the columnar representation.
+        
+        """
+        with open(join(split_dir, 'corpora.json')) as reader:
+            corpus = json.load(reader)[corpus_id]
+        inv = SenseInventory.from_json_cached(join(split_dir, 'inventory.json'),
+                                              join(split_dir, 'inventory.pt'))
+        sents = read_json_lines(join(split_dir, corpus['sents']))
+        return SenseTaggedSentences(sents, inv, corpus['n_insts'])
+
+    @staticmethod
+    def from_data_dir(data_dir, corpus_id):
+        """
+        Loads a corpus from data_dir/raganato_split if it exists, and from
+        data_dir/raganato.json otherwise.
+        
+        """
+        split_dir = join(data_dir, 'raganato_split')
+        if os.path.exists(join(split_dir, 'corpora.json')):
+            return SenseTaggedSentences.from_split(split_dir, corpus_id)
+        return SenseTaggedSentences.from_json(join(data_dir, 'raganato.json'), corpus_id)
+
+
+def read_json_lines(filename):
+    """
+    Iterates through the sentences of a JSON-lines file, parsing one line
+    at a time.
+    
+    """
+    with open(filename, 'rb') as reader:
+        for line in reader:
+            yield json.loads(line.decode('utf-8'))
 
 
 class SenseInstance:
@@ -192,39 +436,138 @@ class SenseInstance:
 
 
 
-class SenseInstanceDataset(Dataset):
+def pool_vectors(vecs, start, stop):
+    """
+    Sums the token vectors in rows [start, stop) of vecs, which is either
+    a list of lists or a (possibly memory-mapped) numpy array. Array slices
+    are wrapped by torch without copying.
+    
+    """
+    return torch.as_tensor(vecs[start:stop]).float().sum(dim=0)
+
 
+def sample_inventory(inv, sense_sz):
+    """
+    Returns a SenseInventory restricted to sense_sz randomly chosen lemmas
+    of inv.
+    
+    """
+    all_senses_by_lemma = inv.get_senses_by_lemma()
+    key_samples = random.sample(list(all_senses_by_lemma.keys()), sense_sz)
+    new_senses_by_lemma = {}
+    for k in key_samples:
+        new_senses_by_lemma[k] = all_senses_by_lemma[k]
+    return SenseInventory(new_senses_by_lemma)
+
+def sentence_groups(sent_indices):
+    """
+    Given the (sorted) sentence index of each instance, returns the 
+    [start, stop) instance range of each sentence that has instances.
+    
+    """
+    if len(sent_indices) == 0:
+        return []
+    starts = np.flatnonzero(np.diff(sent_indices)) + 1
+    starts = np.concatenate([[0], starts])
+    stops = np.append(starts[1:], len(sent_indices))
+    return list(zip(starts.tolist(), stops.tolist()))
+
+def sentence_order(sent_bounds, randomize):
+    """
+    Given the [start, stop) instance ranges of each sentence, returns an
+    ordering of all instances that keeps each sentence's instances together
+    (in random sentence order, if randomize is True).
+    
+    """
+    sent_bounds = list(sent_bounds)
+    if randomize:
+        random.shuffle(sent_bounds)
+    return [i for (start, stop) in sent_bounds for i in range(start, stop)]
+
+def sentence_sampler(ds):
+    """
+    Returns a Loader sampler that keeps the instances of each sentence of
+    ds together (shuffling the order of the sentences, if requested), so
+    that most sentences fall within a single batch.
+    
+    """
+    def sample(indices, shuffle, rng):
+        groups = dict()
+        for i in indices:
+            groups.setdefault(ds.sent_index(i), []).append(i)
+        groups = list(groups.values())
+        if shuffle:
+            rng.shuffle(groups)
+        return [i for group in groups for i in group]
+    return sample
+
+
+class SenseInstanceDataset(Dataset):
+    """
+    A map-style dataset of the SenseInstances of a corpus. On construction,
+    it builds an index with one (sentence index, word position, subword 
+    start, subword stop) entry per annotated word, so that __getitem__ 
+    only needs to load and pool the vectors of a single sentence.
+    
+    """
     def __init__(self, st_sents, vec_manager, randomize_sents=True, sense_sz=-1):
         self.st_sents = st_sents
         self.inv = self.st_sents.get_inventory()
         self.vec_manager = vec_manager
-        self.instance_index = 0
-        self.instance_iter = self.item_iter()
         self.randomize_sents = randomize_sents
-        self.num_insts = self.st_sents.get_n_insts()
-        self.current_instance = next(self.instance_iter)
         if sense_sz > 0:
-            all_senses_by_lemma = self.inv.get_senses_by_lemma()
-            key_samples = random.sample(all_senses_by_lemma.keys(), sense_sz)
-            new_senses_by_lemma = {}
-            for k in key_samples:
-                new_senses_by_lemma[k] = all_senses_by_lemma[k]
-            self.inv = SenseInventory(new_senses_by_lemma)
-
-            # recount n_insts
-            n_insts = 0
-            sent_ids = list(range(len(self.st_sents)))
-            for i, index in enumerate(sent_ids):            
-                st_sent = self.st_sents[index] 
-                for i, word in enumerate(st_sent['words']):
-                    w = word['word']
-                    if 'sense' in word and w in self.inv.get_senses_by_lemma():
-                        n_insts += 1
-            self.num_insts = n_insts
+            self.inv = sample_inventory(self.inv, sense_sz)
+        self.index_instances()
+
+    def index_instances(self):
+        self.index = []
+        self.sent_bounds = []
+        self.num_dropped_sents = 0
+        self.cached_vecs = None
+        self.cached_sent_id = None
+        sent_indices, all_positions = self.st_sents.instance_positions(self.inv)
+        groups = sentence_groups(sent_indices)
+        for (first, last) in groups:
+            sent_index = int(sent_indices[first])
+            positions = all_positions[first:last].tolist()
+            sent_id = self.st_sents.sent_id(sent_index)
+            record = self.vec_manager.get_record(sent_id)
+            if record is None:
+                record = dict()
+            stored_positions = record.get('positions')
+            stored_spans = record.get('spans')
+            alignment = None
+            if stored_spans is not None:
+                # spans computed by the tokenizer during vectorization
+                if all(stored_spans[i] is not None for i in positions):
+                    alignment = stored_spans
+            elif stored_positions is not None:
+                # target-only store: one pooled row per stored word
+                rows = {pos: row for (row, pos) in enumerate(stored_positions)}
+                alignment = {i: (rows[i], rows[i] + 1) for i in positions if i in rows}
+                if len(alignment) < len(positions):
+                    alignment = None
+            else:
+                new_toks = record.get('tokens')
+                if new_toks is not None:
+                    old_toks = self.st_sents.sent_words(sent_index)
+                    alignment = align.align(old_toks, new_toks)
+            if alignment is None:
+                self.num_dropped_sents += 1
+                continue
+            start = len(self.index)
+            for i in positions:
+                (projection_start, projection_stop) = alignment[i]
+                self.index.append((sent_index, i, projection_start, projection_stop))
+            self.sent_bounds.append((start, len(self.index)))
+        if self.num_dropped_sents > 0:
+            print('Warning: dropped {} of {} sentences with instances, whose words could not be aligned with their vectors.'.format(
+                  self.num_dropped_sents, len(groups)))
 
     def duplicate(self):
-        new_ds = SenseInstanceDataset(self.st_sents, self.vec_manager, self.randomize_sents)
-        new_ds.set_inventory(self.get_inventory())
+        new_ds = copy.copy(self)
+        new_ds.cached_vecs = None
+        new_ds.cached_sent_id = None
         return new_ds
 
     def onehot(self, sense):
@@ -235,61 +578,89 @@ class SenseInstanceDataset(Dataset):
     
     def set_inventory(self, inv):
         self.inv = inv
+        self.index_instances()
     
     def set_randomize_sents(self, value):
         self.randomize_sents = value
+
+    def sent_index(self, i):
+        return self.index[i][0]
+
+    def get_sentence_vectors(self, sent_id):
+        if self.cached_vecs is None or self.cached_sent_id != sent_id:
+            self.cached_vecs = self.vec_manager.get_vector(sent_id)
+            self.cached_sent_id = sent_id
+        return self.cached_vecs
          
     def item_iter(self):
-        sent_ids = list(range(len(self.st_sents)))
-        if self.randomize_sents:
-            random.shuffle(sent_ids)
-        for i, index in enumerate(sent_ids):            
-            st_sent = self.st_sents[index] 
-            vecs = self.vec_manager.get_vector(st_sent['sentid'])
-            old_toks = [wd['word'] for wd in st_sent['words']]    
-            new_toks = vecs['tokens']
-            alignment = align.align(old_toks, new_toks)
-            if alignment is not None:
-                for i, word in enumerate(st_sent['words']):
-                    if 'sense' in word:
-                        sense_inst = SenseInstance(word['id'], old_toks, i, word['sense'], word['tag'])
-                        (projection_start, projection_stop) = alignment[i]
-                        embeddings = []
-                        for j in range(projection_start, projection_stop):
-                            embeddings.append(tensor(vecs['vecs'][j]))
-                        embedding = torch.stack(embeddings).sum(dim=0).tolist()
-                        sense_inst.add_embedding('embed', embedding)
-                        yield sense_inst
+        for i in sentence_order(self.sent_bounds, self.randomize_sents):
+            yield self[i]
         
+    def instance(self, index):
+        """
+        Returns the instance id, the sense and the pooled embedding (as a 
+        tensor) of an instance, without building a SenseInstance.
+        
+        """
+        (sent_index, i, projection_start, projection_stop) = self.index[index]
+        vecs = self.get_sentence_vectors(self.st_sents.sent_id(sent_index))
+        word = self.st_sents.token(sent_index, i)
+        embedding = pool_vectors(vecs['vecs'], projection_start, projection_stop)
+        return word['id'], word['sense'], embedding
+
     def __getitem__(self, index):
-        if index < self.instance_index:
-            self.instance_index = 0
-            self.instance_iter = self.item_iter()
-            self.current_instance = next(self.instance_iter)
-        while self.instance_index < index:
-            self.instance_index += 1
-            self.current_instance = next(self.instance_iter)            
-        return self.current_instance
+        (sent_index, i, projection_start, projection_stop) = self.index[index]
+        vecs = self.get_sentence_vectors(self.st_sents.sent_id(sent_index))
+        old_toks = self.st_sents.sent_words(sent_index)
+        word = self.st_sents.token(sent_index, i)
+        sense_inst = SenseInstance(word['id'], old_toks, i, word['sense'], word['tag'])
+        embedding = pool_vectors(vecs['vecs'], projection_start, 
+                                 projection_stop).tolist()
+        sense_inst.add_embedding('embed', embedding)
+        return sense_inst
 
     def __len__(self):
-        return self.num_insts
+        return len(self.index)
 
 
 
+def pin_evidence(batch):
+    """
+    With CUDA, pins the evidence of a collated instance batch, so that it
+    can be copied to the GPU asynchronously. Called outside of the worker
+    processes, which must not initialize CUDA.
+    
+    """
+    if not torch.cuda.is_available():
+        return batch
+    (inst_ids, targets, evidence, sense_ids, zones) = batch
+    return (inst_ids, targets, evidence.pin_memory(), sense_ids, zones)
+
+
 class SenseInstanceLoader(Loader):
+    """
+    Batches the instances of a SenseInstanceDataset. Each batch is a
+    (inst_ids, targets, evidence, sense_ids, zones) package. See Loader
+    for the meaning of num_workers, prefetch and seed.
+
+    The instances of each sentence are kept together (only the order of
+    the sentences is shuffled), so that the dataset loads each sentence's
+    vectors once per epoch rather than once per instance.
     
-    def __init__(self, inst_ds, batch_size, desired_ids = None):
+    """
+    def __init__(self, inst_ds, batch_size, desired_ids = None, shuffle = None,
+                 num_workers = 0, prefetch = 0, seed = None):
+        if shuffle is None:
+            shuffle = inst_ds.randomize_sents
+        super().__init__(batch_size, shuffle, num_workers, prefetch, seed,
+                         sampler=sentence_sampler(inst_ds))
         self.inst_ds = inst_ds
-        self.n_insts = len(self.inst_ds)
-        self.batch_size = batch_size
         if desired_ids is None:
             self.desired_ids = list(range(len(self.inst_ds)))
         else:
             self.desired_ids = desired_ids            
+        self.n_insts = len(self.desired_ids)
         self.inventory = self.inst_ds.get_inventory()
-
-    def __len__(self):
-        return math.ceil(self.n_insts / self.batch_size)
             
     def get_instance_dataset(self):
         return self.inst_ds
@@ -306,48 +677,234 @@ class SenseInstanceLoader(Loader):
     def sense(self, sense_id):
         return self.inventory.sense(sense_id)
             
-    def __iter__(self):
+    def collate(self, indices):
+        """
+        Assembles the batch of the given instances, copying each embedding
+        straight into a preallocated tensor.
+        
+        """
+        inst_ids = []
+        senses = []
+        evidence = None
+        for row, i in enumerate(indices):
+            inst_id, sense, embedding = self.inst_ds.instance(i)
+            if evidence is None:
+                evidence = torch.empty((len(indices), embedding.shape[0]))
+            evidence[row] = embedding
+            inst_ids.append(inst_id)
+            senses.append(sense)
+        sense_ids = self.inventory.sense_id_tensor(senses)
+        zone_starts, zone_stops = self.inventory.zone_tensors(sense_ids)
+        return (inst_ids,
+                self.inventory.sense_lemmas(sense_ids),
+                evidence,
+                sense_ids,
+                list(zip(zone_starts.tolist(), zone_stops.tolist())))
+
+    def pin(self, batch):
+        return pin_evidence(batch)
+
+    def worker_stats(self):
+        vec_manager = self.inst_ds.vec_manager
+        if hasattr(vec_manager, 'take_stats'):
+            return vec_manager.take_stats()
+        return None
+
+    def merge_worker_stats(self, stats):
+        self.inst_ds.vec_manager.merge_stats(stats)
+            
+class CompiledSenseInstances:
+    """
+    A CompiledSenseInstances is a dense table of all the instances of a
+    SenseInstanceDataset. It holds:
+        - 'evidence' (a float tensor of shape [n_insts, dim]): the pooled
+          embedding of each annotated word
+        - 'sense_ids' (a long tensor): the sense id of each instance
+        - 'zone_starts', 'zone_stops' (long tensors): the sense range of
+          each instance's lemma
+        - 'inst_ids', 'targets' (lists of strings): the instance ids and
+          lemmas
+
+    Since the alignment and subword pooling are the same every epoch, the
+    table is computed once per corpus and vectorizer and cached on disk,
+    together with a fingerprint of the dataset it was compiled from (see
+    CompiledSenseInstances.fingerprint).
+    
+    """
+    def __init__(self, evidence, sense_ids, zone_starts, zone_stops, 
+                 inst_ids, targets, inventory):
+        self.evidence = evidence
+        self.sense_ids = sense_ids
+        self.zone_starts = zone_starts
+        self.zone_stops = zone_stops
+        self.inst_ids = inst_ids
+        self.targets = targets
+        self.inventory = inventory
+
+    def __len__(self):
+        return self.evidence.shape[0]
+
+    def get_inventory(self):
+        return self.inventory
+
+    def zones(self, indices):
+        return list(zip(self.zone_starts[indices].tolist(),
+                        self.zone_stops[indices].tolist()))
+
+    def save(self, filename, fingerprint=None):
+        torch.save({'evidence': self.evidence,
+                    'sense_ids': self.sense_ids,
+                    'zone_starts': self.zone_starts,
+                    'zone_stops': self.zone_stops,
+                    'inst_ids': self.inst_ids,
+                    'targets': self.targets,
+                    'num_senses': self.inventory.num_senses(),
+                    'fingerprint': fingerprint}, filename)
+
+    @staticmethod
+    def load(filename, inventory, fingerprint=None):
+        """
+        Loads a saved table. If a fingerprint is given, returns None 
+        unless the table was saved with the same fingerprint.
+        
+        """
+        data = torch.load(filename)
+        if fingerprint is not None and data.get('fingerprint') != fingerprint:
+            return None
+        assert data['num_senses'] == inventory.num_senses(), "cached table was compiled with a different inventory"
+        return CompiledSenseInstances(data['evidence'], data['sense_ids'],
+                                      data['zone_starts'], data['zone_stops'],
+                                      data['inst_ids'], data['targets'],
+                                      inventory)
+
+    @staticmethod
+    def fingerprint(inst_ds):
+        """
+        Summarizes what a table compiled from inst_ds depends on: its 
+        vector store (see VectorManager.fingerprint), its number of 
+        instances and a hash of its inventory's sense ids.
+        
+        """
+        senses = '\n'.join(inst_ds.get_inventory().all_senses)
+        return {'vectors': inst_ds.vec_manager.fingerprint(),
+                'n_insts': len(inst_ds),
+                'inventory': hashlib.sha1(senses.encode('utf-8')).hexdigest()}
+
+    @staticmethod
+    def from_dataset(inst_ds):
+        inventory = inst_ds.get_inventory()
+        evidence = []
+        senses = []
         inst_ids = []
-        target_batch = []
-        evidence_batch = []
-        response_batch = []
-        zones = []
-        for i in self.desired_ids:
-            inst_ids.append(self.inst_ds[i].inst_id)
-            target_batch.append(self.inst_ds[i].get_target())
-            evidence_batch.append(self.inst_ds[i].get_embedding('embed'))
-            response_batch.append(self.sense_id(self.inst_ds[i].sense))
-            lemma = self.inst_ds[i].sense.split("%")[0]
-            zones.append(self.inventory.sense_range(lemma))
-            if len(evidence_batch) == self.batch_size:
-                yield (inst_ids,
-                       target_batch, 
-                       torch.tensor(evidence_batch), 
-                       torch.tensor(response_batch),
-                       zones)                
-                inst_ids = []
-                target_batch = []
-                evidence_batch = []
-                response_batch = []
-                zones = []
-        if len(inst_ids) > 0:
-            yield (inst_ids,
-                   target_batch, 
-                   torch.tensor(evidence_batch), 
-                   torch.tensor(response_batch),
-                   zones)
+        for i in range(len(inst_ds)):
+            inst_id, sense, embedding = inst_ds.instance(i)
+            evidence.append(embedding)
+            senses.append(sense)
+            inst_ids.append(inst_id)
+        sense_ids = inventory.sense_id_tensor(senses)
+        zone_starts, zone_stops = inventory.zone_tensors(sense_ids)
+        return CompiledSenseInstances(torch.stack(evidence), sense_ids,
+                                      zone_starts, zone_stops, inst_ids,
+                                      inventory.sense_lemmas(sense_ids), inventory)
+
+    @staticmethod
+    def from_dataset_cached(inst_ds, filename):
+        """
+        Loads the compiled table from filename if it was compiled from the
+        same data as inst_ds (i.e. has the same fingerprint); otherwise 
+        compiles inst_ds and saves the result to filename.
+        
+        """
+        fingerprint = CompiledSenseInstances.fingerprint(inst_ds)
+        if os.path.exists(filename):
+            result = CompiledSenseInstances.load(filename, inst_ds.get_inventory(),
+                                                 fingerprint)
+            if result is not None:
+                return result
+        print('Compiling sense instances: {}'.format(filename))
+        result = CompiledSenseInstances.from_dataset(inst_ds)
+        partial_file = filename + '.partial'
+        result.save(partial_file, fingerprint)
+        os.replace(partial_file, filename)
+        return result
+
+
+class CompiledSenseInstanceLoader(Loader):
+    """
+    Batches a CompiledSenseInstances table, yielding packages in the same 
+    format as a SenseInstanceLoader.
+    
+    """
+    def __init__(self, table, batch_size, desired_ids = None, shuffle = False, 
+                 num_workers = 0, prefetch = 0, seed = None):
+        super().__init__(batch_size, shuffle, num_workers, prefetch, seed)
+        self.table = table
+        if desired_ids is None:
+            self.desired_ids = list(range(len(self.table)))
+        else:
+            self.desired_ids = list(desired_ids)
+        self.n_insts = len(self.desired_ids)
+        self.inventory = self.table.get_inventory()
+
+    def get_instance_dataset(self):
+        return self.table
+
+    def get_inventory(self):
+        return self.inventory
+
+    def sense_id(self, sense):
+        return self.inventory.sense_id(sense)
             
+    def num_senses(self):
+        return self.inventory.num_senses()
+    
+    def sense(self, sense_id):
+        return self.inventory.sense(sense_id)
+
+    def collate(self, indices):
+        batch = torch.tensor(indices, dtype=torch.long)
+        return ([self.table.inst_ids[i] for i in indices],
+                [self.table.targets[i] for i in indices],
+                self.table.evidence[batch],
+                self.table.sense_ids[batch],
+                self.table.zones(batch))
+
+    def pin(self, batch):
+        return pin_evidence(batch)
+
+
 class TwinSenseInstanceLoader(Loader):
-    def __init__(self, inst_ds, batch_size, desired_ids = None):
-        self.inst_ds1 = inst_ds
-        self.inventory = self.inst_ds1.get_inventory()
-        self.inst_ds2 = inst_ds.duplicate()
-        self.inst_loader1 = SenseInstanceLoader(self.inst_ds1, batch_size, desired_ids)
-        self.inst_loader2 = SenseInstanceLoader(self.inst_ds2, batch_size, desired_ids)
-        assert(len(self.inst_loader1) == len(self.inst_loader2), "two loaders have unequal length.")
+    """
+    Yields pairs of batches, drawn from two independent permutations of the
+    same instances, for pairwise training. 
+    
+    The instances (either a CompiledSenseInstances table or a 
+    SenseInstanceDataset, which gets compiled) are held in a single table 
+    that both views share, so an epoch costs no more vector I/O than a 
+    single-style epoch.
+    
+    """
+    def __init__(self, instances, batch_size, desired_ids = None, shuffle = None,
+                 num_workers = 0, prefetch = 0, seed = None):
+        if isinstance(instances, CompiledSenseInstances):
+            self.table = instances
+            if shuffle is None:
+                shuffle = True
+        else:
+            self.table = CompiledSenseInstances.from_dataset(instances)
+            if shuffle is None:
+                shuffle = instances.randomize_sents
+        self.inventory = self.table.get_inventory()
+        seed2 = None if seed is None else '{}/twin'.format(seed)
+        self.inst_loader1 = CompiledSenseInstanceLoader(self.table, batch_size, 
+                                                        desired_ids, shuffle, 
+                                                        num_workers, prefetch, seed)
+        self.inst_loader2 = CompiledSenseInstanceLoader(self.table, batch_size, 
+                                                        desired_ids, shuffle, 
+                                                        num_workers, prefetch, seed2)
 
     def get_instance_dataset(self):
-        return self.inst_ds1
+        return self.table
 
     def get_inventory(self):
         return self.inventory
@@ -364,6 +921,10 @@ class TwinSenseInstanceLoader(Loader):
     def __len__(self):
         return len(self.inst_loader1)
 
+    @property
+    def wait_time(self):
+        return self.inst_loader1.wait_time + self.inst_loader2.wait_time
+
     def __iter__(self):
         for pkg1, pkg2 in zip(self.inst_loader1, self.inst_loader2):
             yield pkg1, pkg2
@@ -1,7 +1,9 @@
 from reed_wsd.mnist.model import BasicFFN, AbstainingFFN, ConfidenceFFN
 from reed_wsd.allwords.wordsense import SenseInstanceDataset, SenseTaggedSentences, SenseInstanceLoader, TwinSenseInstanceLoader
-from reed_wsd.allwords.vectorize import DiskBasedVectorManager
-from reed_wsd.allwords.blevins import BEMDataset, BEMLoader
+from reed_wsd.allwords.wordsense import CompiledSenseInstances, CompiledSenseInstanceLoader
+from reed_wsd.allwords.vectorize import open_vector_manager
+from reed_wsd.allwords.blevins import BEMDataset, BEMLoader, GlossCache
+from reed_wsd.allwords.wordnet import ExampleIndex
 from reed_wsd.allwords.model import SingleLayerFFNWithZones, AbstainingSingleLayerFFNWithZones, BEMforWSD
 from reed_wsd.mnist.train import MnistSimpleDecoder
 from reed_wsd.mnist.train import MnistAbstainingDecoder
@@ -23,6 +25,7 @@ import copy
 import sys
 from functools import reduce
 from trustscore import TrustScore
+from transformers import BertTokenizer
 from reed_wsd.util import logger_config, log
 from datetime import datetime
 import statistics
@@ -114,6 +117,11 @@ class TaskFactory:
             assert(config['architecture'] == 'abstaining')
 
         self.config = config
+
+    def loader_options(self):
+        return {'num_workers': self.config.get('num_workers', 0),
+                'prefetch': self.config.get('prefetch', 0),
+                'seed': self.config.get('seed')}
     
     def train_loader_factory(self):
         raise NotImplementedError("Cannot call on abstract class.")
@@ -221,23 +229,39 @@ class AllwordsTaskFactory(TaskFactory):
 
 
     @staticmethod
-    def init_loader(stage, architecture, style, corpus_id, bsz):
+    def init_loader(stage, architecture, style, corpus_id, bsz, cache_bytes=None,
+                    options={}, group_sents=False):
         data_dir = allwords_data_dir
-        filename = join(data_dir, 'raganato.json')
-        sents = SenseTaggedSentences.from_json(filename, corpus_id)
+        sents = SenseTaggedSentences.from_data_dir(data_dir, corpus_id)
         if architecture == "bem":
-            ds = BEMDataset(sents)
-            loader = BEMLoader(ds, bsz)
+            tknz = BertTokenizer.from_pretrained('bert-base-uncased')
+            example_index = ExampleIndex.from_file(join(data_dir, 'wn_examples.json'), tknz)
+            gloss_cache = GlossCache.from_file(join(data_dir, 'gloss_cache.pt'), tknz,
+                                               example_index)
+            ds = BEMDataset(sents, gloss_cache=gloss_cache)
+            if ds.build_gloss_cache() > 0:
+                gloss_cache.save()
+            if example_index.n_added > 0:
+                example_index.save()
+            loader = BEMLoader(ds, bsz, group_sents=group_sents, **options)
         if architecture == 'simple' or architecture == 'abstaining': 
-            vecmgr = DiskBasedVectorManager(join(join(data_dir, 'vecs'), corpus_id))
+            vec_dir = join(join(data_dir, 'vecs'), corpus_id)
+            vecmgr = open_vector_manager(vec_dir, cache_bytes)
             ds = SenseInstanceDataset(sents, vecmgr)
-            if stage == 'train':
-                if style == 'single':
-                    loader = SenseInstanceLoader(ds, batch_size=bsz)
-                if style == 'pairwise':
-                    loader = TwinSenseInstanceLoader(ds, batch_size=bsz)
-            if stage == 'test':
-                loader = SenseInstanceLoader(ds, batch_size=bsz)
+            pairwise = (stage == 'train' and style == 'pairwise')
+            if cache_bytes is not None and not pairwise:
+                # stream the vectors through the cache instead of compiling them
+                loader = SenseInstanceLoader(ds, batch_size=bsz, 
+                                             shuffle=(stage == 'train'), **options)
+            else:
+                table = CompiledSenseInstances.from_dataset_cached(ds, join(vec_dir, 'compiled.pt'))
+                if pairwise:
+                    loader = TwinSenseInstanceLoader(table, batch_size=bsz, shuffle=True,
+                                                     **options)
+                else:
+                    loader = CompiledSenseInstanceLoader(table, batch_size=bsz, 
+                                                         shuffle=(stage == 'train'),
+                                                         **options)
         return loader
         
     def train_loader_factory(self):
@@ -247,7 +271,10 @@ class AllwordsTaskFactory(TaskFactory):
                                     self.config['architecture'], 
                                     self.config['style'], 
                                     corpus_id_lookup['semcor'],
-                                    self.config['bsz'])
+                                    self.config['bsz'],
+                                    self.config.get('vector_cache_bytes'),
+                                    self.loader_options(),
+                                    self.config.get('group_sents', False))
 
     def val_loader_factory(self):
         if self.config['architecture'] == 'bem' or self.config['architecture'] == 'simple':
@@ -256,9 +283,14 @@ class AllwordsTaskFactory(TaskFactory):
                                     self.config['architecture'], 
                                     self.config['style'], 
                                     corpus_id_lookup[self.config['dev_corpus']],
-                                    self.config['bsz'])
+                                    self.config['bsz'],
+                                    self.config.get('vector_cache_bytes'),
+                                    self.loader_options(),
+                                    self.config.get('group_sents', False))
 
     def decoder_factory(self):
+        if self.config['architecture'] == 'bem' and self.config.get('gloss_bank', False):
+            return AllwordsBEMDecoder(use_bank=True)
         return self._decoder_lookup[self.config['architecture']]()
     
     def model_factory(self, data):
@@ -267,10 +299,13 @@ class AllwordsTaskFactory(TaskFactory):
         else:
             model = self._model_lookup[self.config['architecture']](input_size=768,
                                                                   output_size=data.num_senses(),
-                                                                  zone_applicant=self.config['confidence'])
+                                                                  zone_applicant=self.config['confidence'],
+                                                                  sparse=self.config.get('sparse_head', False))
         return model
  
     def optimizer_factory(self, model):
+        if self.config.get('sparse_head', False) and self.config['architecture'] != 'bem':
+            return optim.SparseAdam(list(model.parameters()), lr=0.001)
         return optim.Adam(model.parameters(), lr=0.001)
  
     def scheduler_factory(self, optimizer):
@@ -302,38 +337,40 @@ class MnistTaskFactory(TaskFactory):
                                 'confidence': MnistSimpleDecoder}
 
     @staticmethod
-    def init_loader(stage, style, confuse, bsz):
+    def init_loader(stage, style, confuse, bsz, options={}):
         if stage == 'train':
             ds = datasets.MNIST(mnist_train_dir, download=True, train=True, transform=transform)
             if style == 'single':
                 if confuse != False:
-                    loader = ConfusedMnistLoader(ds, bsz, confuse, shuffle=True)
+                    loader = ConfusedMnistLoader(ds, bsz, confuse, shuffle=True, **options)
                 else:
-                    loader = MnistLoader(ds, bsz, shuffle=True)
+                    loader = MnistLoader(ds, bsz, shuffle=True, **options)
             if style == 'pairwise':
                 if confuse != False:
-                    loader = ConfusedMnistPairLoader(ds, bsz, confuse, shuffle=True)
+                    loader = ConfusedMnistPairLoader(ds, bsz, confuse, shuffle=True, **options)
                 else:
-                    loader = MnistPairLoader(ds, bsz, shuffle=True)
+                    loader = MnistPairLoader(ds, bsz, shuffle=True, **options)
         if stage == 'test':
             ds = datasets.MNIST(mnist_test_dir, download=True, train=False, transform=transform)
             if confuse != False:
-                loader = ConfusedMnistLoader(ds, bsz, confuse, shuffle=True)
+                loader = ConfusedMnistLoader(ds, bsz, confuse, shuffle=True, **options)
             else:
-                loader = MnistLoader(ds, bsz, shuffle=True)
+                loader = MnistLoader(ds, bsz, shuffle=True, **options)
         return loader
         
     def train_loader_factory(self):
         return MnistTaskFactory.init_loader('train', 
                                             self.config['style'], 
                                             self.config['confuse'], 
-                                            self.config['bsz'])
+                                            self.config['bsz'],
+                                            self.loader_options())
     
     def val_loader_factory(self):
         return MnistTaskFactory.init_loader('test', 
                                             self.config['style'], 
                                             self.config['confuse'], 
-                                            self.config['bsz'])
+                                            self.config['bsz'],
+                                            self.loader_options())
 
     def decoder_factory(self):
         return self._decoder_lookup[self.config['architecture']]()
@@ -374,15 +411,15 @@ class IMDBTaskFactory(TaskFactory):
         ds = IMDBDataset.from_json(join(imdb_dir, 'data/aclImdb/imdb.json'), 'train')
         bsz = self.config['bsz']
         if self.config['style'] == 'single':
-            loader = IMDBLoader(ds, bsz, shuffle=True)
+            loader = IMDBLoader(ds, bsz, shuffle=True, **self.loader_options())
         if self.config['style'] == 'pairwise':
-            loader = IMDBTwinLoader(ds, bsz)
+            loader = IMDBTwinLoader(ds, bsz, **self.loader_options())
         return loader
 
     def val_loader_factory(self):
         ds = IMDBDataset.from_json(join(imdb_dir, 'data/aclImdb/imdb.json'), 'test')
         bsz = self.config['bsz']
-        loader = IMDBLoader(ds, bsz, shuffle=True)
+        loader = IMDBLoader(ds, bsz, shuffle=True, **self.loader_options())
         return loader
 
     def decoder_factory(self):
@@ -3,6 +3,7 @@ import json
 from torch.utils.data import Dataset
 import random
 import math
+from reed_wsd.loader import Loader
 
 class IMDBDataset(Dataset):
     def __init__(self, data):
@@ -23,44 +24,37 @@ class IMDBDataset(Dataset):
         return len(self.ds)
 
 
-class IMDBLoader:
-    def __init__(self, dataset, bsz, shuffle=True):
+class IMDBLoader(Loader):
+    def __init__(self, dataset, bsz, shuffle=True, num_workers=0, prefetch=0,
+                 seed=None):
+        super().__init__(bsz, shuffle, num_workers, prefetch, seed)
         self.ds = dataset
         self.bsz = bsz
-        self.index_list = list(range(len(self.ds)))
-        self.shuffle = shuffle
-        if self.shuffle:
-            random.shuffle(self.index_list)
+        self.desired_ids = list(range(len(self.ds)))
 
-    def __len__(self):
-        return math.ceil(len(self.ds) / self.bsz)
-        
-    def __iter__(self):
-        evidence_batch = []
-        gold_batch = []
-        for i in self.index_list:
-            evidence = self.ds[i]['vec']
-            gold = self.ds[i]['gold']
-            evidence_batch.append(evidence)
-            gold_batch.append(gold)
-            if len(evidence_batch) == self.bsz:
-                yield torch.tensor(evidence_batch), torch.tensor(gold_batch)
-                evidence_batch = []
-                gold_batch = []
-        if len(evidence_batch) > 0:
-            yield torch.tensor(evidence_batch), torch.tensor(gold_batch)
+    def collate(self, indices):
+        evidence_batch = [self.ds[i]['vec'] for i in indices]
+        gold_batch = [self.ds[i]['gold'] for i in indices]
+        return torch.tensor(evidence_batch), torch.tensor(gold_batch)
 
 
 class IMDBTwinLoader:
-    def __init__(self, dataset, bsz):
+    def __init__(self, dataset, bsz, num_workers=0, prefetch=0, seed=None):
         self.ds = dataset
         self.bsz = bsz
-        self.loader1 = IMDBLoader(self.ds, self.bsz, shuffle=True)
-        self.loader2 = IMDBLoader(self.ds, self.bsz, shuffle=True)
+        seed2 = None if seed is None else '{}/twin'.format(seed)
+        self.loader1 = IMDBLoader(self.ds, self.bsz, True, num_workers, 
+                                  prefetch, seed)
+        self.loader2 = IMDBLoader(self.ds, self.bsz, True, num_workers,
+                                  prefetch, seed2)
         assert(len(self.loader1) == len(self.loader2))
 
     def __len__(self):
-        return len(self.ds) // self.bsz + 1
+        return len(self.loader1)
+
+    @property
+    def wait_time(self):
+        return self.loader1.wait_time + self.loader2.wait_time
 
     def __iter__(self):
         for pkg1, pkg2 in zip(self.loader1, self.loader2):
@@ -68,6 +62,3 @@ class IMDBTwinLoader:
             evidence_batch2, gold_batch2 = pkg2
             yield (evidence_batch1, evidence_batch2,
                    gold_batch1, gold_batch2) 
-
-            
-        
@@ -1,6 +1,234 @@
+import math
+import time
+import queue
+import random
+import threading
+import weakref
+from collections import deque
+import torch
+import torch.multiprocessing as torch_mp
+
+
 class Loader:
-    def __iter__(self):
+    """
+    The batching engine shared by the task loaders. A child class sets
+    self.desired_ids (the dataset indices it serves) and implements
+    collate, which builds a batch from a list of those indices.
+
+    Each epoch (i.e. each call to __iter__):
+        - the sampler orders self.desired_ids; by default they are shuffled
+          if self.shuffle is True. If a seed was given, the order of epoch e
+          is drawn from a generator seeded with (seed, e), so that runs are
+          reproducible
+        - if num_workers > 0, batches are collated in that many worker
+          processes, with up to num_workers + prefetch batches in flight.
+          The worker pool is started on the first epoch and kept until
+          close() is called (or the loader is garbage collected), so the
+          workers see the loader as it was when the pool started. Tensors
+          come back from the workers through shared memory (as with torch's
+          DataLoader), and the statistics a child class gathers while 
+          collating (see worker_stats) are merged into the main process
+        - otherwise, if prefetch > 0, batches are collated on a background
+          thread, which keeps up to prefetch batches ready
+        - each batch then goes through pin (in the main process, or on the
+          prefetch thread), which a child class can override to pin its
+          tensors; CUDA must not be used in the forked workers
+        - the time spent waiting for batches is kept in self.wait_time
+
+    """
+    def __init__(self, batch_size, shuffle=False, num_workers=0, prefetch=0,
+                 seed=None, sampler=None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.seed = seed
+        self.sampler = sampler if sampler is not None else shuffle_sampler
+        self.epoch = 0
+        self.wait_time = 0.0
+        self.pool = None
+
+    def collate(self, indices):
         raise NotImplementedError("This feature needs to be implemented in the child class.")
 
+    def pin(self, batch):
+        return batch
+
+    def worker_stats(self):
+        """
+        Called in a worker process after each batch it collates. Returns
+        the statistics gathered since the previous call (e.g. cache hits),
+        which are passed to merge_worker_stats in the main process, or 
+        None if there are none.
+        
+        """
+        return None
+
+    def merge_worker_stats(self, stats):
+        pass
+
+    def worker_pool(self):
+        if self.pool is None:
+            self.pool = torch_mp.Pool(self.num_workers, initializer=_init_worker,
+                                      initargs=(self,))
+            weakref.finalize(self, self.pool.terminate)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
     def __len__(self):
-        raise NotImplementedError("This feature needs to be implemented in the child class.")
+        return math.ceil(len(self.desired_ids) / self.batch_size)
+
+    def epoch_rng(self, epoch):
+        if self.seed is None:
+            return random.Random()
+        return random.Random('{}/{}'.format(self.seed, epoch))
+
+    def epoch_batches(self):
+        """
+        Returns the index lists of the batches of the next epoch.
+
+        """
+        order = self.sampler(list(self.desired_ids), self.shuffle,
+                             self.epoch_rng(self.epoch))
+        self.epoch += 1
+        return [order[i:i + self.batch_size]
+                for i in range(0, len(order), self.batch_size)]
+
+    def __iter__(self):
+        batch_indices = self.epoch_batches()
+        if self.num_workers > 0:
+            batches = (self.pin(batch) for batch in 
+                       collate_in_workers(self, batch_indices, self.epoch - 1))
+        else:
+            batches = (self.pin(self.collate(indices)) for indices in batch_indices)
+            if self.prefetch > 0:
+                batches = prefetch(batches, self.prefetch)
+        return timed(batches, self)
+
+    def __getstate__(self):
+        # worker processes only need what collate uses
+        state = self.__dict__.copy()
+        state['sampler'] = None
+        state['pool'] = None
+        return state
+
+
+def shuffle_sampler(indices, shuffle, rng):
+    if shuffle:
+        rng.shuffle(indices)
+    return indices
+
+
+_worker_loader = None
+
+def _init_worker(loader):
+    global _worker_loader
+    _worker_loader = loader
+    torch.set_num_threads(1)
+
+def _collate_in_worker(args):
+    (indices, seed) = args
+    if seed is not None:
+        # collate functions that sample (e.g. label confusers) stay reproducible
+        random.seed(seed)
+        torch.manual_seed(seed)
+    return _worker_loader.collate(indices), _worker_loader.worker_stats()
+
+def collate_in_workers(loader, batch_indices, epoch):
+    """
+    Collates the batches in the loader's worker pool, yielding them in
+    order. At most num_workers + prefetch batches are in flight at once.
+
+    """
+    max_pending = loader.num_workers + max(loader.prefetch, 1)
+    pool = loader.worker_pool()
+    pending = deque()
+    for (batch_number, indices) in enumerate(batch_indices):
+        seed = None
+        if loader.seed is not None:
+            seed = random.Random('{}/{}/{}'.format(loader.seed, epoch, 
+                                                   batch_number)).getrandbits(32)
+        pending.append(pool.apply_async(_collate_in_worker, ((indices, seed),)))
+        if len(pending) >= max_pending:
+            yield _worker_result(loader, pending.popleft())
+    while len(pending) > 0:
+        yield _worker_result(loader, pending.popleft())
+
+def _worker_result(loader, pending_result):
+    (batch, stats) = pending_result.get()
+    if stats is not None:
+        loader.merge_worker_stats(stats)
+    return batch
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(batches, num_ready):
+    """
+    Iterates through batches on a background thread, keeping at most
+    num_ready finished batches waiting in a queue. Errors raised while
+    producing a batch are re-raised by the consumer.
+
+    """
+    ready = queue.Queue(maxsize=num_ready)
+    finished = object()
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if not put(batch):
+                    return
+            put(finished)
+        except Exception as error:
+            put(_Failure(error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is finished:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        # lets the producer exit if the consumer stops early
+        stopped.set()
+
+
+def timed(batches, loader):
+    """
+    Yields the elements of batches, accumulating the time spent waiting for
+    each one in loader.wait_time (which is reset at the start of the
+    iteration, i.e. once per epoch).
+
+    """
+    loader.wait_time = 0.0
+    batches = iter(batches)
+    while True:
+        start = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return
+        finally:
+            loader.wait_time += time.perf_counter() - start
+        yield batch
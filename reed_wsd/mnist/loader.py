@@ -1,4 +1,5 @@
 import torch
+from reed_wsd.loader import Loader
 
 def confuse_two(labels):
     labels = labels.clone()
@@ -36,56 +37,65 @@ def confuse_all(labels):
 confuser_lookup = {'two': confuse_two,
                    'all': confuse_all}
 
-class MnistLoader:
+def identity(labels):
+    return labels
+
+
+class MnistLoader(Loader):
     
-    def __init__(self, dataset, bsz=64, shuffle = True, confuser = lambda x: x):
-        self.loader = torch.utils.data.DataLoader(dataset, 
-                                                  batch_size=bsz, 
-                                                  shuffle=shuffle)
+    def __init__(self, dataset, bsz=64, shuffle = True, confuser = identity,
+                 num_workers = 0, prefetch = 0, seed = None):
+        super().__init__(bsz, shuffle, num_workers, prefetch, seed)
+        self.dataset = dataset
+        self.desired_ids = list(range(len(dataset)))
         self.confuser = confuser
         
-    def __iter__(self):
-        for images, labels in self.loader:
-            images = images.view(images.shape[0], -1)
-            labels = self.confuser(labels)
-            yield images, labels
+    def collate(self, indices):
+        images, labels = zip(*[self.dataset[i] for i in indices])
+        images = torch.stack(images)
+        images = images.view(images.shape[0], -1)
+        labels = self.confuser(torch.tensor(labels))
+        return images, labels
 
-    def __len__(self):
-        return len(self.loader)
     
 class ConfusedMnistLoader(MnistLoader):
     
-    def __init__(self, dataset, bsz=64, confuser='all', shuffle=True):
-        super().__init__(dataset, bsz, shuffle, confuser_lookup[confuser])
+    def __init__(self, dataset, bsz=64, confuser='all', shuffle=True,
+                 num_workers = 0, prefetch = 0, seed = None):
+        super().__init__(dataset, bsz, shuffle, confuser_lookup[confuser],
+                         num_workers, prefetch, seed)
         
         
     
 class MnistPairLoader:
-    def __init__(self, dataset, bsz=64, shuffle=True, confuser=lambda x:x):
+    def __init__(self, dataset, bsz=64, shuffle=True, confuser=identity,
+                 num_workers = 0, prefetch = 0, seed = None):
         self.bsz = bsz
         self.dataset = dataset
-        self.single_img_loader1 = torch.utils.data.DataLoader(dataset, 
-                                                              batch_size=bsz, 
-                                                              shuffle=True)
-        self.single_img_loader2 = torch.utils.data.DataLoader(dataset, 
-                                                              batch_size=bsz, 
-                                                              shuffle=True)
+        seed2 = None if seed is None else '{}/twin'.format(seed)
+        self.single_img_loader1 = MnistLoader(dataset, bsz, True, confuser,
+                                              num_workers, prefetch, seed)
+        self.single_img_loader2 = MnistLoader(dataset, bsz, True, confuser,
+                                              num_workers, prefetch, seed2)
         assert(len(self.single_img_loader1) == len(self.single_img_loader2))
         self.confuser = confuser
     
     def __len__(self):
         return len(self.single_img_loader1)
+
+    @property
+    def wait_time(self):
+        return (self.single_img_loader1.wait_time + 
+                self.single_img_loader2.wait_time)
+
     def __iter__(self):
         for ((imgs1, lbls1), (imgs2, lbls2)) in zip(self.single_img_loader1, 
                                                     self.single_img_loader2):
-            lbls1 = self.confuser(lbls1)
-            lbls2 = self.confuser(lbls2)
-            imgs1 = imgs1.view(imgs1.shape[0], -1)
-            imgs2 = imgs2.view(imgs2.shape[0], -1)
             yield imgs1, imgs2, lbls1, lbls2
 
 class ConfusedMnistPairLoader(MnistPairLoader):
-    def __init__(self, dataset, bsz=64, confuser='all', shuffle=True):
-        super().__init__(dataset, bsz, shuffle, confuser_lookup[confuser])
+    def __init__(self, dataset, bsz=64, confuser='all', shuffle=True,
+                 num_workers = 0, prefetch = 0, seed = None):
+        super().__init__(dataset, bsz, shuffle, confuser_lookup[confuser],
+                         num_workers, prefetch, seed)
             
-
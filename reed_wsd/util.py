@@ -38,6 +38,55 @@ def entropy(tensor):
     entropy = (surprise * tensor).sum(-1)
     return entropy
 
+def zone_bounds(zones, device=None):
+    """
+    Converts zones (a list of (start, stop) pairs, or a long tensor of 
+    shape [batch, 2]) into a tensor of starts and a tensor of stops.
+    
+    """
+    if not torch.is_tensor(zones):
+        zones = torch.tensor(zones, dtype=torch.long).view(-1, 2)
+    zones = zones.to(device)
+    return zones[:, 0], zones[:, 1]
+
+def local_zones(zones, device=None):
+    """
+    Returns the zones of compact outputs, whose columns only cover each
+    row's zone: [0, stop - start) for each (start, stop) zone.
+    
+    """
+    starts, stops = zone_bounds(zones, device)
+    return torch.stack([torch.zeros_like(starts), stops - starts], dim=1)
+
+def zone_mask(zones, num_cols, device=None):
+    """
+    Returns a boolean tensor of shape [batch, num_cols] which is True
+    exactly at the columns [start, stop) of each row's zone.
+    
+    """
+    starts, stops = zone_bounds(zones, device)
+    cols = torch.arange(num_cols, device=device).unsqueeze(0)
+    return (cols >= starts.unsqueeze(1)) & (cols < stops.unsqueeze(1))
+
+def apply_zone_mask(input_vec, zones, fill_value=float('-inf')):
+    """
+    Replaces every entry of input_vec outside its row's zone with 
+    fill_value.
+    
+    """
+    mask = zone_mask(zones, input_vec.shape[1], input_vec.device)
+    return input_vec.masked_fill(~mask, fill_value)
+
+def length_buckets(lengths, batch_size):
+    """
+    Groups the indices of lengths into batches of at most batch_size, such
+    that each batch holds sequences of similar length (and therefore needs
+    little padding).
+    
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
 def logger_config(outfile):
     if outfile is None:
         logging.basicConfig(format="%(message)s", level=logging.INFO)
@@ -1,7 +1,13 @@
 import unittest
 import json
-from reed_wsd.allwords.blevins import BEMDataset, BEMLoader
+import os
+import shutil
+import tempfile
+from os.path import join
+from reed_wsd.allwords.blevins import BEMDataset, BEMLoader, GlossCache, GlossBank
+from reed_wsd.allwords.blevins import pad_contexts
 from reed_wsd.allwords.wordsense import SenseTaggedSentences, SenseInventory
+from reed_wsd.allwords.model import BEMforWSD
 import torch
 
 
@@ -98,6 +104,28 @@ class TestBEMDataset(unittest.TestCase):
         assert(torch.equal(expected_gloss, inst0['glosses_ids']['input_ids']))
         assert(expected_gloss_span == inst0['glosses_ids']['span'])
 
+    def test_gloss_cache(self):
+        ds = BEMDataset(self.sents, randomize_sents=False, gloss='wneg')
+        expected = [ds[i]['glosses_ids'] for i in range(len(ds))]
+        assert ds.build_gloss_cache() == 0
+        assert len(ds.gloss_cache) == 3
+        root_dir = tempfile.mkdtemp()
+        try:
+            filename = join(root_dir, 'gloss_cache.pt')
+            ds.gloss_cache.save(filename)
+            cache = GlossCache.from_file(filename, ds.tknz)
+            assert len(cache) == 3
+            assert cache.entries[('be', 'wneg', 'was')]['span'] == [[6, 7]]
+            ds = BEMDataset(self.sents, randomize_sents=False, gloss='wneg',
+                            gloss_cache=cache)
+            for i in range(len(ds)):
+                glosses_ids = ds[i]['glosses_ids']
+                assert(torch.equal(expected[i]['input_ids'], glosses_ids['input_ids']))
+                assert(expected[i]['span'] == glosses_ids['span'])
+            assert cache.n_added == 0
+        finally:
+            shutil.rmtree(root_dir)
+
     def test_BEMLoader(self):
         ds = BEMDataset(self.sents, randomize_sents = False)
         loader = BEMLoader(ds, batch_size = 3)
@@ -130,9 +158,98 @@ class TestBEMDataset(unittest.TestCase):
         assert(expected_span == pkg['span'])
         assert(expected_gold == pkg['gold'])
 
-        
+    def test_BEMLoader_group_sents(self):
+        ds = BEMDataset(self.sents, randomize_sents = False)
+        loader = BEMLoader(ds, batch_size = 3, group_sents = True)
+        pkg = next(iter(loader))
+        expected_contexts = torch.tensor(
+                             [[101, 2009, 2001, 1037, 7071, 999, 102, 0, 0, 0],
+                              [101, 2002, 2001, 4191, 1035, 2125, 1996, 3898, 1012, 102]])
+        assert(torch.equal(expected_contexts, pkg['contexts']['input_ids']))
+        assert(pkg['context_rows'] == [0, 1, 1])
+        assert(pkg['span'] == [[2, 3], [3, 6], [7, 8]])
+        loader = BEMLoader(ds, batch_size = 3, shuffle = True, group_sents = True)
+        for _ in range(5):
+            pkg = next(iter(loader))
+            assert(pkg['contexts']['input_ids'].shape[0] == 2)
+            assert(sorted(pkg['context_rows']) in [[0, 1, 1], [0, 0, 1]])
+
+    def test_pad_contexts(self):
+        contexts = pad_contexts([torch.tensor([101, 2009, 102]),
+                                 torch.tensor([101, 2002, 2001, 3898, 102])], 0)
+        assert contexts['input_ids'].tolist() == [[101, 2009, 102, 0, 0],
+                                                  [101, 2002, 2001, 3898, 102]]
+        assert contexts['attention_mask'].tolist() == [[1, 1, 1, 0, 0],
+                                                       [1, 1, 1, 1, 1]]
+        assert contexts['token_type_ids'].tolist() == [[0] * 5, [0] * 5]
+
+
+class GlossOnlyDataset:
+    """
+    Provides what GlossBank.build needs from a BEMDataset, with one-token
+    glosses (so that 'screen%2' and 'be%1' share a gloss).
+    
+    """
+    GLOSS_IDS = {'be%1': 7, 'be%2': 8, 'be%3': 9, 'laugh_off%1': 10,
+                 'screen%1': 11, 'screen%2': 7}
+
+    def __init__(self, inv, lemmas, gloss='defn_cls'):
+        self.inv = inv
+        self.lemmas = lemmas
+        self.gloss = gloss
+        self.gloss_cache = self
+
+    def get_inventory(self):
+        return self.inv
+
+    def instance_lemmas(self):
+        return self.lemmas
+
+    def glosses(self, lemma, senses, gloss, wordform=None):
+        ids = [[GlossOnlyDataset.GLOSS_IDS[sense]] for sense in senses]
+        return {'input_ids': torch.tensor(ids),
+                'attention_mask': torch.ones(len(ids), 1, dtype=torch.long),
+                'span': [[0, 1]] * len(ids)}
+
+
+class FirstTokenEncoder:
+    """
+    Encodes a gloss as its first token id and its negation, counting the
+    glosses it encodes.
+    
+    """
+    encode_batch_glosses = BEMforWSD.encode_batch_glosses
+
+    def __init__(self):
+        self.gloss_chunk_size = 2
+        self.n_encoded = 0
+
+    def encode_glosses(self, g):
+        self.n_encoded += len(g['input_ids'])
+        first = g['input_ids'][:, :1].float()
+        return torch.cat([first, -first], dim=1)
+
 
+class TestGlossBank(unittest.TestCase):
+    def test_gloss_bank(self):
+        inv = SenseInventory({'be': ['be%1', 'be%2', 'be%3'],
+                              'laugh_off': ['laugh_off%1'],
+                              'screen': ['screen%1', 'screen%2']})
+        ds = GlossOnlyDataset(inv, ['be', 'screen'])
+        assert GlossBank.supports(ds)
+        encoder = FirstTokenEncoder()
+        bank = GlossBank.build(encoder, ds)
+        assert encoder.n_encoded == 4
+        assert bank.matrix.shape == (4, 2)
+        assert bank.rows[inv.sense_id('laugh_off%1')].item() == -1
+        target_reps = torch.tensor([[1.0, 0.0], [0.0, 1.0]])
+        scores = bank.score(target_reps, [[4, 6], [0, 3]])
+        assert scores.tolist() == [[11.0, 7.0, float('-inf')],
+                                   [-7.0, -8.0, -9.0]]
 
+    def test_gloss_bank_wneg(self):
+        inv = SenseInventory({'be': ['be%1', 'be%2', 'be%3']})
+        assert not GlossBank.supports(GlossOnlyDataset(inv, ['be'], gloss='wneg'))
         
 if __name__ == "__main__":
 	unittest.main()
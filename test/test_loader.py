@@ -0,0 +1,145 @@
+import unittest
+import os
+import time
+import random
+from reed_wsd.loader import Loader, prefetch, timed
+
+
+class Counter:
+    pass
+
+
+class RangeLoader(Loader):
+    """
+    Serves the integers 0 to n - 1, tagging each with a random draw so that
+    the seeding of collate can be checked.
+
+    """
+    def __init__(self, n, batch_size, **kwargs):
+        super().__init__(batch_size, **kwargs)
+        self.desired_ids = list(range(n))
+
+    def collate(self, indices):
+        return [(i, random.random()) for i in indices]
+
+
+class PinLoader(RangeLoader):
+    """
+    Tags each batch with the process that collated it and the process
+    that pinned it.
+
+    """
+    def collate(self, indices):
+        return (indices, os.getpid())
+
+    def pin(self, batch):
+        return batch + (os.getpid(),)
+
+
+class StatsLoader(RangeLoader):
+    """
+    Counts the batches each process collates, and merges the counts of
+    the workers.
+
+    """
+    def __init__(self, n, batch_size, **kwargs):
+        super().__init__(n, batch_size, **kwargs)
+        self.n_collated = 0
+
+    def collate(self, indices):
+        self.n_collated += 1
+        return indices
+
+    def worker_stats(self):
+        result = self.n_collated
+        self.n_collated = 0
+        return result
+
+    def merge_worker_stats(self, stats):
+        self.n_collated += stats
+
+
+class TestLoader(unittest.TestCase):
+
+    def test_prefetch(self):
+        assert list(prefetch(iter(range(10)), 3)) == list(range(10))
+
+    def test_prefetch_error(self):
+        def batches():
+            yield 1
+            raise ValueError('simulated failure')
+        result = prefetch(batches(), 2)
+        assert next(result) == 1
+        with self.assertRaises(ValueError):
+            next(result)
+
+    def test_prefetch_early_stop(self):
+        result = prefetch(iter(range(1000)), 2)
+        assert next(result) == 0
+        result.close()
+
+    def test_timed(self):
+        def batches():
+            for i in range(3):
+                time.sleep(0.01)
+                yield i
+        counter = Counter()
+        assert list(timed(batches(), counter)) == [0, 1, 2]
+        assert counter.wait_time >= 0.03
+        assert list(timed([], counter)) == []
+        assert counter.wait_time < 0.01
+
+    def test_loader_batches(self):
+        loader = RangeLoader(5, 2)
+        assert len(loader) == 3
+        batches = [[i for (i, _) in batch] for batch in loader]
+        assert batches == [[0, 1], [2, 3], [4]]
+        assert loader.epoch == 1
+
+    def test_loader_seeded_shuffle(self):
+        def epochs(loader):
+            return [[i for batch in loader for (i, _) in batch] for _ in range(2)]
+        first = epochs(RangeLoader(20, 3, shuffle=True, seed=7))
+        assert first == epochs(RangeLoader(20, 3, shuffle=True, seed=7))
+        assert first[0] != first[1]
+        assert sorted(first[0]) == list(range(20))
+        assert first != epochs(RangeLoader(20, 3, shuffle=True, seed=8))
+
+    def test_loader_workers(self):
+        serial = list(RangeLoader(20, 3, shuffle=True, seed=7))
+        parallel = list(RangeLoader(20, 3, shuffle=True, seed=7, 
+                                    num_workers=2, prefetch=1))
+        assert [[i for (i, _) in batch] for batch in serial] == \
+               [[i for (i, _) in batch] for batch in parallel]
+        again = list(RangeLoader(20, 3, shuffle=True, seed=7, num_workers=3))
+        assert parallel == again
+
+    def test_loader_persistent_pool(self):
+        loader = PinLoader(10, 3, shuffle=True, seed=7, num_workers=2)
+        first = list(loader)
+        pool = loader.pool
+        second = list(loader)
+        assert loader.pool is pool
+        assert sorted(i for (indices, _, _) in second for i in indices) == list(range(10))
+        assert all(collated != os.getpid() and pinned == os.getpid()
+                   for (_, collated, pinned) in first + second)
+        loader.close()
+        assert loader.pool is None
+
+    def test_loader_worker_stats(self):
+        loader = StatsLoader(10, 3, num_workers=2)
+        assert len(list(loader)) == 4
+        assert len(list(loader)) == 4
+        assert loader.n_collated == 8
+        loader.close()
+
+    def test_loader_prefetch(self):
+        loader = RangeLoader(7, 2, shuffle=True, seed=1, prefetch=2)
+        batches = [[i for (i, _) in batch] for batch in loader]
+        assert batches == [[i for (i, _) in batch] 
+                           for batch in RangeLoader(7, 2, shuffle=True, seed=1)]
+        assert loader.wait_time >= 0.0
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
 import unittest
-from reed_wsd.allwords.model import BEMforWSD
-from reed_wsd.allwords.model import abstention
+from reed_wsd.allwords.model import BEMforWSD, dedupe_glosses
+from reed_wsd.allwords.model import abstention, zero_out_probs
+from reed_wsd.allwords.model import SparseZoneLinear, AbstainingSingleLayerFFNWithZones
+from reed_wsd.allwords.model import SingleLayerFFNWithZones
+from reed_wsd.allwords.evaluate import AllwordsSimpleEmbeddingDecoder
 import torch
 
 class TestBEMforWSD(unittest.TestCase):
@@ -28,6 +31,23 @@ class TestBEMforWSD(unittest.TestCase):
         result = BEMforWSD.target_representation(context_rep, spans)
         assert( torch.equal(result, expected_result))
 
+    def test_target_rep_rows(self):
+        context_rep = torch.tensor([[[1, 2, 3, 4],
+                                     [4, 3, 2, 1],
+                                     [0, 0, 0, 0]],
+                                    [[1, 1, 1, 1],
+                                     [2, 2, 2, 2],
+                                     [3, 3, 3, 3]]]).float()
+        # three spans in sequence 1, one in sequence 0
+        spans = [[1, 3], [0, 2], [0, 1], [2, 3]]
+        rows = [1, 0, 1, 1]
+        expected_result = torch.tensor([[2.5, 2.5, 2.5, 2.5],
+                                        [2.5, 2.5, 2.5, 2.5],
+                                        [1, 1, 1, 1],
+                                        [3, 3, 3, 3]]).float()
+        result = BEMforWSD.target_representation(context_rep, spans, rows)
+        assert( torch.equal(result, expected_result))
+
     def test_forward(self):
         model = BEMforWSD()
         model.eval()
@@ -71,6 +91,27 @@ class TestBEMforWSD(unittest.TestCase):
             scores = model(contexts, glosses, pos)
         assert(scores.allclose(expected_output))
 
+    def test_dedupe_glosses(self):
+        be = {'input_ids': torch.tensor([[101, 1037, 2653, 102],
+                                         [101, 1996, 102, 0]]),
+              'attention_mask': torch.tensor([[1, 1, 1, 1],
+                                              [1, 1, 1, 0]]),
+              'span': [[0, 1], [0, 1]]}
+        be_tgt = {'input_ids': torch.tensor([[101, 1996, 102]]),
+                  'attention_mask': torch.tensor([[1, 1, 1]]),
+                  'span': [[1, 2]]}
+        screen = {'input_ids': torch.tensor([[101, 1996, 102, 0, 0],
+                                             [101, 2051, 1037, 7267, 102]]),
+                  'attention_mask': torch.tensor([[1, 1, 1, 0, 0],
+                                                  [1, 1, 1, 1, 1]])}
+        unique, rows = dedupe_glosses([be, be_tgt, be, screen])
+        assert [(ids.tolist(), span) for (ids, span) in unique] == \
+               [([101, 1037, 2653, 102], [0, 1]),
+                ([101, 1996, 102], [0, 1]),
+                ([101, 1996, 102], [1, 2]),
+                ([101, 2051, 1037, 7267, 102], [0, 1])]
+        assert [r.tolist() for r in rows] == [[0, 1], [2], [0, 1], [1, 3]]
+
 class TestFFN(unittest.TestCase):
     def test_abstention(self):
         input_vec = torch.tensor([[1., 1, 1, 3],
@@ -82,6 +123,79 @@ class TestFFN(unittest.TestCase):
                                    atol=0.0001))
         assert(torch.allclose(confidence, torch.tensor([3., 2]), atol=0.0001))
 
+    def test_zero_out_probs(self):
+        input_vec = torch.tensor([[1., 2, 3, 4],
+                                  [5., 6, 7, 8],
+                                  [9., 10, 11, 12]], requires_grad=True)
+        inf = float('-inf')
+        expected = torch.tensor([[inf, 2, 3, inf],
+                                 [5., inf, inf, inf],
+                                 [inf, inf, inf, 12]])
+        for zones in [[(1, 3), (0, 1), (3, 4)], torch.tensor([[1, 3], [0, 1], [3, 4]])]:
+            result = zero_out_probs(input_vec, zones)
+            assert(torch.equal(result, expected))
+        result.exp().sum().backward()
+        expected_grad = torch.tensor([0, 2., 3, 0]).exp() * torch.tensor([0, 1., 1, 0])
+        assert(torch.allclose(input_vec.grad[0], expected_grad))
+
+    def test_sparse_zone_linear(self):
+        torch.manual_seed(0)
+        sparse_layer = SparseZoneLinear(4, 6, abstain=True)
+        dense_layer = torch.nn.Linear(4, 7)
+        with torch.no_grad():
+            dense_layer.weight.copy_(sparse_layer.weight)
+            dense_layer.bias.copy_(sparse_layer.bias.squeeze(1))
+        input_vec = torch.randn(3, 4)
+        zones = [(1, 3), (0, 1), (3, 6)]
+        result, candidates = sparse_layer(input_vec, zones)
+        assert(candidates.tolist() == [[1, 2, -1, 6], [0, -1, -1, 6], [3, 4, 5, 6]])
+        expected = dense_layer(input_vec).gather(1, candidates.clamp(min=0))
+        expected = expected.masked_fill(candidates < 0, float('-inf'))
+        assert(torch.allclose(result, expected))
+        result[torch.isfinite(result)].sum().backward()
+        assert(sparse_layer.weight.grad.is_sparse)
+        touched = sparse_layer.weight.grad.coalesce().indices()[0].tolist()
+        assert(sorted(touched) == [0, 1, 2, 3, 4, 5, 6])
+        result, _ = sparse_layer(input_vec[:2], zones[:2])
+        assert(result.shape == (2, 3))
+
+    def test_sparse_abstaining_ffn(self):
+        torch.manual_seed(0)
+        model = AbstainingSingleLayerFFNWithZones(4, 6, sparse=True)
+        optimizer = torch.optim.SparseAdam(list(model.parameters()), lr=0.01)
+        zones = torch.tensor([[1, 3], [0, 1]])
+        output, conf = model(torch.randn(2, 4), zones)
+        assert(output.shape == (2, 3))
+        assert(torch.isinf(output[1, 1]))
+        gold = model.output_columns(torch.tensor([1, 0]), zones)
+        assert(gold.tolist() == [0, 0])
+        before = model.linear.weight.detach().clone()
+        output.log_softmax(dim=1)[[0, 1], gold].sum().backward()
+        optimizer.step()
+        changed = (model.linear.weight.detach() != before).any(dim=1)
+        assert(changed.tolist() == [True, True, True, False, False, False, True])
+        assert(model.output_senses(torch.tensor([1, 0]), zones).tolist() == [2, 0])
+
+    def test_sparse_decoder_low_scores(self):
+        model = SingleLayerFFNWithZones(2, 5, sparse=True)
+        with torch.no_grad():
+            model.linear.weight.copy_(torch.tensor([[-100., 0], [-90, 0], 
+                                                    [1, 0], [2, 0], [3, 0]]))
+            model.linear.bias.zero_()
+        # both candidates of the first instance score below the clamp (-25)
+        batch = (['i1', 'i2'], ['a', 'b'], torch.tensor([[1., 0], [1., 0]]),
+                 torch.tensor([1, 4]), [(0, 2), (2, 5)])
+        decoded = AllwordsSimpleEmbeddingDecoder()(model, [batch], None)
+        assert([int(pkg['pred']) for pkg in decoded] == [1, 4])
+
+    def test_dense_ffn_columns(self):
+        model = AbstainingSingleLayerFFNWithZones(4, 6)
+        zones = [(1, 3), (0, 1)]
+        output, conf = model(torch.randn(2, 4), zones)
+        assert(output.shape == (2, 7))
+        assert(model.output_columns(torch.tensor([2, 0]), zones).tolist() == [2, 0])
+        assert(model.output_senses(torch.tensor([2, 0]), zones).tolist() == [2, 0])
+
         
 
 if __name__ == '__main__':
@@ -1,7 +1,12 @@
 import unittest
 from reed_wsd.allwords.raganato import harvest_data, create_sense_inventory
 from reed_wsd.allwords.raganato import parse_raganato_gold
+from reed_wsd.allwords.raganato import harvest_multi, run
+from reed_wsd.allwords.wordsense import SenseTaggedSentences
 import os
+import json
+import shutil
+import tempfile
 from os.path import join
 
 file_dir = os.path.dirname(os.path.realpath(__file__))
@@ -62,6 +67,51 @@ class TestRaganato(unittest.TestCase):
                     'd000.s001.t001': 'mountain%1:21:00::',
                     'd000.s001.t002': 'top%3:00:02::'}
         assert result == expected
+
+    def test_run(self):
+        xml_files = [join(self.testdata_dir, 'raganato1.xml'),
+                     join(self.testdata_dir, 'raganato2.xml')]
+        gold_files = [join(self.testdata_dir, 'raganato1.key.txt'),
+                      join(self.testdata_dir, 'raganato2.key.txt')]
+        out_dir = tempfile.mkdtemp()
+        try:
+            json_output = join(out_dir, 'raganato.json')
+            run(xml_files, gold_files, json_output, num_workers=2)
+            with open(json_output) as reader:
+                result = json.load(reader)
+            assert result == harvest_multi(xml_files, gold_files)
+            assert os.listdir(out_dir) == ['raganato.json']
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_run_split(self):
+        xml_files = [join(self.testdata_dir, 'raganato1.xml'),
+                     join(self.testdata_dir, 'raganato2.xml')]
+        gold_files = [join(self.testdata_dir, 'raganato1.key.txt'),
+                      join(self.testdata_dir, 'raganato2.key.txt')]
+        out_dir = tempfile.mkdtemp()
+        try:
+            split_dir = join(out_dir, 'raganato_split')
+            run(xml_files, gold_files, join(out_dir, 'raganato.json'), 
+                num_workers=1, split_dir=split_dir)
+            expected = harvest_multi(xml_files, gold_files)
+            for xml_file in xml_files:
+                corpus = expected['corpora'][xml_file]
+                sents = SenseTaggedSentences.from_split(split_dir, xml_file)
+                assert len(sents) == len(corpus['sents'])
+                assert sents.get_n_insts() == corpus['n_insts']
+                assert sents.count_instances() == corpus['n_insts']
+                assert sents[1] == corpus['sents'][1]
+                assert sents[0] == corpus['sents'][0]
+            inv = SenseTaggedSentences.from_split(split_dir, xml_files[0]).get_inventory()
+            assert inv.num_senses() == 8
+            with open(join(split_dir, 'corpora.json')) as reader:
+                corpora = json.load(reader)
+            for xml_file in xml_files:
+                assert corpora[xml_file]['n_sents'] == len(expected['corpora'][xml_file]['sents'])
+            assert not any(f.endswith('.npy') for f in os.listdir(split_dir))
+        finally:
+            shutil.rmtree(out_dir)
         
 
 if __name__ == "__main__":
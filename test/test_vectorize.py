@@ -0,0 +1,297 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from os.path import join
+import numpy as np
+from reed_wsd.allwords import vectorize, bert
+from reed_wsd.util import length_buckets
+
+
+class TestVectorize(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.vecs1 = [[11.0, 12.0, 13.0],
+                      [21.0, 22.0, 23.0]]
+        self.vecs2 = [[31.0, 32.0, 33.0],
+                      [41.0, 42.0, 43.0],
+                      [51.0, 52.0, 53.0]]
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_memmap_vector_manager(self):
+        store_dir = join(self.root_dir, 'corpus1')
+        with vectorize.MemmapVectorManager(store_dir) as writer:
+            writer.write(4, ['[CLS]', '[SEP]'], self.vecs1)
+            writer.write(7, ['[CLS]', 'hi', '[SEP]'], np.array(self.vecs2))
+        reader = vectorize.open_vector_manager(store_dir)
+        assert isinstance(reader, vectorize.MemmapVectorManager)
+        assert reader.sent_ids() == [4, 7]
+        data = reader.get_vector(7)
+        assert data['sentid'] == 7
+        assert data['tokens'] == ['[CLS]', 'hi', '[SEP]']
+        assert isinstance(data['vecs'], np.memmap)
+        assert data['vecs'].tolist() == self.vecs2
+        assert reader.get_vector(4)['vecs'].tolist() == self.vecs1
+        assert reader.get_vector(5) is None
+
+    def test_memmap_append(self):
+        store_dir = join(self.root_dir, 'corpus1')
+        os.makedirs(store_dir)
+        with open(join(store_dir, 'vectors.bin'), 'wb') as writer:
+            writer.write(b'leftover')
+        with vectorize.MemmapVectorManager(store_dir) as writer:
+            writer.write(4, ['[CLS]', '[SEP]'], self.vecs1)
+        with vectorize.MemmapVectorManager(store_dir) as writer:
+            writer.write(7, ['[CLS]', 'hi', '[SEP]'], self.vecs2)
+        assert os.path.getsize(join(store_dir, 'vectors.bin')) == 5 * 3 * 4
+        reader = vectorize.MemmapVectorManager(store_dir)
+        assert reader.get_vector(4)['vecs'].tolist() == self.vecs1
+        assert reader.get_vector(7)['vecs'].tolist() == self.vecs2
+        fingerprint = reader.fingerprint()
+        with vectorize.MemmapVectorManager(store_dir) as writer:
+            writer.write(8, ['a'], [[1.0, 2.0, 3.0]])
+        assert vectorize.MemmapVectorManager(store_dir).fingerprint() != fingerprint
+        with open(join(store_dir, 'vectors.bin'), 'ab') as writer:
+            writer.write(b'garbage')
+        with self.assertRaises(AssertionError):
+            vectorize.MemmapVectorManager(store_dir).write(8, ['a'], [[1.0, 2.0, 3.0]])
+
+    def test_memmap_float16(self):
+        store_dir = join(self.root_dir, 'corpus1')
+        with vectorize.MemmapVectorManager(store_dir, dtype='float16') as writer:
+            writer.write(0, ['a', 'b'], self.vecs1)
+        reader = vectorize.MemmapVectorManager(store_dir)
+        assert reader.dtype == 'float16'
+        assert os.path.getsize(join(store_dir, 'vectors.bin')) == 2 * 3 * 2
+        assert reader.get_vector(0)['vecs'].tolist() == self.vecs1
+
+    def test_memmap_int8(self):
+        store_dir = join(self.root_dir, 'corpus1')
+        with vectorize.MemmapVectorManager(store_dir, dtype='int8') as writer:
+            writer.write(0, ['a', 'b'], self.vecs1)
+            writer.write(1, ['c', 'd', 'e'], [[0.0, 0.0, 0.0], 
+                                              [-1.0, 0.5, 0.25],
+                                              [51.0, 52.0, 53.0]])
+        reader = vectorize.MemmapVectorManager(store_dir)
+        assert reader.dtype == 'int8'
+        assert os.path.getsize(join(store_dir, 'vectors.bin')) == 5 * 3
+        assert os.path.getsize(join(store_dir, 'scales.bin')) == 5 * 4
+        vecs = reader.get_vector(1)['vecs']
+        assert vecs.dtype == np.float32
+        assert vecs[0].tolist() == [0.0, 0.0, 0.0]
+        assert np.allclose(vecs[1], [-1.0, 0.5, 0.25], atol=1.0 / 254)
+        ref = vectorize.RamBasedVectorManager(dict())
+        ref.write(0, ['a', 'b'], np.array(self.vecs1))
+        error = vectorize.reconstruction_error(ref, reader, [0])
+        assert error['max_abs_error'] <= 23.0 / 254
+        assert error['mean_cosine'] > 0.9999
+
+    def test_convert_vector_tree(self):
+        corpus_dir = join(self.root_dir, 'data', 'corpus1.xml')
+        writer = vectorize.DiskBasedVectorManager(corpus_dir)
+        writer.write(3, ['a', 'b'], self.vecs1)
+        writer.write(150, ['c', 'd', 'e'], self.vecs2)
+        out_root = join(self.root_dir, 'converted')
+        vectorize.convert_vector_tree(self.root_dir, out_root)
+        reader = vectorize.open_vector_manager(join(out_root, 'data', 'corpus1.xml'))
+        assert isinstance(reader, vectorize.MemmapVectorManager)
+        assert reader.sent_ids() == [3, 150]
+        assert reader.get_vector(150)['tokens'] == ['c', 'd', 'e']
+        assert reader.get_vector(150)['vecs'].tolist() == self.vecs2
+        errors = vectorize.convert_vector_tree(self.root_dir, out_root, 'int8', report=True)
+        error = errors[join(out_root, 'data', 'corpus1.xml')]
+        assert error['max_abs_error'] <= 53.0 / 254
+        assert error['mean_cosine'] > 0.9999
+
+    def test_memmap_empty_rows(self):
+        store_dir = join(self.root_dir, 'corpus1')
+        for dtype in ['float32', 'int8']:
+            with vectorize.MemmapVectorManager(store_dir, dtype) as writer:
+                writer.write(0, [], np.zeros((0, 3)), positions=[])
+            reader = vectorize.MemmapVectorManager(store_dir)
+            assert reader.get_vector(0)['vecs'].shape == (0, 3)
+            assert reader.get_vector(1) is None
+            vectorize.MemmapVectorManager.remove(store_dir)
+
+    def test_length_buckets(self):
+        buckets = length_buckets([5, 2, 9, 3, 2], 2)
+        assert buckets == [[1, 4], [3, 0], [2]]
+
+    def test_vectorize_sents_batched(self):
+        sents = [{'sentid': 0, 'words': [{'word': 'a'}, {'word': 'b_c'}]},
+                 {'sentid': 1, 'words': [{'word': 'd'}]},
+                 {'sentid': 2, 'words': [{'word': 'e'}, {'word': 'f'}]}]
+        writer = vectorize.RamBasedVectorManager(dict())
+        meter = vectorize.vectorize_sents(sents, FakeVectorizer(), writer, batch_size=2)
+        assert meter.n_sents == 3
+        assert meter.n_toks == 6
+        assert writer.get_vector(0)['tokens'] == ['a', 'b', 'c']
+        assert writer.get_vector(0)['vecs'] == [[0.0], [1.0], [2.0]]
+        assert writer.get_vector(1)['tokens'] == ['d']
+        assert writer.get_vector(2)['tokens'] == ['e', 'f']
+
+    def test_vectorize_corpus_sharded_resumes(self):
+        sents = [{'sentid': i, 'words': [{'word': 'w{}'.format(i)}]} 
+                 for i in range(5)]
+        corpus_dir = join(self.root_dir, 'corpus1')
+        with self.assertRaises(ValueError):
+            vectorize.vectorize_corpus_sharded(sents, lambda: FakeVectorizer(fail_on='w3'),
+                                               corpus_dir, shard_size=2, batch_size=2)
+        manifest = vectorize.ShardManifest(join(corpus_dir, 'manifest.json'))
+        assert manifest.is_complete(0)
+        assert not manifest.is_complete(1)
+        vectorizer = FakeVectorizer()
+        vectorize.vectorize_corpus_sharded(sents, lambda: vectorizer,
+                                           corpus_dir, shard_size=2, batch_size=2)
+        assert vectorizer.seen == ['w2', 'w3', 'w4']
+        reader = vectorize.open_vector_manager(corpus_dir)
+        assert reader.sent_ids() == [0, 1, 2, 3, 4]
+        assert reader.get_vector(3)['tokens'] == ['w3']
+        assert not os.path.exists(join(corpus_dir, 'shards'))
+        assert vectorize.ShardManifest(join(corpus_dir, 'manifest.json')).merged
+        # an interruption between the merge and the removal of the shards
+        os.makedirs(join(corpus_dir, 'shards', 'shard0'))
+        vectorizer = FakeVectorizer()
+        vectorize.vectorize_corpus_sharded(sents, lambda: vectorizer,
+                                           corpus_dir, shard_size=2, batch_size=2)
+        assert vectorizer.seen == []
+        assert not os.path.exists(join(corpus_dir, 'shards'))
+        with self.assertRaises(ValueError):
+            vectorize.vectorize_corpus_sharded(sents, lambda: vectorizer, corpus_dir,
+                                               shard_size=3, batch_size=2)
+        with self.assertRaises(ValueError):
+            vectorize.vectorize_corpus_sharded(sents, lambda: vectorizer, corpus_dir,
+                                               shard_size=2, dtype='int8')
+        with self.assertRaises(ValueError):
+            vectorize.vectorize_corpus_sharded(sents[1:], lambda: vectorizer, corpus_dir,
+                                               shard_size=2, batch_size=2)
+
+    def test_shard_manifest_checks_ranges(self):
+        sents = [{'sentid': i, 'words': [{'word': 'w{}'.format(i)}]} 
+                 for i in range(4)]
+        manifest = vectorize.ShardManifest(join(self.root_dir, 'manifest.json'))
+        manifest.mark_complete(0, {'first': 0, 'last': 1, 'n_sents': 2, 'n_toks': 2})
+        assert manifest.is_complete(0, sents[0:2])
+        assert not manifest.is_complete(0, sents[1:3])
+        assert not manifest.is_complete(0, sents[0:3])
+        assert not manifest.is_complete(1, sents[2:4])
+
+    def test_vectorize_sents_targets_only(self):
+        sents = [{'sentid': 0, 'words': [{'word': 'a'}, 
+                                         {'word': 'b_c', 'sense': 'b_c%1'},
+                                         {'word': 'd'}, 
+                                         {'word': 'e'}]}]
+        writer = vectorize.RamBasedVectorManager(dict())
+        vectorize.vectorize_sents(sents, FakeVectorizer(), writer, batch_size=2,
+                                  targets_only=True)
+        data = writer.get_vector(0)
+        assert data['tokens'] == ['b_c']
+        assert data['positions'] == [1]
+        assert data['vecs'].tolist() == [[3.0]]
+        vectorize.vectorize_sents(sents, FakeVectorizer(), writer, batch_size=2,
+                                  targets_only=True, window=1)
+        data = writer.get_vector(0)
+        assert data['positions'] == [0, 1, 2]
+        assert data['vecs'].tolist() == [[0.0], [3.0], [3.0]]
+        store_dir = join(self.root_dir, 'corpus1')
+        with vectorize.MemmapVectorManager(store_dir) as store:
+            store.write(0, data['tokens'], data['vecs'], data['positions'])
+        assert vectorize.MemmapVectorManager(store_dir).get_positions(0) == [0, 1, 2]
+
+    def test_vectorize_sents_spans(self):
+        sents = [{'sentid': 0, 'words': [{'word': 'a'}, {'word': 'b_c'}, {'word': 'd'}]},
+                 {'sentid': 1, 'words': [{'word': 'e'}]}]
+        for batch_size in [1, 2]:
+            writer = vectorize.RamBasedVectorManager(dict())
+            vectorize.vectorize_sents(sents, SpanVectorizer(), writer, batch_size=batch_size)
+            assert writer.get_spans(0) == [[1, 2], [2, 4], [4, 5]]
+            assert writer.get_spans(1) == [[1, 2]]
+        store_dir = join(self.root_dir, 'corpus1')
+        with vectorize.MemmapVectorManager(store_dir) as store:
+            data = writer.get_vector(0)
+            store.write(0, data['tokens'], data['vecs'], spans=data['spans'])
+        reader = vectorize.MemmapVectorManager(store_dir)
+        assert reader.get_spans(0) == [[1, 2], [2, 4], [4, 5]]
+        assert reader.get_vector(0)['spans'] == [[1, 2], [2, 4], [4, 5]]
+
+    def test_cached_vector_manager(self):
+        vec_map = {0: {'sentid': 0, 'tokens': ['a', 'b'], 'vecs': self.vecs1},
+                   1: {'sentid': 1, 'tokens': ['c', 'd', 'e'], 'vecs': self.vecs2}}
+        # room for the three rows of sentence 1, but not for both sentences
+        cache = vectorize.CachedVectorManager(vectorize.RamBasedVectorManager(vec_map),
+                                              max_bytes=3 * 3 * 4)
+        assert cache.get_vector(0)['vecs'].tolist() == self.vecs1
+        assert cache.get_vector(0)['tokens'] == ['a', 'b']
+        assert cache.get_vector(1)['vecs'].tolist() == self.vecs2
+        assert cache.get_vector(1)['tokens'] == ['c', 'd', 'e']
+        stats = cache.stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 2
+        assert stats['evictions'] == 1
+        assert stats['n_sents'] == 1
+        assert stats['n_bytes'] == 36
+        taken = cache.take_stats()
+        assert taken == {'hits': 2, 'misses': 2, 'evictions': 1}
+        assert cache.stats()['hits'] == 0
+        cache.merge_stats(taken)
+        cache.merge_stats(taken)
+        assert cache.stats()['misses'] == 4
+
+    def test_cached_vector_manager_threads(self):
+        vec_map = {i: {'sentid': i, 'tokens': ['a', 'b'], 'vecs': self.vecs1}
+                   for i in range(20)}
+        cache = vectorize.CachedVectorManager(vectorize.RamBasedVectorManager(vec_map),
+                                              max_bytes=5 * 2 * 3 * 4)
+        def read():
+            for _ in range(50):
+                for i in range(20):
+                    assert cache.get_vector(i)['tokens'] == ['a', 'b']
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.stats()
+        assert stats['hits'] + stats['misses'] == 4 * 50 * 20
+        assert stats['n_sents'] == 5
+        assert stats['n_bytes'] == 5 * 2 * 3 * 4
+
+
+class FakeVectorizer:
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.seen = []
+
+    def tokenize(self, sent):
+        if sent == self.fail_on:
+            raise ValueError('simulated crash')
+        self.seen.append(sent)
+        return sent.split()
+
+    def encode_batch(self, input_ids_list):
+        return [(ids, [[float(i)] for i in range(len(ids))]) for ids in input_ids_list]
+
+
+class SpanVectorizer(FakeVectorizer):
+    """
+    Mimics the word span output of BertSentenceVectorizer.tokenize_words,
+    wrapping the tokens in [CLS] and [SEP].
+    
+    """
+    def tokenize_words(self, words):
+        toks = ['[CLS]']
+        word_ids = [None]
+        for i, word in enumerate(words):
+            toks += word.split()
+            word_ids += [i] * len(word.split())
+        toks.append('[SEP]')
+        word_ids.append(None)
+        return toks, bert.word_spans(word_ids, len(words))
+
+
+if __name__ == "__main__":
+    unittest.main()
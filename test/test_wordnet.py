@@ -1,5 +1,8 @@
 import unittest
-from reed_wsd.allwords.wordnet import wn_example
+import shutil
+import tempfile
+from os.path import join
+from reed_wsd.allwords.wordnet import wn_example, ExampleIndex
 from nltk.corpus import wordnet as wn
 from transformers import BertTokenizer
 
@@ -27,6 +30,22 @@ class TestBEMDataset(unittest.TestCase):
         print(span)
         assert(span == [1, 2])
 
+    def test_example_index(self):
+        be = wn.lemma_from_key('be%2:42:03::')
+        index = ExampleIndex(self.tknz)
+        assert(wn_example(be, 'is', self.tknz, index=index) == ('John is rich', [2, 3]))
+        assert(index.n_added == 2)
+        root_dir = tempfile.mkdtemp()
+        try:
+            filename = join(root_dir, 'wn_examples.json')
+            index.save(filename)
+            index = ExampleIndex.from_file(filename, self.tknz)
+            assert(len(index) == 1)
+            assert(index.matches(be.synset(), 'is') == [('John is rich', [2, 3])])
+            assert(index.n_added == 0)
+        finally:
+            shutil.rmtree(root_dir)
+
 
 
         
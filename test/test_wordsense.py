@@ -1,5 +1,7 @@
 import unittest
 import json
+import os
+import tempfile
 from torch import tensor
 from reed_wsd.allwords import wordsense, vectorize
 
@@ -85,6 +87,38 @@ class TestWordsense(unittest.TestCase):
                                           'laugh_off': (3, 6)}
         assert inventory.sense_range('laugh_off') == (3, 6)
     
+    def test_compiled_sense_inventory(self):
+        inventory = wordsense.SenseInventory.from_sense_iter(['laugh_off%1', 'be%1', 
+                                                    'laugh_off%2', 'laugh_off%3',
+                                                    'screen%1', 'screen%2'])
+        sense_ids = inventory.sense_id_tensor(['screen%2', 'be%1', 'laugh_off%3'])
+        assert sense_ids.tolist() == [5, 0, 3]
+        zone_starts, zone_stops = inventory.zone_tensors(sense_ids)
+        assert zone_starts.tolist() == [4, 0, 1]
+        assert zone_stops.tolist() == [6, 1, 4]
+        assert inventory.sense_lemmas(sense_ids) == ['screen', 'be', 'laugh_off']
+        assert inventory.lemma_id_tensor(['screen', 'be']).tolist() == [2, 0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'inventory.pt')
+            compiled = wordsense.SenseInventory.from_json_cached({'be': ['be%1']}, filename)
+            assert compiled.num_senses() == 1
+            loaded = wordsense.SenseInventory.from_json_cached({'be': ['be%1']}, filename)
+            assert loaded.sense_id('be%1') == 0
+            assert loaded.zone_stops.tolist() == [1]
+            changed = wordsense.SenseInventory.from_json_cached({'be': ['be%1', 'be%2']},
+                                                               filename)
+            assert changed.num_senses() == 2
+            json_file = os.path.join(tmp_dir, 'inventory.json')
+            with open(json_file, 'w') as writer:
+                json.dump({'be': ['be%1', 'be%2']}, writer)
+            compiled = wordsense.SenseInventory.from_json_cached(json_file, filename)
+            assert compiled.num_senses() == 2
+            assert wordsense.SenseInventory.from_json_cached(json_file, filename).num_senses() == 2
+            with open(json_file, 'w') as writer:
+                json.dump({'be': ['be%1', 'be%2', 'be%3']}, writer)
+            compiled = wordsense.SenseInventory.from_json_cached(json_file, filename)
+            assert compiled.num_senses() == 3
+
     def test_sense_tagged_sentences(self):
         sents = self.sents
         data = self.data
@@ -98,7 +132,42 @@ class TestWordsense(unittest.TestCase):
         assert(sent1['words'][2]['word'] == 'laughed_off')
         assert(sent1['words'][2]['tag'] == 'VB')
         assert(sent1['words'][2]['sense'] == 'laugh_off%2:32:00::')
- 
+
+    def test_columnar_sense_tagged_sentences(self):
+        sents = self.sents
+        corpus1 = self.data['corpora']['corpus1']
+        assert(sents[0] == corpus1['sents'][0])
+        assert(sents[-1] == corpus1['sents'][1])
+        assert(sents.sent_offsets.tolist() == [0, 5, 11])
+        assert(sents.sense_ids.tolist() == [-1, 0, -1, -1, -1,
+                                            -1, -1, 1, -1, 2, -1])
+        assert(sents.words[sents.word_ids[6]] == 'was')
+        assert(sents.word_ids[1] == sents.word_ids[6])
+        assert(sents.sent_words(1) == ['He', 'was', 'laughed_off', 'the', 'screen', '.'])
+        assert(sents.token(1, 4) == {'word': 'screen', 'tag': 'NN',
+                                     'sense': 'screen%1:06:06::', 'id': 'i1'})
+        sent_indices, positions = sents.instance_positions()
+        assert(sent_indices.tolist() == [0, 1, 1])
+        assert(positions.tolist() == [1, 2, 4])
+        inv = wordsense.SenseInventory({'screen': ['screen%1:06:06::']})
+        sent_indices, positions = sents.instance_positions(inv)
+        assert(sent_indices.tolist() == [1])
+        assert(positions.tolist() == [4])
+        assert(sents.count_instances() == 3)
+
+    def test_stored_spans(self):
+        vec_map = {37163: {'sentid': 37163, 'tokens': ['[CLS]', 'it', 'was', '[SEP]'],
+                           'vecs': [[0.0], [1.0], [2.0], [3.0]],
+                           'spans': [[1, 2], [2, 3], None, None, None]},
+                   37165: {'sentid': 37165, 'tokens': ['[CLS]', '[SEP]'],
+                           'vecs': [[0.0], [1.0]],
+                           'spans': [None, None, None, None, None, None]}}
+        dataset = wordsense.SenseInstanceDataset(self.sents, 
+                                                 vectorize.RamBasedVectorManager(vec_map))
+        assert dataset.index == [(0, 1, 2, 3)]
+        assert dataset.num_dropped_sents == 1
+        assert dataset[0].get_embedding('embed') == [2.0]
+
     def test_sense_instance_dataset(self):
         dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
                                                  randomize_sents = False)
@@ -123,6 +192,18 @@ class TestWordsense(unittest.TestCase):
         assert(self.compare_lists(sense_inst2.get_embedding('embed'), 
                                   [61.1, 62.1, 63.1]))       
  
+    def test_sense_instance_dataset_reads_each_record_once(self):
+        reads = []
+        get_vector = self.vec_mgr.get_vector
+        def counting_get_vector(sent_id):
+            reads.append(sent_id)
+            return get_vector(sent_id)
+        self.vec_mgr.get_vector = counting_get_vector
+        dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
+                                                 randomize_sents = False)
+        assert(len(dataset) == 3)
+        assert(sorted(reads) == [37163, 37165])
+
     def test_sense_instance_loader(self):
         dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
                                                  randomize_sents = False)
@@ -144,6 +225,37 @@ class TestWordsense(unittest.TestCase):
         assert(self.compare_matrices(evid, expected_evid))
         assert(self.compare_vectors(resp.float(), expected_resp.float()))
         
+    def test_prefetching_sense_instance_loader(self):
+        dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
+                                                 randomize_sents = False)
+        expected = list(wordsense.SenseInstanceLoader(dataset, batch_size = 2))
+        loader = wordsense.SenseInstanceLoader(dataset, batch_size = 2, prefetch = 1)
+        for epoch in range(2):
+            batches = list(loader)
+            assert(len(batches) == 2)
+            for (batch, expected_batch) in zip(batches, expected):
+                assert(batch[0] == expected_batch[0])
+                assert(batch[1] == ['be', 'laugh_off'] or batch[1] == ['screen'])
+                assert(self.compare_matrices(batch[2], expected_batch[2]))
+                assert(batch[3].tolist() == expected_batch[3].tolist())
+                assert(batch[4] == expected_batch[4])
+            assert(loader.wait_time > 0)
+        assert(self.compare_matrices(batches[0][2], tensor([[21., 22., 23.],
+                                                            [72.2, 74.2, 76.2]])))
+
+    def test_sentence_grouped_sense_instance_loader(self):
+        dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
+                                                 randomize_sents = False)
+        loader = wordsense.SenseInstanceLoader(dataset, batch_size = 2, 
+                                               shuffle = True, seed = 3)
+        for epoch in range(3):
+            order = [i for indices in loader.epoch_batches() for i in indices]
+            assert(sorted(order) == list(range(len(dataset))))
+            sents = [dataset.sent_index(i) for i in order]
+            # each sentence's instances are contiguous
+            assert(len(set(sents)) == len([s for (j, s) in enumerate(sents) 
+                                           if j == 0 or sents[j - 1] != s]))
+
     def test_sense_instance_loader2(self):
         dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
                                                  randomize_sents = False)
@@ -169,10 +281,127 @@ class TestWordsense(unittest.TestCase):
         assert(self.compare_vectors(resp1.float(), expected_resp.float()))
         assert(self.compare_matrices(evid2, expected_evid))
         assert(self.compare_vectors(resp2.float(), expected_resp.float()))
-        
 
+    def test_twin_sense_instance_loader_shared_table(self):
+        dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
+                                                 randomize_sents = False)
+        table = wordsense.CompiledSenseInstances.from_dataset(dataset)
+        loader = wordsense.TwinSenseInstanceLoader(table, batch_size = 2, shuffle = False)
+        assert(loader.get_instance_dataset() is table)
+        assert(len(loader) == 2)
+        ((_, _, evid1, resp1, zones1), (_, _, evid2, resp2, _)) = next(iter(loader))
+        assert(self.compare_matrices(evid1, tensor([[21., 22., 23.],
+                                                    [72.2, 74.2, 76.2]])))
+        assert(resp1.tolist() == [0, 1])
+        assert(zones1 == [(0, 1), (1, 2)])
+        assert(resp2.tolist() == [0, 1])
+        loader = wordsense.TwinSenseInstanceLoader(dataset, batch_size = 3, shuffle = True)
+        orders = set()
+        for _ in range(20):
+            ((ids1, _, _, resp1, _), (ids2, _, _, resp2, _)) = next(iter(loader))
+            assert(sorted(resp1.tolist()) == [0, 1, 2])
+            assert(sorted(resp2.tolist()) == [0, 1, 2])
+            orders.add((tuple(resp1.tolist()), tuple(resp2.tolist())))
+        assert(any(order1 != order2 for (order1, order2) in orders))
+
+    def test_sense_instance_dataset_random_access(self):
+        dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
+                                                 randomize_sents = False)
+        assert(len(dataset) == 3)
+        assert(dataset.index == [(0, 1, 1, 2), (1, 2, 2, 4), (1, 4, 5, 6)])
+        assert(dataset[2].sense == 'screen%1:06:06::')
+        assert(dataset[0].sense == 'be%2:42:06::')
+        assert(self.compare_lists(dataset[1].get_embedding('embed'), 
+                                  [72.2, 74.2, 76.2]))
+        loader = wordsense.SenseInstanceLoader(dataset, batch_size = 2, 
+                                               desired_ids = [2, 0])
+        assert(len(loader) == 1)
+        _, targets, _, resp, _ = next(iter(loader))
+        assert(targets == ['screen', 'be'])
+        assert(resp.tolist() == [2, 0])
+
+    def test_sense_instance_dataset_targets_only(self):
+        vec_map = {37163: {'sentid': 37163, 'tokens': ['was'], 
+                           'vecs': [[21.0, 22.0, 23.0]], 'positions': [1]},
+                   37165: {'sentid': 37165, 'tokens': ['laughed_off', 'screen'],
+                           'vecs': [[72.2, 74.2, 76.2], [61.1, 62.1, 63.1]],
+                           'positions': [2, 4]}}
+        vec_mgr = vectorize.RamBasedVectorManager(vec_map)
+        dataset = wordsense.SenseInstanceDataset(self.sents, vec_mgr,
+                                                 randomize_sents = False)
+        assert(len(dataset) == 3)
+        assert(self.compare_lists(dataset[1].get_embedding('embed'), 
+                                  [72.2, 74.2, 76.2]))
+        assert(self.compare_lists(dataset[2].get_embedding('embed'), 
+                                  [61.1, 62.1, 63.1]))
+
+    def test_compiled_sense_instances(self):
+        dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
+                                                 randomize_sents = False)
+        table = wordsense.CompiledSenseInstances.from_dataset(dataset)
+        assert(len(table) == 3)
+        expected_evid = tensor([[21., 22., 23.],
+                                [72.2, 74.2, 76.2],
+                                [61.1, 62.1, 63.1]])
+        assert(self.compare_matrices(table.evidence, expected_evid))
+        assert(table.sense_ids.tolist() == [0, 1, 2])
+        assert(table.zones(tensor([0, 2])) == [(0, 1), (2, 3)])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'compiled.pt')
+            table.save(filename)
+            loaded = wordsense.CompiledSenseInstances.from_dataset_cached(dataset, filename)
+            assert(self.compare_matrices(loaded.evidence, expected_evid))
+            assert(loaded.targets == ['be', 'laugh_off', 'screen'])
+            # a table saved with the dataset's fingerprint is reused as is
+            stale = wordsense.CompiledSenseInstances(table.evidence * 0, table.sense_ids,
+                                                     table.zone_starts, table.zone_stops,
+                                                     table.inst_ids, table.targets,
+                                                     table.inventory)
+            fingerprint = wordsense.CompiledSenseInstances.fingerprint(dataset)
+            stale.save(filename, fingerprint)
+            loaded = wordsense.CompiledSenseInstances.from_dataset_cached(dataset, filename)
+            assert(loaded.evidence.abs().sum().item() == 0)
+            # but not once the fingerprint changes
+            fingerprint['n_insts'] += 1
+            stale.save(filename, fingerprint)
+            loaded = wordsense.CompiledSenseInstances.from_dataset_cached(dataset, filename)
+            assert(self.compare_matrices(loaded.evidence, expected_evid))
 
+    def test_compiled_sense_instance_loader(self):
+        dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
+                                                 randomize_sents = False)
+        table = wordsense.CompiledSenseInstances.from_dataset(dataset)
+        loader = wordsense.CompiledSenseInstanceLoader(table, batch_size = 2)
+        assert(len(loader) == 2)
+        batches = list(loader)
+        _, targets, evid, resp, zones = batches[0]
+        expected_evid = tensor([[21., 22., 23.],
+                                [72.2, 74.2, 76.2]])
+        assert(targets == ['be', 'laugh_off'])
+        assert(self.compare_matrices(evid, expected_evid))
+        assert(resp.tolist() == [0, 1])
+        assert(zones == [(0, 1), (1, 2)])
+        _, _, evid, resp, _ = batches[1]
+        assert(self.compare_matrices(evid, tensor([[61.1, 62.1, 63.1]])))
+        assert(resp.tolist() == [2])
 
+    def test_prefetching_compiled_sense_instance_loader(self):
+        dataset = wordsense.SenseInstanceDataset(self.sents, self.vec_mgr,
+                                                 randomize_sents = False)
+        table = wordsense.CompiledSenseInstances.from_dataset(dataset)
+        expected = list(wordsense.CompiledSenseInstanceLoader(table, batch_size = 2))
+        loader = wordsense.TwinSenseInstanceLoader(table, batch_size = 2, shuffle = False,
+                                                   prefetch = 2)
+        assert(loader.inst_loader1.prefetch == 2)
+        assert(loader.inst_loader2.prefetch == 2)
+        for (batch, _) in loader:
+            expected_batch = expected.pop(0)
+            assert(batch[0] == expected_batch[0])
+            assert(self.compare_matrices(batch[2], expected_batch[2]))
+            assert(batch[3].tolist() == expected_batch[3].tolist())
+        assert(expected == [])
+        assert(loader.inst_loader1.wait_time >= 0)
+        
         
 if __name__ == "__main__":
 	unittest.main()